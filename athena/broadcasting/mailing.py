@@ -1,83 +1,106 @@
 from jinja2 import Environment, PackageLoader, ChoiceLoader, FileSystemLoader
 from mailshake import SMTPMailer, EmailMessage
+import sys
+import traceback
 import yaml
+from collections import OrderedDict
 from datetime import datetime
 from os import listdir
-from os.path import isfile, join as path_join
-from athena.queries import query_impala, query_to_csv
+from os.path import getsize, isfile, join as path_join
+from shutil import copyfile
+from athena.queries import query_impala_cursor, query_to_csv
+from athena.queries.cache import normalize_sql
 from slugify import slugify
+from athena.utils import imap_bounded
 from athena.utils.config import ConfigDir, Config
 from athena.utils.file import create_tmp_dir
+from athena.utils.profiling import count, span
+
+
+class ReportError(Exception):
+    pass
 
 
 def mail_report(name, recipients=None, stdout=False, template=None):
-    reports_dir = ConfigDir().sub('reports').path
     config = Config.load_default()
-    template_dir = ConfigDir().sub('templates').path
-    template_name = template or config.mailing.default_template
-    if not template_name.endswith('.html'):
-        template_name += '.html'
-    loader = ChoiceLoader([
-        FileSystemLoader(template_dir),
-        PackageLoader('athena.broadcasting', 'templates')
-    ])
-    env = Environment(loader=loader)
-    template = env.get_template(template_name)
+    job = load_report(name)
+    recipients = report_recipients(job, recipients, stdout)
+    # Run all queries of the report before rendering anything, so the report takes as long as its slowest query
+    blocks, csvs = gather_report_data(name, report_queries(name, job), config.mailing.query_concurrency)
+    send_report(job, blocks, csvs, recipients, stdout, template)
+
+
+def mail_reports(names, template=None):
+    """
+    Sends several reports that are due at the same time. All queries of all reports run together, and queries that
+    appear in more than one report (see unique_queries) run only once. A report that fails does not keep the others
+    from being sent. Returns a dict with the number of queries the reports contain, the number that was executed, the
+    number of executions saved and a list with the error message of every report that failed.
+    """
+    config = Config.load_default()
+    reports, failures = prepare_reports(names)
+    queries = [query for _, _, report in reports for query in report]
+    results, executions = run_report_queries(queries, config.mailing.query_concurrency)
+    failures.extend(send_reports(reports, results, template))
+    return {'reports': len(names), 'queries': len(queries), 'executions': executions,
+            'executions_saved': len(queries) - executions, 'failures': failures}
 
-    job_file = path_join(reports_dir, name)
-    if not isfile(job_file):
-        raise ValueError("{} does not exist or is not a readable file!".format(name))
-    with open(job_file, 'r') as f:
-        job = yaml.load(f.read())
-    title = job.get('title')
-    description = job.get('description')
-    data = job.get('data')
-    inline_blocks = data.get('inline')
-    csv_items = data.get('csv')
-    today = datetime.now().date().strftime('%d %b %Y')
 
+def prepare_reports(names):
+    """
+    Loads the given reports and their queries. Returns a list with a (name, job, queries) tuple per report, and a list
+    with the error message of every report that could not be loaded.
+    """
+    reports = []
+    failures = []
+    for name in names:
+        try:
+            job = load_report(name)
+            report_recipients(job)
+            reports.append((name, job, report_queries(name, job)))
+        except ValueError as e:
+            failures.append(str(e))
+    return reports, failures
+
+
+def send_reports(reports, results, template=None):
+    """
+    Sends the reports returned by prepare_reports, given a (result, error) tuple for each of their queries in the same
+    order. Returns a list with the error message of every report that could not be sent.
+    """
+    failures = []
+    offset = 0
+    for name, job, report in reports:
+        try:
+            blocks, csvs = report_data(name, report, results[offset:offset + len(report)])
+            send_report(job, blocks, csvs, template=template)
+        except ReportError as e:
+            failures.append(str(e))
+        except Exception as e:
+            failures.append("{} could not be sent: {}".format(name, e))
+        offset += len(report)
+    return failures
+
+
+def report_recipients(job, recipients=None, stdout=False):
     if not recipients:
         job_recepients = job.get('recipients')
         recipients = [recipient.strip() for recipient in job_recepients.split(',')] if job_recepients else None
-    if not data or (not inline_blocks and not csv_items):
-        raise ValueError("Your job config must contain a 'data' section with one or more inline or csv entries")
     if not recipients and not stdout:
         raise ValueError("No recipients to send the data!")
+    return recipients
 
-    blocks = []
-    if inline_blocks:
-        for block_item in inline_blocks:
-            block = {'name': block_item['name'], 'description': block_item['description']}
-            if block_item['type'] == 'sql':
-                rows, headers = query_impala(block_item['query'])
-                block['data'] = {'headers': headers, 'rows': rows}
-            else:
-                raise ValueError("{} contains an inline block of unknown type ({})!".format(name, block_item['type']))
 
-            blocks.append(block)
-    csvs = []
-    if csv_items:
-        tmpdir = create_tmp_dir(prefix=slugify(title, separator='_'))
-        for item in csv_items:
-            filenameretrieve = item['filename']
-            csv_path = path_join(tmpdir, filenameretrieve)
-            if item['type'] == 'sql':
-                sql_query = item['query']
-                if 'with_items' in item:
-                    variables = item['with_items']
-                    for variable in variables:
-                        processed_sql_query = sql_query.replace("{{ item }}", variable)
-                        processed_filename = filenameretrieve.replace("{{ item }}", variable)
-                        csv_path_instance = path_join(tmpdir, processed_filename)
-                        query_to_csv(processed_sql_query, csv_path_instance)
-                        csvs.append({'name': processed_filename, 'path': csv_path_instance})
-                else:
-                    query_to_csv(sql_query, csv_path)
-                    csvs.append({'name': filenameretrieve, 'path': csv_path})
-            else:
-                raise ValueError("{} contains csv item of unknown type ({})!".format(name, item['type']))
+def send_report(job, blocks, csvs, recipients=None, stdout=False, template=None):
+    config = Config.load_default()
+    template = get_template(template or config.mailing.default_template)
+    title = job.get('title')
+    description = job.get('description')
+    today = datetime.now().date().strftime('%d %b %Y')
 
-    html = template.render(title=title, description=description, today=today, blocks=blocks)
+    recipients = report_recipients(job, recipients, stdout)
+    with span('report.render'):
+        html = template.render(title=title, description=description, today=today, blocks=blocks)
     if stdout:
         print html
         print "\n"
@@ -99,10 +122,164 @@ def mail_report(name, recipients=None, stdout=False, template=None):
             to=recipients,
             html=html
         )
-        for c in csvs:
-            email_msg.attach_file(c['path'])
+        with span('report.smtp'):
+            for c in csvs:
+                email_msg.attach_file(c['path'])
+                count('report.attachment_bytes', getsize(c['path']))
+            mailer.send_messages(email_msg)
+
+
+def get_template(template_name):
+    template_dir = ConfigDir().sub('templates').path
+    if not template_name.endswith('.html'):
+        template_name += '.html'
+    loader = ChoiceLoader([
+        FileSystemLoader(template_dir),
+        PackageLoader('athena.broadcasting', 'templates')
+    ])
+    env = Environment(loader=loader)
+    return env.get_template(template_name)
+
+
+def load_report(name):
+    reports_dir = ConfigDir().sub('reports').path
+    job_file = path_join(reports_dir, name)
+    if not isfile(job_file):
+        raise ValueError("{} does not exist or is not a readable file!".format(name))
+    with open(job_file, 'r') as f, span('report.load'):
+        job = yaml.load(f.read())
+
+    data = job.get('data')
+    if not data or (not data.get('inline') and not data.get('csv')):
+        raise ValueError("Your job config must contain a 'data' section with one or more inline or csv entries")
+    return job
+
+
+def report_queries(name, job):
+    """
+    Returns all queries of a report, with the with_items of csv entries expanded, as a list of dicts in the order in
+    which their results appear in the report. The 'kind' of each query is either 'inline' or 'csv'.
+    """
+    data = job.get('data')
+    inline_blocks = data.get('inline')
+    csv_items = data.get('csv')
+    cache_ttl = job.get('cache_ttl')
+
+    queries = []
+    if inline_blocks:
+        for block_item in inline_blocks:
+            if block_item['type'] != 'sql':
+                raise ValueError("{} contains an inline block of unknown type ({})!".format(name, block_item['type']))
+            queries.append({'kind': 'inline', 'name': block_item['name'],
+                            'description': block_item.get('description'), 'query': block_item['query'],
+                            'cache_ttl': block_item.get('cache_ttl', cache_ttl)})
+    if csv_items:
+        tmpdir = create_tmp_dir(prefix=slugify(job.get('title'), separator='_'))
+        for item in csv_items:
+            filenameretrieve = item['filename']
+            if item['type'] != 'sql':
+                raise ValueError("{} contains csv item of unknown type ({})!".format(name, item['type']))
+            sql_query = item['query']
+            item_cache_ttl = item.get('cache_ttl', cache_ttl)
+            if 'with_items' in item:
+                for variable in item['with_items']:
+                    processed_filename = filenameretrieve.replace("{{ item }}", variable)
+                    queries.append({'kind': 'csv', 'name': processed_filename,
+                                    'path': path_join(tmpdir, processed_filename),
+                                    'query': sql_query.replace("{{ item }}", variable),
+                                    'cache_ttl': item_cache_ttl})
+            else:
+                queries.append({'kind': 'csv', 'name': filenameretrieve, 'path': path_join(tmpdir, filenameretrieve),
+                                'query': sql_query, 'cache_ttl': item_cache_ttl})
+    return queries
+
+
+def run_report_query(query):
+    if query['kind'] == 'inline':
+        with query_impala_cursor(query['query'], cache_ttl=query.get('cache_ttl')) as cursor:
+            headers = [i[0] for i in cursor.description]
+            with span('query.fetch'):
+                rows = cursor.fetchall()
+            count('query.rows', len(rows))
+        return {'headers': headers, 'rows': rows}
+    else:
+        query_to_csv(query['query'], query['path'], cache_ttl=query.get('cache_ttl'))
+        return query['path']
+
+
+def unique_queries(queries):
+    """
+    Returns the distinct queries among the given report queries, and for every query the index of its distinct query.
+    Queries are the same when they are of the same kind and have the same SQL, after normalization.
+    """
+    unique = OrderedDict()
+    indices = []
+    for query in queries:
+        key = (query['kind'], normalize_sql(query['query']))
+        if key not in unique:
+            unique[key] = (len(unique), query)
+        indices.append(unique[key][0])
+    return [query for _, query in unique.values()], indices
+
+
+def run_report_queries(queries, concurrency=1):
+    """
+    Runs the given report queries, at most `concurrency` at a time. Queries that are the same (see unique_queries) run
+    only once: inline queries share the result, and the csv file is copied for csv queries. Returns a list with a
+    (result, error) tuple per query, in the same order, and the number of queries that were executed.
+    """
+    unique, indices = unique_queries(queries)
+    with span('report.queries'):
+        outcomes = list(imap_bounded(run_report_query, unique, concurrency))
+
+    results = []
+    for query, index in zip(queries, indices):
+        result, error = outcomes[index]
+        if error is None and query['kind'] == 'csv' and query is not unique[index]:
+            try:
+                copyfile(result, query['path'])
+                result = query['path']
+            except IOError:
+                result, error = None, sys.exc_info()
+        results.append((result, error))
+    return results, len(unique)
+
+
+def gather_report_data(name, queries, concurrency=1):
+    """
+    Runs the given report queries, at most `concurrency` at a time, and returns the inline blocks and csv attachments
+    for the report. Raises a ReportError when any of the queries failed, after all of them have finished.
+    """
+    results, _ = run_report_queries(queries, concurrency)
+    return report_data(name, queries, results)
+
+
+def report_data(name, queries, results):
+    """
+    Returns the inline blocks and csv attachments for a report, from its queries and the (result, error) tuple of
+    each, where the error is either an exc_info tuple or a message. Raises a ReportError when any of the queries
+    failed.
+    """
+    blocks = []
+    csvs = []
+    failures = []
+    for query, (result, error) in zip(queries, results):
+        if error is not None:
+            failures.append("'{}': {}".format(query['name'], describe_error(error)))
+        elif query['kind'] == 'inline':
+            blocks.append({'name': query['name'], 'description': query['description'], 'data': result})
+        else:
+            csvs.append({'name': query['name'], 'path': result})
+    if failures:
+        raise ReportError("{} failed to run {} of its queries: {}".format(name, len(failures), '; '.join(failures)))
+    return blocks, csvs
+
 
-        mailer.send_messages(email_msg)
+def describe_error(error):
+    """Returns the message for an error given as exc_info tuple, or the error itself when it is a message already."""
+    if isinstance(error, basestring):
+        return error
+    return ''.join(traceback.format_exception_only(*error[:2])).strip()
 
 
 def list_reports():
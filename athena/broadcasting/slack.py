@@ -1,25 +1,88 @@
+import logging
+import threading
+import time
+from functools import partial
+from itertools import chain
+from os.path import basename, join as path_join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from slugify import slugify
 from tabulate import tabulate
+from athena.queries import fetch_batches, limit_query, query_impala_cursor
 from athena.utils.config import Config
+from athena.utils.file import write_csv_batches
 
+logger = logging.getLogger(__name__)
 
-def send_msg(text, username=None, channel=None, icon=None):
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(token):
     """
-    Send a message to Slack
+    Returns a Slacker client for the given token, shared by everything in the process. Its chat and files calls go
+    through a single HTTP session, so they reuse the connection to Slack rather than opening one per message.
     """
+    if not token:
+        raise ValueError("You must provide a Slack token in your configuration!")
+    with _clients_lock:
+        client = _clients.get(token)
+        if client is None:
+            import requests
+            from slacker import Slacker
+            client = Slacker(token)
+            session = requests.Session()
+            for api in (client.chat, client.files):
+                api.get = partial(api._request, session.get)
+                api.post = partial(api._request, session.post)
+            _clients[token] = client
+    return client
 
-    from slacker import Slacker
 
-    config = Config.load_default()
-    if not config.slack.token:
-        raise ValueError("You must provide a Slack token in your configuration!")
-    if not channel and not config.slack.default_channel:
-        raise ValueError("You must provide a channel to send the Slack message to!")
+def call_slack(method, *args, **kwargs):
+    """
+    Calls a method of a Slacker client, and calls it again when Slack rate limited it (HTTP 429): after the number of
+    seconds in the Retry-After header, or with exponential backoff when there is none, at most slack.max_retries times.
+    """
+    from requests import HTTPError
+    max_retries = Config.load_default().slack.max_retries
+    attempt = 0
+    while True:
+        try:
+            return method(*args, **kwargs)
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 429 or attempt >= max_retries:
+                raise
+            delay = retry_delay(e.response, attempt)
+        attempt += 1
+        logger.warning("Slack rate limited the request, retrying in %s seconds", delay)
+        time.sleep(delay)
+
+
+def retry_delay(response, attempt):
+    try:
+        return max(float(response.headers['Retry-After']), 0)
+    except (KeyError, TypeError, ValueError):
+        return min(2 ** attempt, 60)
 
-    slack = Slacker(config.slack.token)
 
+def get_channel(channel, config):
+    if not channel and not config.slack.default_channel:
+        raise ValueError("You must provide a channel to send the Slack message to!")
     ch = channel or config.slack.default_channel
     if not ch.startswith("#"):
         ch = "#" + ch
+    return ch
+
+
+def send_msg(text, username=None, channel=None, icon=None):
+    """
+    Send a message to Slack
+    """
+    config = Config.load_default()
+    slack = get_client(config.slack.token)
+    ch = get_channel(channel, config)
     u = username or config.slack.default_username
     i = icon or config.slack.default_icon
     icon_url = None
@@ -29,12 +92,104 @@ def send_msg(text, username=None, channel=None, icon=None):
     else:
         icon_url = i
 
-    response = slack.chat.post_message(ch, text, username=u, icon_url=icon_url, icon_emoji=icon_emoji)
+    response = call_slack(slack.chat.post_message, ch, text, username=u, icon_url=icon_url, icon_emoji=icon_emoji)
     return response
 
 
+def split_lines(lines, max_chars):
+    """
+    Yields the lines joined into chunks of at most max_chars characters, keeping lines whole. A line that is longer
+    than that on its own is cut off.
+    """
+    chunk, size = [], 0
+    for line in lines:
+        line = line[:max_chars]
+        if chunk and size + len(line) + 1 > max_chars:
+            yield '\n'.join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        yield '\n'.join(chunk)
+
+
 def send_table(title, headers, data, username, channel, icon):
+    """
+    Sends rows to Slack as a table. A table that does not fit in a single message of slack.max_message_chars characters
+    is sent in several messages, split between rows.
+    """
     t = title or ""
-    msg = '\n{} ```{}``` '.format(
-        t, tabulate(data, headers=headers, tablefmt="plain", numalign='left'))
-    send_msg(msg, username, channel, icon)
+    table = tabulate(data, headers=headers, tablefmt="plain", numalign='left')
+    max_chars = max(Config.load_default().slack.max_message_chars - len(t) - 10, 1)
+    for n, chunk in enumerate(split_lines(table.split('\n'), max_chars)):
+        msg = '\n{} ```{}``` '.format(t, chunk) if n == 0 else '```{}```'.format(chunk)
+        send_msg(msg, username, channel, icon)
+
+
+def upload_file(path, title=None, channel=None, comment=None):
+    """
+    Uploads a file to Slack. Files are uploaded as the owner of the token, so they don't get a username or icon.
+    """
+    config = Config.load_default()
+    slack = get_client(config.slack.token)
+    ch = get_channel(channel, config)
+    return call_slack(slack.files.upload, path, filename=basename(path), title=title, initial_comment=comment,
+                      channels=ch)
+
+
+class RowCap(object):
+    """Passes batches of rows through until max_rows rows have passed, and keeps count."""
+
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.rows = 0
+        self.truncated = False
+
+    def __call__(self, batches):
+        for batch in batches:
+            if self.rows + len(batch) > self.max_rows:
+                self.truncated = True
+                batch = batch[:self.max_rows - self.rows]
+            self.rows += len(batch)
+            if batch:
+                yield batch
+            if self.truncated:
+                return
+
+
+def broadcast_query(sql, title=None, username=None, channel=None, icon=None, max_rows=None):
+    """
+    Runs a query and broadcasts its results to Slack: as a table when it has at most slack.max_table_rows rows, and
+    otherwise as a CSV file, which is written while the rows are fetched. At most max_rows rows (slack.max_rows by
+    default) are sent, and the query gets a LIMIT so Impala does not produce more than that. Returns the number of rows
+    sent.
+    """
+    config = Config.load_default()
+    max_rows = max_rows or config.slack.max_rows
+    cap = RowCap(max_rows)
+    tmpdir = mkdtemp(prefix='athena_')
+    try:
+        path = None
+        # one row more than is sent, to tell whether the results were cut off
+        with query_impala_cursor(limit_query(sql, max_rows + 1)) as cursor:
+            headers = [i[0] for i in cursor.description]
+            batches = fetch_batches(cursor, min(config.cluster.fetch_size, max_rows + 1))
+            rows = []
+            for batch in batches:
+                rows.extend(batch)
+                if len(rows) > config.slack.max_table_rows:
+                    path = path_join(tmpdir, '{}.csv'.format(slugify(title) if title else 'results'))
+                    write_csv_batches(path, cap(chain([rows], batches)), headers)
+                    break
+
+        if path is None:
+            rows = next(cap([rows]), [])
+            if cap.truncated:
+                title = '{} (the first {} rows)'.format(title or '', cap.rows).lstrip()
+            send_table(title, headers, rows, username, channel, icon)
+        else:
+            comment = '{} rows'.format(cap.rows) if not cap.truncated else 'The first {} rows'.format(cap.rows)
+            upload_file(path, title, channel, '{}: {}'.format(title, comment) if title else comment)
+        return cap.rows
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
@@ -1,70 +1,183 @@
 import click
-from click.exceptions import UsageError
-from jinja2 import TemplateNotFound
 from athena.utils.config import Config, ConfigDir
-import queries.query as q
-from queries import query_impala
-from utils.cluster import get_dns
-from utils.ssh import MasterNodeSSHClient, open_ssh_session
-from utils.tunnel import create_tunnel
-from broadcasting.mailing import mail_report, list_reports
-from yaml import safe_dump
-from broadcasting import slack
+from athena.utils.file import Throughput, OUTPUT_FORMATS
+from athena.utils.profiling import enable_profiling
+
+# Every command imports the modules it needs when it runs, rather than here, so commands like `athena url` and
+# `athena --help` don't load paramiko, impyla, jinja2 and friends. tests/test_cli.py keeps an eye on this.
 
 
 @click.group()
-def main():
-    pass
+@click.option('--profile', is_flag=True, default=False, help='Show how long every stage of the command took')
+@click.option('--metrics-json', type=click.Path(), help='Write how long every stage of the command took to a JSON file')
+@click.pass_context
+def main(ctx, profile, metrics_json):
+    if profile or metrics_json:
+        profiler = enable_profiling()
+
+        @ctx.call_on_close
+        def report_profile():
+            if profile:
+                click.echo(profiler.report(), err=True)
+            if metrics_json:
+                with open(metrics_json, 'w') as f:
+                    f.write(profiler.to_json(command=ctx.invoked_subcommand))
 
 
 @main.command()
 @click.option('--slave/--master', 'slave', default=False)
 def url(slave):
+    from utils.cluster import get_dns
     click.echo(get_dns(slave))
 
 
+def print_throughput(throughput, final=False):
+    click.echo('\r{:,} rows written, {:,.0f} rows/s, {:.2f} MB/s'.format(
+        throughput.rows, throughput.rows_per_second, throughput.bytes_per_second / (1024 * 1024)), nl=final, err=True)
+
+
+def ask_for_more():
+    click.echo('-- More (press any key to continue, q to quit) --', nl=False, err=True)
+    key = click.getchar()
+    click.echo('\r' + ' ' * 50 + '\r', nl=False, err=True)
+    return key not in ('q', 'Q', '\x1b')
+
+
 @main.command()
 @click.argument('sql', type=click.STRING)
-@click.option('--csv', type=click.Path(), help='Write the query results to the specified csv file')
-def query(sql, csv):
-    """ Run a SQL query on the cluster and write the results to the terminal or a CSV file. """
-    click.echo(q.execute_query(sql, csv))
+@click.option('--csv', type=click.Path(),
+              help='Write the query results to the specified csv file. Use a .gz or .zst extension for compression')
+@click.option('--output', '-o', type=click.Path(), help='Write the query results to the specified file')
+@click.option('--format', 'output_format', type=click.Choice(OUTPUT_FORMATS),
+              help='Format of the output file. By default derived from its extension')
+@click.option('--batch-size', type=click.INT, help='Number of rows to fetch and write at once')
+@click.option('--progress/--no-progress', default=False, help='Show the progress of writing the output file')
+@click.option('--max-rows', type=click.INT, help='Maximum number of rows to show in the terminal')
+@click.option('--pager/--no-pager', default=False, help='Show the results in the terminal one page at a time')
+@click.option('--cache-ttl', type=click.INT,
+              help='Seconds for which the results may be served from, and are kept in, the local result cache')
+def query(sql, csv, output, output_format, batch_size, progress, max_rows, pager, cache_ttl):
+    """ Run a SQL query on the cluster and write the results to the terminal or a CSV, Parquet or Arrow file. """
+    import queries.query as q
+    from queries.render import stream_query
+    if csv and output:
+        raise click.BadParameter("Use either --csv or --output, not both")
+    if csv:
+        output, output_format = csv, 'csv'
+    if output_format and not output:
+        raise click.BadParameter("--format requires an output file")
+    if not output:
+        if pager:
+            page_size = max(click.get_terminal_size()[1] - 3, 1)
+            stream_query(sql, click.echo, max_rows=max_rows, page_size=page_size, more=ask_for_more,
+                         cache_ttl=cache_ttl)
+        else:
+            stream_query(sql, click.echo, max_rows=max_rows, page_size=batch_size, cache_ttl=cache_ttl)
+        return
+    throughput = Throughput(print_throughput) if progress else None
+    try:
+        click.echo(q.execute_query(sql, output, batch_size=batch_size, progress=throughput,
+                                   output_format=output_format, cache_ttl=cache_ttl))
+    except ValueError as e:
+        raise click.BadParameter(e.message)
 
 
 @main.command()
 @click.argument('queryfile', type=click.File())
-def batch(queryfile):
+@click.option('--parallel', '-p', type=click.INT, default=1,
+              help='Number of queries to run at the same time, spread over the slave nodes')
+@click.option('--cache-ttl', type=click.INT,
+              help='Seconds for which results may be served from the local result cache, unless set per query')
+def batch(queryfile, parallel, cache_ttl):
     """ Run a batch of SQL queries on the cluster and write the results to the terminal or separate CSV files. """
-    q.parse_yaml_queries(queryfile)
+    import queries.query as q
+    if parallel < 1:
+        raise click.BadParameter("--parallel should be at least 1")
+    try:
+        failures = q.parse_yaml_queries(queryfile, parallel, cache_ttl)
+    except ValueError as e:
+        raise click.BadParameter(e.message)
+    if failures:
+        raise click.ClickException("{} of the queries in the batch failed".format(len(failures)))
+
+
+@main.group()
+def cache():
+    """ Inspect or clear the local query result cache. """
+    pass
+
+
+@cache.command('stats')
+def cache_stats():
+    """ Show the size and hit rate of the result cache. """
+    from queries.cache import get_result_cache
+    stats = get_result_cache().stats()
+    lookups = stats['hits'] + stats['misses']
+    click.echo('{:,} results, {:.2f} of {:.0f} MB'.format(stats['entries'], stats['size'] / (1024.0 * 1024),
+                                                          stats['max_size'] / (1024.0 * 1024)))
+    click.echo('{:,} hits, {:,} misses ({:.0%} hit rate), {:,} evictions'.format(
+        stats['hits'], stats['misses'], float(stats['hits']) / lookups if lookups else 0, stats['evictions']))
+
+
+@cache.command('clear')
+def cache_clear():
+    """ Remove all results from the result cache. """
+    from queries.cache import get_result_cache
+    get_result_cache().clear()
+    click.echo("The result cache has been cleared")
 
 
 @main.command()
 @click.option('--slave/--master', 'slave', default=False)
 def ssh(slave):
     """ Create an interactive SSH session to the master node of the cluster. """
+    from utils.ssh import open_ssh_session
     open_ssh_session(slave)
 
 
 @main.command()
-@click.argument('local_port', type=click.INT)
-@click.argument('remote_port', type=click.INT)
+@click.argument('local_port', type=click.INT, required=False)
+@click.argument('remote_port', type=click.INT, required=False)
 @click.option('--slave/--master', 'slave', default=False)
-def tunnel(local_port, remote_port, slave):
+@click.option('--forward', '-L', 'forwards', multiple=True, metavar='[BIND_ADDRESS:]PORT:HOST:HOSTPORT',
+              help='Also forward a local port to a port on any host reachable from the master node. Can be repeated')
+@click.option('--socks', metavar='[BIND_ADDRESS:]PORT',
+              help='Run a SOCKS5 proxy on this local port, for connecting to any cluster node. It only accepts '
+                   'connections from this machine, unless a bind address is given')
+@click.option('--quiet', '-q', is_flag=True, default=False, help='Do not log every connection through the tunnel')
+def tunnel(local_port, remote_port, slave, forwards, socks, quiet):
     """
     Create an ssh tunnel to the master node of the cluster, forwarding traffic from the remote_port on the master node
-    to the local_port on this machine
+    to the local_port on this machine. All tunnels of a single invocation share one SSH connection.
     """
-    create_tunnel(local_port, remote_port, slave)
+    from utils.tunnel import create_tunnel, parse_forward_spec, parse_socks_spec
+    if (local_port is None) != (remote_port is None):
+        raise click.BadParameter("Provide both a local_port and a remote_port")
+    if local_port is None and not forwards and socks is None:
+        raise click.UsageError("Nothing to forward, provide a local and remote port, --forward or --socks")
+    try:
+        forwards = [parse_forward_spec(spec) for spec in forwards]
+        socks = parse_socks_spec(socks) if socks is not None else None
+    except ValueError as e:
+        raise click.BadParameter(e.message)
+    create_tunnel(local_port, remote_port, slave, quiet, forwards, socks)
+
+
+def echo_stderr(line):
+    click.echo(line, err=True)
 
 
 @main.command()
 @click.argument('pig_script', nargs=1, type=click.Path())
 @click.argument('misc_files', nargs=-1, type=click.Path())
-def pig(pig_script, misc_files):
+@click.option('--log-file', type=click.Path(), help='Also append the output of the script to this file')
+def pig(pig_script, misc_files, log_file):
     """ Run a Pig script on the cluster. """
+    from utils.cluster import get_dns
+    from utils.ssh import MasterNodeSSHClient
     config = Config.load_default()
     client = MasterNodeSSHClient(get_dns(), username=config.ssh.username, ssh_key=config.ssh.key_path)
-    client.print_output(client.run_pig_script(pig_script, misc_files))
+    client.run_pig_script(pig_script, misc_files, on_stdout=click.echo, on_stderr=echo_stderr, log_file=log_file)
     client.close()
 
 
@@ -75,6 +188,8 @@ def pig(pig_script, misc_files):
 @click.option('--template', '-t', type=click.STRING, help='Template to use')
 def report(job, recipients, stdout, template):
     """ Generate and mail a report, optionally with attachments """
+    from jinja2 import TemplateNotFound
+    from broadcasting.mailing import mail_report, list_reports, ReportError
     if job == 'list':
         list_reports()
     else:
@@ -88,6 +203,83 @@ def report(job, recipients, stdout, template):
             raise click.BadParameter(e.message)
         except TemplateNotFound as e:
             raise click.BadParameter("Template '{}' cannot be found!".format(e.message))
+        except ReportError as e:
+            raise click.ClickException(e.message)
+
+
+@main.group()
+def scheduler():
+    """ Send the reports that have a schedule from this process, without Celery. """
+    pass
+
+
+@scheduler.command('run')
+@click.option('--workers', '-w', type=click.INT, help='Maximum number of reports to send at the same time')
+def scheduler_run(workers):
+    """ Send scheduled reports for as long as this command runs. """
+    import logging
+    import signal
+    from queries.pool import close_pool
+    from scheduling import enable_metrics, start_metrics_server
+    from scheduling.runner import CronScheduler, SchedulerState, load_jobs, run_reports
+    from scheduling.schedules import ScheduleRegistry, get_timezone
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    config = Config.load_default()
+    enable_metrics()
+    metrics_server = start_metrics_server()
+    registry = ScheduleRegistry(ConfigDir().sub('reports'), config.scheduling.coalesce_reports)
+    registry.refresh()
+    engine = CronScheduler(load_jobs(registry), run_reports, SchedulerState(), workers or config.scheduling.workers,
+                           config.scheduling.missed_run_grace, registry=registry,
+                           reload_interval=config.scheduling.reload_interval,
+                           coalesce=config.scheduling.coalesce_reports, timezone=get_timezone(config))
+    signal.signal(signal.SIGTERM, lambda signum, frame: engine.stop())
+    try:
+        engine.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_pool()
+        if metrics_server is not None:
+            metrics_server.stop()
+
+
+@scheduler.command('list')
+def scheduler_list():
+    """ Show the scheduled reports, with their last and next run. """
+    import time
+    from scheduling.runner import SchedulerState, from_timestamp, load_jobs
+    from scheduling.schedules import ScheduleRegistry, get_timezone
+    config = Config.load_default()
+    registry = ScheduleRegistry(ConfigDir().sub('reports'), config.scheduling.coalesce_reports)
+    registry.refresh()
+    state = SchedulerState()
+    timezone = get_timezone(config)
+    now = from_timestamp(time.time(), timezone)
+    click.echo('Times are in {}'.format(timezone.zone))
+    for job in load_jobs(registry):
+        entry = state.get(job.key)
+        last_run = '-'
+        if 'last_run' in entry:
+            last_run = from_timestamp(entry['last_run'], timezone).strftime('%Y-%m-%d %H:%M')
+        if 'last_status' in entry:
+            last_run += ' ({})'.format(entry['last_status'])
+        click.echo('{}: {}'.format(job.key, ', '.join(job.files)))
+        click.echo('  schedule {}, last run {}, next run {:%Y-%m-%d %H:%M}'.format(
+            ' '.join(job.schedule.fields), last_run, job.schedule.next_after(now)))
+    for filename, error in sorted(registry.errors.items()):
+        click.echo("{}: ignored, {}".format(filename, error), err=True)
+
+
+@scheduler.command('metrics')
+@click.option('--reset', is_flag=True, default=False, help='Start the metrics over from zero')
+def scheduler_metrics(reset):
+    """ Show the metrics of the scheduled reports, in the Prometheus text format. """
+    from scheduling import get_metrics, render_metrics
+    if reset:
+        get_metrics().reset()
+    else:
+        click.echo(render_metrics(), nl=False)
 
 
 @main.command()
@@ -96,24 +288,84 @@ def report(job, recipients, stdout, template):
 @click.option('--username', '-u', type=click.STRING, help='Slack user that broadcasts this query')
 @click.option('--icon', '-i', type=click.STRING, help='Icon for the resulting Slack message')
 @click.option('--title', '-t', type=click.STRING, help='Title for this query')
-def broadcast(sql, channel, username, icon, title):
-    data, headers = query_impala(sql)
-    slack.send_table(title, headers, data, username, channel, icon)
+@click.option('--max-rows', type=click.INT, help='Maximum number of rows to broadcast')
+def broadcast(sql, channel, username, icon, title, max_rows):
+    """ Broadcast the results of a query to Slack, as a table or, when there are many rows, as a CSV file. """
+    from broadcasting import slack
+    slack.broadcast_query(sql, title, username, channel, icon, max_rows)
+
+
+class CopyProgress(object):
+    """Shows the progress of distcp jobs on a single, continuously updated line."""
+
+    def __init__(self):
+        self.width = 0
+
+    def __call__(self, copies):
+        finished = sum(1 for c in copies if c.state in ('done', 'failed'))
+        running = ', '.join('{}: {}%'.format(c.src.rstrip('/').rsplit('/', 1)[-1], c.map_percent)
+                            for c in copies if c.state in ('starting', 'running', 'failing'))
+        line = '{}/{} copies finished{}'.format(finished, len(copies), ' - ' + running if running else '')
+        click.echo('\r' + line.ljust(self.width), nl=False, err=True)
+        self.width = len(line)
 
 
 @main.command()
-@click.argument('src', nargs=1, type=click.STRING)
-@click.argument('dst', nargs=1, type=click.STRING)
-def copy(src, dst):
+@click.argument('paths', nargs=-1, type=click.STRING)
+@click.option('--manifest', type=click.File(), help='File with a source per line, optionally followed by a destination')
+@click.option('--parallel', '-p', type=click.INT, default=1, help='Number of copies to run at the same time')
+@click.option('--maps', '-m', type=click.INT, help='Maximum number of simultaneous maps per copy')
+@click.option('--bandwidth', type=click.INT, help='Bandwidth per map in MB/s')
+@click.option('--log-file', type=click.Path(), help='Also append the output of distcp to this file')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='Show the output of distcp instead of the progress')
+def copy(paths, manifest, parallel, maps, bandwidth, log_file, verbose):
+    """
+    Copy files from and to HDFS and S3 with distcp. Usage: copy SRC... DST, or copy --manifest FILE [DST]
+    """
+    from utils.cluster import get_dns
+    from utils.distcp import parse_manifest, run_copies
+    from utils.ssh import MasterNodeSSHClient
+    if manifest:
+        if len(paths) > 1:
+            raise click.BadParameter("With --manifest, only a destination can be given")
+        try:
+            copies = parse_manifest(manifest, paths[0] if paths else None)
+        except ValueError as e:
+            raise click.BadParameter(e.message)
+    elif len(paths) < 2:
+        raise click.BadParameter("Provide one or more sources and a destination")
+    else:
+        copies = [(src, paths[-1]) for src in paths[:-1]]
+    if parallel < 1:
+        raise click.BadParameter("--parallel should be at least 1")
+
     config = Config.load_default()
     client = MasterNodeSSHClient(get_dns(), username=config.ssh.username, ssh_key=config.ssh.key_path)
-    client.print_output(client.dist_copy(src, dst))
-    client.fix_hdfs_permissions(dst)
+    if verbose:
+        def show_output(line):
+            click.echo(line, err=True)
+        client_output = {'on_line': show_output}
+    else:
+        client_output = {'on_progress': CopyProgress()}
+    jobs = run_copies(client, copies, parallel, maps, bandwidth, log_file=log_file, **client_output)
     client.close()
+    if not verbose:
+        click.echo(err=True)
+
+    failed = [job for job in jobs if job.state == 'failed']
+    for job in failed:
+        click.echo("Copying {} to {} failed:".format(job.src, job.dst), err=True)
+        click.echo(job.output[1] or job.output[0], err=True)
+    if failed:
+        raise click.ClickException("{} of the {} copies failed".format(len(failed), len(jobs)))
+    click.echo("Copied {} to {}".format(', '.join(job.src for job in jobs),
+                                        ', '.join(sorted(set(job.dst for job in jobs)))))
 
 
 @main.command()
 def init():
+    from click.exceptions import UsageError
+    from yaml import safe_dump
     config_dir = ConfigDir()
 
     def options(opt_list):
@@ -1,29 +1,127 @@
-from impala.dbapi import connect
-from athena.utils.cluster import get_dns
+import re
+from contextlib import contextmanager
+from athena.queries.cache import CachedCursor, RecordingCursor, cluster_identity, get_result_cache, resolve_ttl
+from athena.queries.pool import get_pool, PoolTimeout
+from athena.utils.cluster import get_dns, get_node_selector, invalidate_node
 from athena.utils.config import Config
-from athena.utils.file import write_csv
+from athena.utils.file import write_csv_batches, guess_output_format
+from athena.utils.profiling import count, span
 
+LIMITABLE_QUERY = re.compile(r'^(select|with)\b', re.IGNORECASE)
+ENDS_WITH_LIMIT = re.compile(r'\blimit\s+\d+(\s+offset\s+\d+)?$', re.IGNORECASE)
+# string literals, quoted identifiers, comments, and everything else; an unterminated quote or comment is one character
+SQL_TOKEN = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|--[^\n]*|/\*.*?\*/|;|\s+|[^'"`;\s/-]+|.""",
+                       re.DOTALL)
 
-def query_impala(sql, params=None, fetch_one=False):
+
+def query_impala(sql, params=None, fetch_one=False, host=None, cache_ttl=None):
     try:
-        cursor = query_impala_cursor(sql, params=params)
-        field_names = [i[0] for i in cursor.description]
-        if fetch_one:
-            result = cursor.fetchone()
-        else:
-            result = cursor.fetchall()
-        return result, field_names
+        with query_impala_cursor(sql, params=params, host=host, cache_ttl=cache_ttl) as cursor:
+            field_names = [i[0] for i in cursor.description]
+            if fetch_one:
+                result = cursor.fetchone()
+            else:
+                result = cursor.fetchall()
+            return result, field_names
     except Exception as e:
         print e
         return None
 
 
-def query_impala_cursor(sql, params=None):
+def limit_query(sql, limit):
+    """
+    Returns the query with a LIMIT clause, so Impala stops after `limit` rows rather than the client throwing away the
+    rest. Comments, semicolons and whitespace at the end of the query are left out. Queries that already end with a
+    LIMIT, statements other than SELECT, and anything that is not a single complete statement (like several statements,
+    or an unterminated string or comment) are returned unchanged.
+    """
+    start = end = None
+    terminated = False
+    for token in SQL_TOKEN.finditer(sql):
+        text = token.group()
+        if text in ("'", '"', '`') or text == '/' and sql.startswith('/*', token.start()):
+            return sql
+        if text == ';':
+            terminated = end is not None
+        elif not text.isspace() and not text.startswith(('--', '/*')):
+            if terminated:
+                return sql
+            start = token.start() if start is None else start
+            end = token.end()
+    if start is None or not LIMITABLE_QUERY.match(sql[start:end]) or ENDS_WITH_LIMIT.search(sql[start:end]):
+        return sql
+    return '{}\nLIMIT {}'.format(sql[:end], int(limit))
+
+
+@contextmanager
+def query_impala_cursor(sql, params=None, host=None, cache_ttl=None):
+    """
+    Executes the given SQL on a pooled connection to a slave node and yields the cursor. The cursor is closed and the
+    connection is returned to the pool when the block exits. When no host is given, the node selector picks one.
+
+    With a cache_ttl (by default the configured one, when the result cache is enabled) a cached result is served if
+    there is one, and otherwise the rows fetched from the cursor are cached for cache_ttl seconds, as long as the whole
+    result was fetched and is not larger than cache.max_entry_rows rows.
+    """
     config = Config.load_default()
-    conn = connect(host=get_dns(slave=True), port=config.cluster.impala_port)
-    cursor = conn.cursor()
-    cursor.execute(sql.encode('utf-8'), params)
-    return cursor
+    cache_ttl = resolve_ttl(cache_ttl)
+    if cache_ttl > 0:
+        cache = get_result_cache()
+        key = cache.key(sql, params, cluster_identity(config))
+        with span('query.cache_lookup'):
+            cached = cache.get(key)
+        if cached is not None:
+            yield CachedCursor(*cached)
+            return
+
+    with impala_connection(host) as (node, conn):
+        cursor = conn.cursor()
+        try:
+            with span('query.execute'):
+                cursor.execute(sql.encode('utf-8'), params)
+            if cache_ttl > 0:
+                recording = RecordingCursor(cursor, config.cache.max_entry_rows)
+                yield recording
+                if recording.complete:
+                    cache.put(key, cursor.description, recording.rows, cache_ttl)
+            else:
+                yield cursor
+        finally:
+            cursor.close()
+
+
+@contextmanager
+def impala_connection(host=None):
+    """
+    Yields a (node, connection) tuple with a pooled connection to the Impala daemon on the given host, or on the slave
+    node picked by the node selector. When connecting fails, the node is marked as down, its hostname is dropped from
+    the AWS node cache and another node is tried, up to cluster.connect_attempts nodes in total. The time it took to
+    connect, or to check the health of a pooled connection, is recorded as the latency of the node.
+    """
+    config = Config.load_default()
+    pool = get_pool()
+    node = host or get_dns(slave=True)
+    tried = []
+    while True:
+        try:
+            with span('impala.connect'):
+                pooled = pool.acquire(node, config.cluster.impala_port)
+            break
+        except PoolTimeout:
+            raise
+        except Exception:
+            tried.append(node)
+            get_node_selector().mark_down(node)
+            invalidate_node(node)
+            next_node = get_node_selector().select(exclude=tried)
+            if next_node is None or len(tried) >= config.cluster.connect_attempts:
+                raise
+            node = next_node
+    if pooled.latency is not None:
+        get_node_selector().record_latency(node, pooled.latency)
+    with get_node_selector().track(node):
+        with pool.using(pooled) as conn:
+            yield node, conn
 
 
 def get_date_range(days):
@@ -36,7 +134,40 @@ def get_date_range(days):
     return format_date(start_midnight), format_date(last_midnight)
 
 
-def query_to_csv(sql, csv_file):
-    c = query_impala_cursor(sql)
-    headers = [i[0] for i in c.description]
-    write_csv(csv_file, c, headers)
+def fetch_batches(cursor, batch_size=None):
+    """Yields the rows of an executed cursor in lists of at most batch_size rows (cluster.fetch_size by default)."""
+    batch_size = batch_size or Config.load_default().cluster.fetch_size
+    # arraysize also determines how many rows Impyla requests from Impala at once
+    cursor.arraysize = batch_size
+    while True:
+        with span('query.fetch'):
+            rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        count('query.rows', len(rows))
+        yield rows
+
+
+def query_to_csv(sql, csv_file, host=None, batch_size=None, progress=None, cache_ttl=None):
+    """
+    Streams the results of a query to a CSV file, which is compressed when its name ends with .gz or .zst. Rows are
+    fetched and written in batches of batch_size rows. Pass a Throughput as progress to keep track of the rows and
+    bytes written.
+    """
+    with query_impala_cursor(sql, host=host, cache_ttl=cache_ttl) as c:
+        headers = [i[0] for i in c.description]
+        write_csv_batches(csv_file, fetch_batches(c, batch_size), headers, progress)
+
+
+def query_to_file(sql, filename, output_format=None, host=None, batch_size=None, progress=None, cache_ttl=None):
+    """
+    Streams the results of a query to a csv, parquet or arrow file. When no output format is given, it is derived from
+    the extension of the filename.
+    """
+    output_format = output_format or guess_output_format(filename)
+    if output_format == 'csv':
+        return query_to_csv(sql, filename, host=host, batch_size=batch_size, progress=progress, cache_ttl=cache_ttl)
+
+    from athena.utils.columnar import write_columnar
+    with query_impala_cursor(sql, host=host, cache_ttl=cache_ttl) as c:
+        write_columnar(filename, c.description, fetch_batches(c, batch_size), output_format, progress)
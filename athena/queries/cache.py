@@ -0,0 +1,279 @@
+from __future__ import absolute_import
+
+import cPickle as pickle
+import hashlib
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from os.path import join as path_join
+
+from athena.utils.config import Config, ConfigDir
+from athena.utils.metrics import Counters
+
+# strings and quoted identifiers are kept as they are, comments are dropped, everything else is normalized
+_SQL_TOKENS = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|(--[^\n]*|/\*.*?\*/)|([^'"`\-/]+|.)""",
+                         re.DOTALL)
+
+
+def normalize_sql(sql):
+    """
+    Normalizes a SQL statement so that statements that only differ in comments, whitespace, letter case (outside of
+    string literals and quoted identifiers) or a trailing semicolon are considered the same.
+    """
+    parts = []
+    unquoted = []
+
+    def flush():
+        parts.append(re.sub(r'\s+', ' ', ''.join(unquoted)).lower())
+        del unquoted[:]
+
+    for quoted, comment, other in _SQL_TOKENS.findall(sql):
+        if quoted:
+            flush()
+            parts.append(quoted)
+        else:
+            unquoted.append(' ' if comment else other)
+    flush()
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def cluster_identity(config):
+    cluster = config.cluster
+    return '|'.join(str(value) for value in (cluster.type, getattr(cluster, 'master', None),
+                                             getattr(cluster, 'slaves', None), cluster.impala_port))
+
+
+class CachedCursor(object):
+    """Read-only stand-in for a DB-API cursor, serving rows from the result cache."""
+
+    def __init__(self, description, rows):
+        self.description = description
+        self.arraysize = 1
+        self._rows = rows
+        self._position = 0
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        pass
+
+
+class RecordingCursor(object):
+    """
+    Wraps a DB-API cursor and keeps a copy of the rows fetched through it, up to max_rows rows. `complete` tells
+    whether all rows of the result were fetched and recorded.
+    """
+
+    def __init__(self, cursor, max_rows):
+        self.cursor = cursor
+        self.max_rows = max_rows
+        self.rows = []
+        self.exhausted = False
+        self.overflow = False
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def arraysize(self):
+        return self.cursor.arraysize
+
+    @arraysize.setter
+    def arraysize(self, size):
+        self.cursor.arraysize = size
+
+    @property
+    def complete(self):
+        return self.exhausted and not self.overflow
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is None:
+            self.exhausted = True
+        else:
+            self._record([row])
+        return row
+
+    def fetchmany(self, size=None):
+        size = size or self.cursor.arraysize
+        rows = self.cursor.fetchmany(size)
+        if len(rows) < size:
+            self.exhausted = True
+        self._record(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.exhausted = True
+        self._record(rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def _record(self, rows):
+        if self.overflow:
+            return
+        if len(self.rows) + len(rows) > self.max_rows:
+            # too large to cache, so stop holding on to the rows
+            self.overflow = True
+            self.rows = []
+        else:
+            self.rows.extend(rows)
+
+
+class ResultCache(object):
+    """
+    On-disk cache of query results, stored in a directory with one file per result. A file starts with a fixed size
+    header holding a magic string, a format version and the creation and expiry times, followed by the zlib compressed
+    pickle of the cursor description and the rows. Results that were used least recently are evicted once the total
+    size of the cache exceeds max_size bytes. The hits, misses and evictions are counted over all processes that use
+    the cache.
+    """
+
+    MAGIC = 'ATHC'
+    VERSION = 1
+    HEADER = struct.Struct('>4sBdd')
+    EXTENSION = '.result'
+    STATS_FILE = 'stats.json'
+
+    def __init__(self, config_dir, max_size=256 * 1024 * 1024):
+        self.config_dir = config_dir
+        self.max_size = max_size
+        self._counters = Counters(config_dir, self.STATS_FILE)
+
+    @staticmethod
+    def key(sql, params=None, cluster=''):
+        h = hashlib.sha1()
+        h.update(cluster)
+        h.update('\0')
+        h.update(normalize_sql(sql).encode('utf-8'))
+        if params:
+            h.update('\0')
+            h.update(repr(sorted(params.items()) if isinstance(params, dict) else params))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns a (description, rows) tuple for the given key, or None if it is not cached or has expired."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                magic, version, created, expires = self.HEADER.unpack(f.read(self.HEADER.size))
+                if magic != self.MAGIC or version != self.VERSION or expires < time.time():
+                    self._count('misses')
+                    return None
+                description, rows = pickle.loads(zlib.decompress(f.read()))
+        except (IOError, OSError, struct.error, zlib.error, pickle.UnpicklingError, EOFError, ValueError):
+            self._count('misses')
+            return None
+        # the modification time of a file is its last use, which is what eviction goes by
+        os.utime(path, None)
+        self._count('hits')
+        return description, rows
+
+    def put(self, key, description, rows, ttl):
+        now = time.time()
+        payload = zlib.compress(pickle.dumps((list(description), list(rows)), pickle.HIGHEST_PROTOCOL))
+        path = self._path(key)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, now, now + ttl))
+            f.write(payload)
+        os.rename(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Removes expired results, and the least recently used ones while the cache is larger than max_size."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for path, size, last_used in sorted(entries, key=lambda e: e[2]):
+            if total <= self.max_size and not self._expired(path, now):
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                self._count('evictions')
+            except OSError:
+                pass
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._counters.reset()
+
+    def stats(self):
+        entries = self._entries()
+        stats = {'entries': len(entries), 'size': sum(size for _, size, _ in entries), 'max_size': self.max_size,
+                 'hits': 0, 'misses': 0, 'evictions': 0}
+        stats.update(self._counters.read())
+        return stats
+
+    def _path(self, key):
+        return path_join(self.config_dir.path, key + self.EXTENSION)
+
+    def _entries(self):
+        entries = []
+        for filename in os.listdir(self.config_dir.path):
+            if filename.endswith(self.EXTENSION):
+                path = path_join(self.config_dir.path, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def _expired(self, path, now):
+        try:
+            with open(path, 'rb') as f:
+                return self.HEADER.unpack(f.read(self.HEADER.size))[3] < now
+        except (IOError, struct.error):
+            return True
+
+    def _count(self, counter):
+        self._counters.increment(**{counter: 1})
+
+
+def get_result_cache():
+    config = Config.load_default()
+    return ResultCache(ConfigDir().sub('cache'), max_size=int(config.cache.max_size_mb * 1024 * 1024))
+
+
+def resolve_ttl(cache_ttl=None):
+    """Returns the TTL to cache a query with: the given one, or the configured default when caching is enabled."""
+    if cache_ttl is not None:
+        return cache_ttl
+    config = Config.load_default()
+    return config.cache.ttl if config.cache.enabled else 0
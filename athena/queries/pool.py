@@ -0,0 +1,209 @@
+from __future__ import absolute_import
+
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+from impala.dbapi import connect
+from athena.utils.config import Config
+from athena.utils.profiling import count
+
+
+class PoolTimeout(Exception):
+    def __init__(self, host, port):
+        super(PoolTimeout, self).__init__(
+            "Timed out waiting for a free Impala connection to {}:{}".format(host, port))
+
+
+class PooledConnection(object):
+    """
+    An open Impala connection together with the bookkeeping the pool needs. `latency` holds the seconds that opening
+    the connection or checking its health took, when the pool did either while handing it out, and None otherwise.
+    """
+
+    def __init__(self, key, conn, latency=None):
+        self.key = key
+        self.conn = conn
+        self.latency = latency
+        self.last_used = self.last_checked = time.time()
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of Impala connections, keyed by (host, port). At most `max_size` connections are open per key.
+    Idle connections are closed after `idle_timeout` seconds, and connections that have been idle for longer than
+    `health_check_interval` seconds are checked before they are handed out again.
+    """
+
+    def __init__(self, max_size=4, idle_timeout=300, health_check_interval=30, acquire_timeout=60,
+                 connect_fn=connect):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.closed = False
+        self._connect = connect_fn
+        self._idle = {}
+        self._open = {}
+        self._lock = threading.Condition()
+
+    def acquire(self, host, port):
+        key = (host, port)
+        deadline = time.time() + self.acquire_timeout
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("Connection pool is closed")
+            while True:
+                self._evict_idle()
+                idle = self._idle.get(key)
+                if idle:
+                    pooled = idle.pop()
+                    break
+                if self._open.get(key, 0) < self.max_size:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    pooled = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout(host, port)
+                self._lock.wait(remaining)
+
+        if pooled is not None:
+            pooled.latency = None
+            if self._is_healthy(pooled):
+                count('impala.connections_reused')
+                return pooled
+            # keep the slot, but replace the dead connection with a fresh one
+            pooled.close()
+        try:
+            started = time.time()
+            conn = self._connect(host=host, port=port)
+            pooled = PooledConnection(key, conn, time.time() - started)
+            count('impala.connections_opened')
+            return pooled
+        except Exception:
+            self._forget(key)
+            raise
+
+    def release(self, pooled, check=False):
+        if check and not self._is_healthy(pooled, force=True):
+            return self.discard(pooled)
+        with self._lock:
+            if self.closed:
+                pooled.close()
+                self._decrement(pooled.key)
+            else:
+                pooled.last_used = time.time()
+                self._idle.setdefault(pooled.key, []).append(pooled)
+                self._evict_idle()
+            self._lock.notify_all()
+
+    def discard(self, pooled):
+        pooled.close()
+        self._forget(pooled.key)
+
+    @contextmanager
+    def connection(self, host, port):
+        with self.using(self.acquire(host, port)) as conn:
+            yield conn
+
+    @contextmanager
+    def using(self, pooled):
+        """Yields the connection of an acquired PooledConnection, and releases it to the pool afterwards."""
+        try:
+            yield pooled.conn
+        except Exception:
+            # the error might have been caused by a broken connection, so verify it before putting it back
+            self.release(pooled, check=True)
+            raise
+        else:
+            self.release(pooled)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            for key, idle in self._idle.items():
+                for pooled in idle:
+                    pooled.close()
+                    self._decrement(key)
+            self._idle = {}
+            self._lock.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return dict((key, {'open': self._open.get(key, 0), 'idle': len(self._idle.get(key, []))})
+                        for key in self._open)
+
+    def _is_healthy(self, pooled, force=False):
+        now = time.time()
+        if not force and now - pooled.last_checked < self.health_check_interval:
+            return True
+        try:
+            cursor = pooled.conn.cursor()
+            try:
+                cursor.ping()
+            finally:
+                cursor.close()
+        except Exception:
+            return False
+        pooled.last_checked = time.time()
+        pooled.latency = pooled.last_checked - now
+        return True
+
+    def _evict_idle(self):
+        """Closes connections that have been idle for too long. Must be called with the lock held."""
+        cutoff = time.time() - self.idle_timeout
+        for key, idle in self._idle.items():
+            expired = [p for p in idle if p.last_used < cutoff]
+            if expired:
+                self._idle[key] = [p for p in idle if p.last_used >= cutoff]
+                for pooled in expired:
+                    pooled.close()
+                    self._decrement(key)
+
+    def _forget(self, key):
+        with self._lock:
+            self._decrement(key)
+            self._lock.notify_all()
+
+    def _decrement(self, key):
+        self._open[key] = max(self._open.get(key, 0) - 1, 0)
+        if not self._open[key]:
+            del self._open[key]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the process-wide connection pool, creating it from the configuration when needed."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            config = Config.load_default()
+            _pool = ConnectionPool(
+                max_size=config.cluster.pool_size,
+                idle_timeout=config.cluster.pool_idle_timeout,
+                health_check_interval=config.cluster.pool_health_check_interval
+            )
+        return _pool
+
+
+def close_pool():
+    """Closes all pooled connections. The next call to get_pool() creates a new pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+atexit.register(close_pool)
@@ -1,35 +1,76 @@
 import os
+import traceback
 
-from tabulate import tabulate
 import yaml
 
-from athena.queries import query_impala
-from athena.queries import query_to_csv
+from athena.queries import query_to_file
+from athena.queries.render import stream_query
+from athena.utils import imap_bounded
+from athena.utils.file import OUTPUT_FORMATS
 
 
-def execute_query(sql, csv_file=None):
-    if not csv_file:
-        results, field_names = query_impala(sql)
-        return tabulate(results, headers=field_names, tablefmt="simple", numalign='left')
+def execute_query(sql, output_file=None, host=None, batch_size=None, progress=None, output_format=None,
+                  cache_ttl=None):
+    if not output_file:
+        lines = []
+        stream_query(sql, lines.append, host=host, page_size=batch_size, cache_ttl=cache_ttl)
+        return '\n'.join(lines)
     else:
-        query_to_csv(sql, csv_file=csv_file)
-        return "The results have succesfully been written to '{}'".format(os.path.basename(csv_file))
+        query_to_file(sql, output_file, output_format=output_format, host=host, batch_size=batch_size,
+                      progress=progress, cache_ttl=cache_ttl)
+        return "The results have succesfully been written to '{}'".format(os.path.basename(output_file))
 
 
-def parse_yaml_queries(yaml_file):
-    queries = yaml.load(yaml_file)
+def expand_yaml_queries(queries, cache_ttl=None):
+    """
+    Turns the entries of a batch file into a flat list of jobs: dicts with the sql, output file, output format,
+    cache TTL and description of every query. The given cache_ttl is used for entries without a cache_ttl of their own.
+    """
+    expanded = []
     for query in queries:
 
         items = query.get("with_items")
         sql = query.get('query')
         filename = query.get('output')
+        output_format = query.get('output_format')
+        if output_format and output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output_format '{}', should be one of: {}".format(
+                output_format, ', '.join(OUTPUT_FORMATS)))
+        job = {'output_format': output_format, 'cache_ttl': query.get('cache_ttl', cache_ttl)}
 
         if items is None:
-            print("\n- Executing query '{}'\n".format(sql))
-            print(execute_query(sql, filename))
+            expanded.append(dict(job, sql=sql, output=filename,
+                                 description="\n- Executing query '{}'\n".format(sql)))
         else:
             for item in items:
                 sql_instance = sql.replace("{{ item }}", item)
-                filename_instance = filename.replace("{{ item }}", item)
-                print("\n- Executing query '{}' with parameters '{}'\n".format(sql_instance, filename_instance))
-                print(execute_query(sql_instance, filename_instance))
+                filename_instance = filename.replace("{{ item }}", item) if filename else None
+                expanded.append(dict(job, sql=sql_instance, output=filename_instance,
+                                     description="\n- Executing query '{}' with parameters '{}'\n".format(
+                                         sql_instance, filename_instance)))
+    return expanded
+
+
+def parse_yaml_queries(yaml_file, parallel=1, cache_ttl=None):
+    """
+    Runs all queries in the given batch file, at most `parallel` at a time, and prints their results in the order in
+    which they appear in the file. A failing query is reported, but does not stop the remaining queries. Returns a
+    list of (sql, error message) tuples for the queries that failed.
+    """
+    jobs = expand_yaml_queries(yaml.load(yaml_file), cache_ttl)
+
+    def run(job):
+        # the node selector spreads queries that run at the same time over the slave nodes
+        return execute_query(job['sql'], job['output'], output_format=job['output_format'],
+                             cache_ttl=job['cache_ttl'])
+
+    failures = []
+    for job, (output, error) in zip(jobs, imap_bounded(run, jobs, parallel)):
+        print(job['description'])
+        if error is None:
+            print(output)
+        else:
+            message = ''.join(traceback.format_exception_only(*error[:2])).strip()
+            print("Query failed: {}".format(message))
+            failures.append((job['sql'], message))
+    return failures
@@ -0,0 +1,81 @@
+from itertools import chain
+
+from athena.queries import query_impala_cursor, fetch_batches
+
+SAMPLE_ROWS = 100
+MAX_COLUMN_WIDTH = 60
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    elif isinstance(value, basestring):
+        return value
+    else:
+        return str(value)
+
+
+class TableFormat(object):
+    """
+    Formats rows as a plain text table in the style of tabulate's 'simple' format. Column widths are determined once,
+    from the headers and a sample of rows, so rows can be formatted one at a time. A longer value in a later row is
+    written in full, pushing the rest of its row to the right, unless it is longer than MAX_COLUMN_WIDTH, in which case
+    it is cut off.
+    """
+
+    def __init__(self, headers, sample_rows):
+        widths = [len(format_value(header)) for header in headers]
+        for row in sample_rows:
+            for i, value in enumerate(row):
+                widths[i] = max(widths[i], len(format_value(value)))
+        self.headers = headers
+        self.widths = [min(width, MAX_COLUMN_WIDTH) for width in widths]
+
+    def header_lines(self):
+        return [self.format_row(self.headers), '  '.join('-' * width for width in self.widths)]
+
+    def format_row(self, row):
+        cells = []
+        for value, width in zip(row, self.widths):
+            text = format_value(value)
+            if len(text) > MAX_COLUMN_WIDTH:
+                text = text[:MAX_COLUMN_WIDTH - 2] + '..'
+            cells.append(text.ljust(width))
+        return '  '.join(cells).rstrip()
+
+
+def render_table(headers, batches, write, max_rows=None, page_size=None, more=None):
+    """
+    Writes the rows from the given batches as a table, line by line, using the first batch to determine the column
+    widths. Only one batch is held in memory at a time. Stops after max_rows rows, and when `more` is given, it is
+    called after every full page of page_size rows and rendering stops as soon as it returns False. Returns the number
+    of rows written.
+    """
+    batches = iter(batches)
+    first = next(batches, [])
+    table = TableFormat(headers, first[:SAMPLE_ROWS])
+    for line in table.header_lines():
+        write(line)
+
+    written = 0
+    for batch in chain([first], batches):
+        for row in batch:
+            if max_rows is not None and written >= max_rows:
+                write("... (output limited to {} rows)".format(max_rows))
+                return written
+            write(table.format_row(row))
+            written += 1
+        if more is not None and len(batch) == page_size and not more():
+            break
+    return written
+
+
+def stream_query(sql, write, max_rows=None, page_size=None, more=None, host=None, cache_ttl=None):
+    """
+    Runs a query and writes its results as a table while they are being fetched, page by page. See render_table.
+    """
+    if max_rows is not None:
+        page_size = min(page_size or max_rows, max_rows) or 1
+    with query_impala_cursor(sql, host=host, cache_ttl=cache_ttl) as cursor:
+        headers = [i[0] for i in cursor.description]
+        return render_table(headers, fetch_batches(cursor, page_size), write, max_rows, page_size, more)
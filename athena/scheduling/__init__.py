@@ -0,0 +1,109 @@
+import logging
+import time
+from contextlib import contextmanager
+from os.path import expanduser
+
+from athena.broadcasting.mailing import ReportError
+from athena.utils.config import Config, ConfigDir
+from athena.utils.metrics import Counters, MetricsServer, format_prometheus, histogram, write_textfile
+from athena.utils.profiling import enable_profiling, get_profiler
+
+METRICS_FILE = 'scheduler_metrics.json'
+METRICS_PREFIX = 'athena_scheduler_'
+# upper bounds, in seconds, of the histogram buckets for the stages of a job (like a query or sending a mail) and for
+# whole jobs
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def get_metrics():
+    """Returns the counters of the reports sent by the scheduler, shared by all workers using this config directory."""
+    return Counters(ConfigDir(), METRICS_FILE)
+
+
+def record_stats(stats, logger=logging.getLogger(__name__)):
+    """Adds the stats returned by mail_reports to the scheduler metrics, and raises a ReportError for any failures."""
+    get_metrics().increment(reports=stats['reports'], reports_failed=len(stats['failures']),
+                            queries=stats['queries'], query_executions=stats['executions'],
+                            query_executions_saved=stats['executions_saved'])
+    logger.info("Sent %d reports with %d queries in %d executions, saving %d",
+                stats['reports'] - len(stats['failures']), stats['queries'], stats['executions'],
+                stats['executions_saved'])
+    if stats['failures']:
+        raise ReportError('; '.join(stats['failures']))
+
+
+def render_metrics():
+    """Returns the scheduler metrics in the Prometheus text format."""
+    return format_prometheus(get_metrics().read(), METRICS_PREFIX)
+
+
+def enable_metrics():
+    """
+    Starts collecting the times of the stages of jobs (like queries and sending mails) and counts like the rows fetched
+    in this process, when scheduling.metrics is enabled. Returns whether it is.
+    """
+    if not Config.load_default().scheduling.metrics:
+        return False
+    enable_profiling(STAGE_BUCKETS)
+    return True
+
+
+def flush_metrics(job_seconds=None, failed=False, logger=logging.getLogger(__name__)):
+    """
+    Moves the stage times and counts collected in this process since the previous flush into the scheduler metrics,
+    along with the duration and outcome of a job when job_seconds is given, and rewrites the metrics textfile. Does
+    nothing unless enable_metrics() enabled the metrics.
+    """
+    profiler = get_profiler()
+    if profiler is None or not profiler.buckets:
+        return
+    stages, counts = profiler.drain()
+    counters = dict((name.replace('.', '_'), amount) for name, amount in counts.items())
+    histograms = dict(('stage_seconds{{stage="{}"}}'.format(name),
+                       {'buckets': profiler.buckets, 'counts': stage['bucket_counts'], 'sum': stage['total_seconds'],
+                        'count': stage['calls']})
+                      for name, stage in stages.items())
+    if job_seconds is not None:
+        counters.update(jobs=1, jobs_failed=int(failed))
+        histograms['job_seconds'] = histogram(JOB_BUCKETS, job_seconds)
+    try:
+        get_metrics().update(counters, histograms)
+        textfile = Config.load_default().scheduling.metrics_textfile
+        if textfile:
+            write_textfile(expanduser(textfile), render_metrics())
+    except Exception as e:
+        # the metrics should never make a job fail
+        logger.warning("Could not update the scheduler metrics: %s", e)
+
+
+@contextmanager
+def job_metrics(start=None):
+    """
+    Adds the duration and outcome of the job in the block to the scheduler metrics, see flush_metrics(). The duration
+    counts from start (a timestamp) when given, for jobs that started in another task.
+    """
+    start = start or time.time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        flush_metrics(time.time() - start, failed)
+
+
+def start_metrics_server(logger=logging.getLogger(__name__)):
+    """
+    Starts serving the scheduler metrics over HTTP at /metrics, when scheduling.metrics_port is set. Returns the
+    MetricsServer, or None.
+    """
+    port = Config.load_default().scheduling.metrics_port
+    if not port:
+        return None
+    try:
+        server = MetricsServer(render_metrics, port).start()
+    except IOError as e:
+        logger.error("Could not serve the scheduler metrics on port %s: %s", port, e)
+        return None
+    logger.info("Serving the scheduler metrics at http://localhost:%s/metrics", server.port)
+    return server
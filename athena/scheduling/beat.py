@@ -0,0 +1,37 @@
+import time
+
+from celery.beat import PersistentScheduler
+from celery.utils.log import get_logger
+from athena.scheduling.celeryconfig import beat_schedule
+from athena.scheduling.schedules import ScheduleRegistry
+from athena.utils.config import Config, ConfigDir
+
+logger = get_logger(__name__)
+
+
+class ReloadingScheduler(PersistentScheduler):
+    """
+    Celery beat scheduler that checks the reports directory every `reload_interval` seconds, and applies added, changed
+    and removed report schedules without a restart.
+    """
+
+    def __init__(self, *args, **kwargs):
+        config = Config.load_default()
+        self.registry = ScheduleRegistry(ConfigDir().sub('reports'), config.scheduling.coalesce_reports)
+        self.reload_interval = config.scheduling.reload_interval
+        self._next_reload = 0
+        super(ReloadingScheduler, self).__init__(*args, **kwargs)
+
+    def reload(self):
+        if self.registry.refresh():
+            self.merge_inplace(beat_schedule(self.registry.schedules()))
+            # merging drops the entries celery adds itself, like the cleanup of results
+            self.install_default_entries(self.schedule)
+            self.sync()
+            logger.info("Reloaded the schedules of the reports: %s", ', '.join(sorted(self.schedule)))
+
+    def tick(self):
+        if time.time() >= self._next_reload:
+            self._next_reload = time.time() + self.reload_interval
+            self.reload()
+        return min(super(ReloadingScheduler, self).tick(), max(self._next_reload - time.time(), 0))
@@ -0,0 +1,250 @@
+import calendar
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from Queue import Queue
+
+from athena.broadcasting.mailing import mail_reports
+from athena.scheduling import job_metrics, record_stats
+from athena.scheduling.schedules import CronSchedule
+from athena.utils.config import ConfigDir
+
+STATE_FILE = 'scheduler_state.json'
+# the longest the loop sleeps, so it notices soon enough when the clock jumps, e.g. after a suspend
+MAX_SLEEP = 60
+
+logger = logging.getLogger(__name__)
+
+
+def to_timestamp(dt, timezone=None):
+    """Returns the timestamp of a naive datetime in the given (pytz) timezone, or in local time without one."""
+    if timezone is None:
+        return time.mktime(dt.timetuple())
+    return calendar.timegm(timezone.localize(dt).utctimetuple())
+
+
+def from_timestamp(timestamp, timezone=None):
+    """Returns a timestamp as naive datetime in the given (pytz) timezone, or in local time without one."""
+    if timezone is None:
+        return datetime.fromtimestamp(timestamp)
+    return datetime.fromtimestamp(timestamp, timezone).replace(tzinfo=None)
+
+
+class ScheduledJob(object):
+    """Reports that are sent on the same schedule, and when they run next (as timestamp)."""
+
+    def __init__(self, key, schedule, files):
+        self.key = key
+        self.schedule = schedule
+        self.files = files
+        self.next_run = None
+        self.running = False
+
+    def __repr__(self):
+        return '<scheduled-job {}: {!r}>'.format(self.key, self.schedule)
+
+
+def load_jobs(registry):
+    """Returns a ScheduledJob for every schedule in the given ScheduleRegistry."""
+    return [ScheduledJob(key, CronSchedule(**schedule['fields']), schedule['files'])
+            for key, schedule in registry.schedules().items()]
+
+
+class SchedulerState(object):
+    """The last run and its outcome for every job, persisted as JSON in the config directory."""
+
+    def __init__(self, config_dir=None, filename=STATE_FILE):
+        self.config_dir = config_dir or ConfigDir()
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            self._entries = json.loads(self.config_dir.read(filename) or '{}')
+        except ValueError:
+            self._entries = {}
+
+    def get(self, key):
+        return dict(self._entries.get(key, {}))
+
+    def last_run(self, key):
+        return self._entries.get(key, {}).get('last_run')
+
+    def update(self, key, **values):
+        with self._lock:
+            self._entries.setdefault(key, {}).update(values)
+            self.config_dir.write(self.filename, json.dumps(self._entries, indent=2, sort_keys=True))
+
+
+class CronScheduler(object):
+    """
+    Runs scheduled jobs in this process. A loop wakes up when the next job is due, and hands it to a pool of `workers`
+    threads that call run_job with the files of the job. A job that is still running when it is due again skips that
+    run. When the state shows that a job missed a run while the scheduler was not running, it runs once right away if
+    that run was due at most `missed_run_grace` seconds ago, no matter how many runs it missed. With a registry, the
+    jobs are updated every `reload_interval` seconds with the changes to the report files. With coalesce, jobs that are
+    due at the same time run together, in a single call of run_job with the files of all of them, even when their
+    schedules are written differently, so the queries they have in common run only once. Schedules are evaluated in
+    `timezone` (a pytz timezone), or in the local time of the machine without one.
+    """
+
+    def __init__(self, jobs, run_job, state, workers=2, missed_run_grace=86400, clock=time.time, registry=None,
+                 reload_interval=30, coalesce=True, timezone=None):
+        self.jobs = OrderedDict((job.key, job) for job in jobs)
+        self.run_job = run_job
+        self.state = state
+        self.workers = max(workers, 1)
+        self.missed_run_grace = missed_run_grace
+        self.clock = clock
+        self.registry = registry
+        self.reload_interval = reload_interval
+        self.coalesce = coalesce
+        self.timezone = timezone
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        now = self.clock()
+        for job in self.jobs.values():
+            self._plan(job, now)
+            logger.info("%s runs next at %s", job.key, self._local(job.next_run))
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _plan(self, job, now):
+        last_run = self.state.last_run(job.key)
+        if last_run is not None:
+            missed = job.schedule.next_after(self._local(last_run))
+            if to_timestamp(missed, self.timezone) <= now:
+                if now - to_timestamp(missed, self.timezone) <= self.missed_run_grace:
+                    logger.warning("%s missed its run at %s, running it now", job.key, missed)
+                    job.next_run = now
+                    return
+                logger.warning("%s missed its run at %s, too long ago to run it now", job.key, missed)
+        job.next_run = self._next_run(job.schedule, now)
+
+    def _local(self, timestamp):
+        return from_timestamp(timestamp, self.timezone)
+
+    def _next_run(self, schedule, now):
+        return to_timestamp(schedule.next_after(self._local(now)), self.timezone)
+
+    def reload(self):
+        """Updates the jobs when the schedules in the registry changed."""
+        if self.registry is not None and self.registry.refresh():
+            self.update_jobs(load_jobs(self.registry))
+
+    def update_jobs(self, jobs):
+        """
+        Replaces the jobs with the given ones. Jobs that are already known keep their state, and keep their next run
+        when their schedule did not change.
+        """
+        now = self.clock()
+        updated = OrderedDict()
+        for job in jobs:
+            current = self.jobs.get(job.key)
+            if current is None:
+                self._plan(job, now)
+                logger.info("Added %s, which runs next at %s", job.key, self._local(job.next_run))
+                current = job
+            elif current.schedule.fields != job.schedule.fields or current.files != job.files:
+                current.schedule = job.schedule
+                current.files = job.files
+                current.next_run = self._next_run(job.schedule, now)
+                logger.info("Updated %s, which runs next at %s", job.key, self._local(current.next_run))
+            updated[job.key] = current
+        for key in set(self.jobs) - set(updated):
+            logger.info("Removed %s", key)
+        self.jobs = updated
+
+    def tick(self):
+        """Hands the jobs that are due to the workers, and returns the number of seconds until the next one is due."""
+        now = self.clock()
+        due = []
+        for job in self.jobs.values():
+            if job.next_run <= now:
+                due.append((job, job.next_run))
+                job.next_run = self._next_run(job.schedule, now)
+        if self.coalesce:
+            self._dispatch(due)
+        else:
+            for run in due:
+                self._dispatch([run])
+        if not self.jobs:
+            return MAX_SLEEP
+        return max(min(job.next_run for job in self.jobs.values()) - self.clock(), 0)
+
+    def _dispatch(self, due):
+        """Hands the given (job, scheduled time) pairs to the workers as a single run, leaving out running jobs."""
+        jobs = []
+        with self._lock:
+            for job, scheduled in due:
+                if job.running:
+                    logger.warning("%s is still running, skipping its run at %s", job.key,
+                                   self._local(scheduled))
+                    continue
+                job.running = True
+                jobs.append((job, scheduled))
+        if not jobs:
+            return
+        # the run is recorded before it starts, so a report is not sent twice when the scheduler stops halfway
+        for job, scheduled in jobs:
+            self.state.update(job.key, last_run=scheduled)
+        self._queue.put([job for job, _ in jobs])
+
+    def _work(self):
+        while True:
+            jobs = self._queue.get()
+            if jobs is None:
+                return
+            start = self.clock()
+            keys = ', '.join(job.key for job in jobs)
+            logger.info("Running %s", keys)
+            try:
+                self.run_job([filename for job in jobs for filename in job.files])
+                status = 'ok'
+            except Exception as e:
+                logger.error("%s failed: %s", keys, e)
+                status = 'failed'
+            finally:
+                with self._lock:
+                    for job in jobs:
+                        job.running = False
+            for job in jobs:
+                self.state.update(job.key, last_status=status, last_duration=round(self.clock() - start, 1))
+
+    def serve_forever(self):
+        """Runs the jobs until stop() is called, and then waits for the jobs that are still running."""
+        self.start()
+        next_reload = time.time() + self.reload_interval
+        try:
+            while not self._stopped.is_set():
+                if time.time() >= next_reload:
+                    self.reload()
+                    next_reload = time.time() + self.reload_interval
+                self._stopped.wait(min(self.tick(), MAX_SLEEP, max(next_reload - time.time(), 0)))
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self._stopped.set()
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            while thread.is_alive():
+                # joining with a timeout keeps the main thread responsive to KeyboardInterrupt
+                thread.join(0.1)
+        self._threads = []
+
+
+def run_reports(files):
+    with job_metrics():
+        record_stats(mail_reports(files), logger)
@@ -1,10 +1,112 @@
-from celery import Celery
-from athena.broadcasting.mailing import mail_report
+import sys
+import time
+from os.path import dirname
+
+from celery import Celery, chord
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
+from celery.utils.log import get_task_logger
+from athena.broadcasting.mailing import (mail_reports, prepare_reports, send_reports, unique_queries, run_report_query,
+                                         run_report_queries, describe_error)
+from athena.queries.pool import close_pool
+from athena.scheduling import enable_metrics, flush_metrics, job_metrics, record_stats, start_metrics_server
+from athena.utils.config import Config
+from athena.utils.file import mkdir_p
+from athena.utils.ssh import close_ssh_connections
 
 celery_app = Celery()
 celery_app.config_from_object('athena.scheduling.celeryconfig')
+logger = get_task_logger(__name__)
+
+
+@worker_init.connect
+def serve_metrics(**kwargs):
+    enable_metrics()
+    start_metrics_server()
+
+
+@worker_process_init.connect
+def collect_metrics(**kwargs):
+    # every pool process collects its own metrics, so it does not carry along what the parent collected before forking
+    enable_metrics()
+
+
+@worker_process_shutdown.connect
+def close_connections(**kwargs):
+    close_pool()
+    close_ssh_connections()
 
 
 @celery_app.task
 def process_job(name):
-    mail_report(name)
+    process_jobs([name])
+
+
+@celery_app.task
+def process_jobs(names):
+    """
+    Sends reports that are due at the same time, running the queries they have in common only once. With fan_out
+    enabled, every inline query runs in a task of its own, so the queries are spread over all workers, and the reports
+    are assembled and mailed by a chord callback when they have all finished. The csv queries run in the chord callback,
+    which streams their results into the attachments, rather than passing whole files through the result backend.
+    """
+    if Config.load_default().scheduling.fan_out:
+        try:
+            return fan_out_jobs(names)
+        finally:
+            flush_metrics()
+    with job_metrics():
+        record_stats(mail_reports(names), logger)
+
+
+def fan_out_jobs(names):
+    reports, failures = prepare_reports(names)
+    queries = [query for _, _, report in reports for query in report if query['kind'] != 'csv']
+    unique, indices = unique_queries(queries)
+    callback = assemble_reports.s(reports, indices, failures, len(names), time.time())
+    if not unique:
+        return callback.delay([])
+    return chord(run_query.s(query) for query in unique)(callback)
+
+
+@celery_app.task(bind=True)
+def run_query(self, query):
+    """
+    Runs a single inline report query, and returns a (result, error) tuple. A query that fails is retried, and when it
+    keeps failing the error message is returned rather than raised, so the other queries of the report still count.
+    """
+    scheduling = Config.load_default().scheduling
+    try:
+        return run_report_query(query), None
+    except Exception as e:
+        if self.request.retries < scheduling.query_retries:
+            raise self.retry(exc=e, countdown=scheduling.query_retry_delay, max_retries=scheduling.query_retries)
+        return None, describe_error(sys.exc_info())
+    finally:
+        flush_metrics()
+
+
+@celery_app.task
+def assemble_reports(outcomes, reports, indices, failures, total, started=None):
+    """
+    Chord callback of fan_out_jobs: runs the csv queries of the reports and sends the reports, given the outcome of
+    every distinct inline query, and the index of the outcome for each of the inline queries of the reports. The
+    duration of the job in the metrics counts from started, when the job was fanned out.
+    """
+    with job_metrics(started):
+        _assemble_reports(outcomes, reports, indices, failures, total)
+
+
+def _assemble_reports(outcomes, reports, indices, failures, total):
+    queries = [query for _, _, report in reports for query in report]
+    csv_queries = [query for query in queries if query['kind'] == 'csv']
+    # the reports were loaded by another worker, which may have run on another machine
+    for query in csv_queries:
+        mkdir_p(dirname(query['path']))
+    csv_results, csv_executions = run_report_queries(csv_queries, Config.load_default().mailing.query_concurrency)
+    csv_results = iter(csv_results)
+    inline_results = iter([outcomes[index] for index in indices])
+    results = [next(csv_results) if query['kind'] == 'csv' else next(inline_results) for query in queries]
+    failures = failures + send_reports(reports, results)
+    executions = len(outcomes) + csv_executions
+    record_stats({'reports': total, 'queries': len(queries), 'executions': executions,
+                  'executions_saved': len(queries) - executions, 'failures': failures}, logger)
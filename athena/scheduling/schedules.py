@@ -0,0 +1,185 @@
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from os import listdir, stat
+from os.path import join as path_join
+from stat import S_ISREG
+
+import pytz
+from slugify import slugify
+import yaml
+
+CRONTAB_FIELDS = ('minute', 'hour', 'day_of_week', 'day_of_month', 'month_of_year')
+DAY_NAMES = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cron_field(value, minimum, maximum, names=()):
+    """
+    Returns the set of numbers matched by a crontab field, like 5, '*', '*/15', '1,15', '10-17', '1-9/2' or, with names,
+    'mon-fri'. Raises a ValueError when the field is invalid.
+    """
+    def number(part):
+        part = part.strip().lower()
+        if part[:3] in names:
+            return names.index(part[:3]) + minimum
+        n = int(part)
+        if not minimum <= n <= maximum:
+            raise ValueError("{} is not between {} and {}".format(n, minimum, maximum))
+        return n
+
+    numbers = set()
+    for part in str(value).split(','):
+        part, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if step < 1:
+            raise ValueError("Invalid step in '{}'".format(value))
+        if part.strip() == '*':
+            start, end = minimum, maximum
+        elif '-' in part:
+            start, end = [number(p) for p in part.split('-', 1)]
+        else:
+            start = number(part)
+            end = maximum if step > 1 else start
+        if end < start:
+            raise ValueError("Invalid range in '{}'".format(value))
+        numbers.update(range(start, end + 1, step))
+    return numbers
+
+
+def get_timezone(config):
+    """
+    Returns the pytz timezone in which crontab schedules are evaluated: scheduling.celery_timezone, or UTC when it is
+    not set, the same as Celery beat, so a schedule fires at the same time with or without Celery.
+    """
+    return pytz.timezone(config.scheduling.celery_timezone or 'UTC')
+
+
+class CronSchedule(object):
+    """
+    A crontab schedule with the same fields and meaning as Celery's crontab: days of the week start at 0 for Sunday,
+    and a time has to match all fields, including both day_of_week and day_of_month.
+    """
+
+    def __init__(self, minute='*', hour='*', day_of_week='*', day_of_month='*', month_of_year='*'):
+        self.fields = (minute, hour, day_of_week, day_of_month, month_of_year)
+        self.minutes = parse_cron_field(minute, 0, 59)
+        self.hours = parse_cron_field(hour, 0, 23)
+        self.days_of_week = parse_cron_field(day_of_week, 0, 6, DAY_NAMES)
+        self.days_of_month = parse_cron_field(day_of_month, 1, 31)
+        self.months = parse_cron_field(month_of_year, 1, 12)
+
+    def __repr__(self):
+        return '<crontab: {}>'.format(' '.join(str(f) for f in self.fields))
+
+    def matches_day(self, dt):
+        return (dt.month in self.months and dt.day in self.days_of_month and
+                (dt.weekday() + 1) % 7 in self.days_of_week)
+
+    def next_after(self, dt):
+        """Returns the first time (as naive datetime, at a whole minute) after dt that matches the schedule."""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # a schedule can only match on the 29th of February, so it takes at most 8 years to find its next time
+        limit = dt + timedelta(days=8 * 366)
+        while dt < limit:
+            if not self.matches_day(dt):
+                dt = datetime(dt.year, dt.month, dt.day) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError("{!r} never matches".format(self))
+
+
+class ScheduleRegistry(object):
+    """
+    The schedules of the reports in a directory, indexed by file. refresh() only parses the files that were added or
+    changed (by modification time and size) since the previous refresh. A file that cannot be parsed, or that has an
+    invalid schedule, is left out and its error kept in `errors`, so it does not affect the other reports.
+    """
+
+    def __init__(self, jobs_config_dir, coalesce=True):
+        self.jobs_config_dir = jobs_config_dir
+        self.coalesce = coalesce
+        self.errors = {}
+        self._index = {}
+        self._schedules = None
+
+    def refresh(self):
+        """Brings the registry up to date with the directory. Returns whether any schedule was added or changed."""
+        jobs_path = self.jobs_config_dir.path
+        index = {}
+        changed = False
+        for filename in listdir(jobs_path):
+            if not filename.endswith('.yml'):
+                continue
+            try:
+                st = stat(path_join(jobs_path, filename))
+            except OSError:
+                continue
+            if not S_ISREG(st.st_mode):
+                continue
+            version = (st.st_mtime, st.st_size)
+            previous = self._index.get(filename)
+            if previous is not None and previous[0] == version:
+                index[filename] = previous
+                continue
+            index[filename] = (version, self._parse(filename))
+            changed = changed or index[filename][1] != (previous[1] if previous else None)
+        changed = changed or any(self._index[f][1] is not None for f in set(self._index) - set(index))
+        self._index = index
+        self.errors = dict((f, e) for f, e in self.errors.items() if f in index)
+        if changed:
+            self._schedules = None
+        return changed
+
+    def _parse(self, filename):
+        """Returns the (key, fields) of the schedule of a report, or None when it has no (valid) schedule."""
+        try:
+            with open(path_join(self.jobs_config_dir.path, filename), 'r') as f:
+                job = yaml.load(f.read())
+            if not isinstance(job, dict):
+                raise ValueError("it does not contain a report definition")
+            schedule = job.get('schedule')
+            if not schedule:
+                self.errors.pop(filename, None)
+                return None
+            if not isinstance(schedule, dict):
+                raise ValueError("its schedule should contain crontab fields")
+            fields = tuple(str(schedule.get(field, '*')) for field in CRONTAB_FIELDS)
+            CronSchedule(*fields).next_after(datetime.now())
+        except Exception as e:
+            self.errors[filename] = str(e)
+            logger.error("Ignoring the schedule of %s: %s", filename, e)
+            return None
+        self.errors.pop(filename, None)
+        return slugify(job.get('title') or filename[:-len('.yml')]), fields
+
+    def schedules(self):
+        """
+        Returns the schedules as an OrderedDict from a key to a dict with the crontab `fields` (a dict) and the report
+        `files` that run on it. With coalesce, reports with the same schedule share a single entry, so they run
+        together and share the queries they have in common.
+        """
+        if self._schedules is None:
+            groups = OrderedDict()
+            for filename in sorted(self._index):
+                parsed = self._index[filename][1]
+                if parsed is not None:
+                    key, fields = parsed
+                    groups.setdefault(fields if self.coalesce else key, []).append((key, fields, filename))
+            self._schedules = OrderedDict()
+            for reports in groups.values():
+                self._schedules['+'.join(report[0] for report in reports)] = {
+                    'fields': dict(zip(CRONTAB_FIELDS, reports[0][1])), 'files': [r[2] for r in reports]}
+        return self._schedules
+
+
+def read_report_schedules(jobs_config_dir, coalesce=True):
+    """Returns the schedules of the reports in the given directory. See ScheduleRegistry.schedules()."""
+    registry = ScheduleRegistry(jobs_config_dir, coalesce)
+    registry.refresh()
+    return registry.schedules()
@@ -1,3 +1,5 @@
+import sys
+import threading
 import time
 
 
@@ -6,6 +8,46 @@ def wait_until(predicate, interval):
         time.sleep(interval)
 
 
+def imap_bounded(func, items, workers):
+    """
+    Calls func on every item using at most `workers` threads. Yields a (result, error) tuple per item, in the order of
+    the items, as soon as that item and all items before it are done. When func raises, error holds the exc_info of the
+    exception and result is None, so one failing call does not stop the others.
+    """
+    items = list(items)
+    results = {}
+    done = threading.Condition()
+    pending = iter(enumerate(items))
+
+    def worker():
+        while True:
+            with done:
+                try:
+                    index, item = next(pending)
+                except StopIteration:
+                    return
+            try:
+                outcome = (func(item), None)
+            except Exception:
+                outcome = (None, sys.exc_info())
+            with done:
+                results[index] = outcome
+                done.notify_all()
+
+    for _ in range(min(max(workers, 1), len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    for index in range(len(items)):
+        with done:
+            while index not in results:
+                # waiting with a timeout keeps the main thread responsive to KeyboardInterrupt
+                done.wait(0.1)
+            outcome = results.pop(index)
+        yield outcome
+
+
 class Timer:
     def __enter__(self):
         self.start = time.time()
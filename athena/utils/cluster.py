@@ -1,57 +1,249 @@
 from __future__ import print_function
+import json
 import random
-from athena.utils.config import Config, is_collection
+import threading
+import time
+from bisect import bisect_right
+from contextlib import contextmanager
+from athena.utils.config import Config, ConfigDir, is_collection
+from athena.utils.profiling import span
 from IPy import IP
 
 
 def get_ips_or_hostnames(ip_list):
-    ip_hostname_list = []
-    if not is_collection(ip_list):
-        ip_list = [ip_list]
-    for item in ip_list:
+    return list(NodeInventory(ip_list))
+
+
+class NodeInventory(object):
+    """
+    Read-only sequence of the nodes in a list of IP addresses, IP ranges (CIDR notation) and hostnames. IP ranges are
+    not expanded: their addresses are computed when they are accessed, so even a /16 takes constant memory.
+    """
+
+    def __init__(self, ip_list):
+        if not is_collection(ip_list):
+            ip_list = [ip_list]
+        self.items = tuple(ip_list)
+        self._offsets = []
+        self._entries = []
+        self._size = 0
+        for item in self.items:
+            try:
+                entry = IP(item)
+                size = entry.len()
+            except ValueError:
+                entry = item
+                size = 1
+            self._offsets.append(self._size)
+            self._entries.append(entry)
+            self._size += size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("node index out of range")
+        position = bisect_right(self._offsets, index) - 1
+        entry = self._entries[position]
+        if isinstance(entry, IP):
+            return str(entry[index - self._offsets[position]])
+        return entry
+
+    def __iter__(self):
+        for entry in self._entries:
+            if isinstance(entry, IP):
+                for ip in entry:
+                    yield str(ip)
+            else:
+                yield entry
+
+    def __eq__(self, other):
+        return isinstance(other, NodeInventory) and self.items == other.items
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<node-inventory: {} nodes>'.format(self._size)
+
+
+class NodeState(object):
+    """Health and load of a single node, as observed by this process."""
+
+    __slots__ = ('outstanding', 'latency', 'failures', 'down_until')
+
+    def __init__(self):
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0
+
+
+class NodeSelector(object):
+    """
+    Chooses the slave node to run the next query on. State is only kept for nodes that have actually been used, and
+    for large inventories the choice is made from a random sample of `sample_size` nodes, so selecting stays cheap
+    regardless of the size of the configured IP ranges. Nodes that failed to connect are skipped for `down_time`
+    seconds, unless no other node is left.
+
+    Strategies:
+    - random: any healthy node
+    - round_robin: the healthy nodes in turn
+    - least_outstanding: the node with the fewest queries currently running through this process
+    - latency_weighted: a random node, weighted by the inverse of its recent latency, see record_latency
+
+    The latency of a node is measured when connecting to it and when checking the health of a pooled connection, not
+    over whole queries, since the time a query takes says more about the query than about the node. It reflects how
+    quickly a node responds, so a node that is slow because it is busy only gets less traffic once that shows in its
+    response times, and it is measured less often when connections are reused within the health check interval.
+    """
+
+    STRATEGIES = ('random', 'round_robin', 'least_outstanding', 'latency_weighted')
+    LATENCY_DECAY = 0.3
+
+    def __init__(self, nodes, strategy='least_outstanding', down_time=60, sample_size=16):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("Unknown slave selection strategy '{}', should be one of: {}".format(
+                strategy, ', '.join(self.STRATEGIES)))
+        self.nodes = nodes
+        self.strategy = strategy
+        self.down_time = down_time
+        self.sample_size = sample_size
+        self._states = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def select(self, exclude=()):
+        """Returns the node to use next, or None when there are no nodes (other than the excluded ones)."""
+        with self._lock:
+            if self.strategy == 'round_robin':
+                return self._round_robin(exclude)
+            candidates = [node for node in self._sample() if node not in exclude]
+            if not candidates:
+                return None
+            healthy = [node for node in candidates if self._is_up(node)]
+            candidates = healthy or candidates
+            if self.strategy == 'least_outstanding':
+                fewest = min(self._outstanding(node) for node in candidates)
+                return random.choice([node for node in candidates if self._outstanding(node) == fewest])
+            elif self.strategy == 'latency_weighted':
+                return self._weighted_by_latency(candidates)
+            else:
+                return random.choice(candidates)
+
+    @contextmanager
+    def track(self, node):
+        """Counts a query as outstanding on the given node for the duration of the block."""
+        with self._lock:
+            self._state(node).outstanding += 1
         try:
-            ips = IP(item)
-            ip_hostname_list.extend([str(i) for i in ips])
-        except ValueError:
-            ip_hostname_list.append(item)
-    return ip_hostname_list
+            yield
+        finally:
+            with self._lock:
+                self._state(node).outstanding -= 1
+
+    def record_latency(self, node, seconds):
+        """Adds a round trip to the node (connecting or a health check) to its latency, and marks it as up."""
+        with self._lock:
+            state = self._state(node)
+            if state.latency is None:
+                state.latency = seconds
+            else:
+                state.latency += self.LATENCY_DECAY * (seconds - state.latency)
+            state.failures = 0
+            state.down_until = 0
+
+    def mark_down(self, node):
+        with self._lock:
+            state = self._state(node)
+            state.failures += 1
+            state.down_until = time.time() + self.down_time
+
+    def state(self, node):
+        return self._states.get(node)
+
+    def _state(self, node):
+        state = self._states.get(node)
+        if state is None:
+            state = self._states[node] = NodeState()
+        return state
+
+    def _is_up(self, node):
+        state = self._states.get(node)
+        return state is None or state.down_until < time.time()
+
+    def _outstanding(self, node):
+        state = self._states.get(node)
+        return state.outstanding if state else 0
+
+    def _sample(self):
+        size = len(self.nodes)
+        if size <= self.sample_size:
+            return list(self.nodes)
+        return [self.nodes[random.randrange(size)] for _ in range(self.sample_size)]
+
+    def _round_robin(self, exclude):
+        size = len(self.nodes)
+        fallback = None
+        # down nodes are few in practice, so this loop normally ends after a couple of iterations
+        for _ in xrange(size):
+            node = self.nodes[self._next % size]
+            self._next = (self._next + 1) % size
+            if node in exclude:
+                continue
+            if self._is_up(node):
+                return node
+            fallback = fallback or node
+        return fallback
+
+    def _weighted_by_latency(self, candidates):
+        known = [self._states[n].latency for n in candidates if n in self._states and self._states[n].latency]
+        # nodes without measurements are treated like the fastest known node, so they get tried
+        default = min(known) if known else 1.0
+        weights = []
+        for node in candidates:
+            state = self._states.get(node)
+            latency = state.latency if state and state.latency else default
+            weights.append(1.0 / max(latency, 0.001))
+        point = random.uniform(0, sum(weights))
+        for node, weight in zip(candidates, weights):
+            point -= weight
+            if point <= 0:
+                return node
+        return candidates[-1]
 
 
 def get_dns(slave=False):
+    with span('cluster.discover'):
+        return _get_dns(slave)
+
+
+def _get_dns(slave):
     config = Config.load_default()
 
-    if config.cluster.type == 'standard':
-        if slave:
-            node = random.choice(get_ips_or_hostnames(config.cluster.slaves))
-        else:
-            node = config.cluster.master
+    def error(msg):
+        import sys
+        print("ERROR:", msg, file=sys.stderr)
+        return None
+
+    if slave:
+        node = get_node_selector().select()
+        if node is None:
+            error("No clusters to connect to")
+    elif config.cluster.type == 'standard':
+        node = config.cluster.master
     else:
         # only possible type currently, next to 'standard', is 'aws'
-        import boto.ec2
-        if slave:
-            if is_collection(config.cluster.slaves):
-                name = random.choice(config.cluster.slaves)
-            else:
-                name = config.cluster.slaves
-        else:
-            name = config.cluster.master
-
-        conn = boto.ec2.connect_to_region(
-            config.aws.region,
-            aws_access_key_id=config.aws.access_key_id,
-            aws_secret_access_key=config.aws.secret_access_key
-        )
-        instances = get_instances_by_tags(name, conn=conn)
-
-        def error(msg):
-            import sys
-            print("ERROR:", msg, file=sys.stderr)
-            return None
+        name = config.cluster.master
+        hostnames = resolve_aws_names([name])
 
         # Assumes there is only 1 node with that name
-        if len(instances) == 1:
-            node = instances[0].public_dns_name
-        elif len(instances) == 0:
+        if len(hostnames[name]) == 1:
+            node = hostnames[name][0]
+        elif len(hostnames[name]) == 0:
             error("No clusters to connect to")
             node = None
         else:
@@ -60,29 +252,177 @@ def get_dns(slave=False):
     return node
 
 
-def get_instances_by_tags(tags, conn=None):
-    if not conn:
+def get_slave_nodes():
+    """Returns a NodeInventory with the IP addresses or hostnames of all slave nodes in the cluster."""
+    global _slave_nodes
+    config = Config.load_default()
+
+    if config.cluster.type == 'standard':
+        slaves = config.cluster.slaves
+    else:
+        names = config.cluster.slaves if is_collection(config.cluster.slaves) else [config.cluster.slaves]
+        hostnames = resolve_aws_names(names)
+        slaves = [hostname for name in names for hostname in hostnames[name]]
+
+    nodes = _slave_nodes
+    if nodes is None or nodes.items != (tuple(slaves) if is_collection(slaves) else (slaves,)):
+        nodes = _slave_nodes = NodeInventory(slaves)
+    return nodes
+
+
+def get_node_selector():
+    """Returns the process-wide NodeSelector for the slave nodes, keeping node state when the inventory changes."""
+    global _node_selector
+    config = Config.load_default()
+    nodes = get_slave_nodes()
+    with _selector_lock:
+        if _node_selector is None or _node_selector.strategy != config.cluster.slave_selection:
+            _node_selector = NodeSelector(nodes, strategy=config.cluster.slave_selection,
+                                          down_time=config.cluster.node_down_time)
+        else:
+            _node_selector.nodes = nodes
+            _node_selector.down_time = config.cluster.node_down_time
+        return _node_selector
+
+
+class NodeCache(object):
+    """
+    Cache of AWS Name tags and the public hostnames of the running instances carrying them. Entries expire after `ttl`
+    seconds and are persisted in the config directory, so they are shared between invocations of athena.
+    """
+
+    FILENAME = 'node_cache.json'
+
+    def __init__(self, config_dir=None, ttl=300):
+        self.config_dir = config_dir or ConfigDir()
+        self.ttl = ttl
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._load().get(name)
+        if entry is None or entry['expires'] < time.time():
+            return None
+        return entry['hostnames']
+
+    def update(self, hostnames_by_name):
+        expires = time.time() + self.ttl
+        with self._lock:
+            entries = self._load()
+            for name, hostnames in hostnames_by_name.items():
+                entries[name] = {'expires': expires, 'hostnames': hostnames}
+            self._save()
+
+    def invalidate_host(self, hostname):
+        """Removes all entries that resolved to the given hostname. Returns whether there were any."""
+        with self._lock:
+            entries = self._load()
+            stale = [name for name, entry in entries.items() if hostname in entry['hostnames']]
+            for name in stale:
+                del entries[name]
+            if stale:
+                self._save()
+        return bool(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.config_dir.delete(self.FILENAME)
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.config_dir.read(self.FILENAME) or '{}')
+            except ValueError:
+                # a corrupt cache file is no reason to fail, it will be rewritten on the next update
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        self.config_dir.write(self.FILENAME, json.dumps(self._entries))
+
+
+_node_cache = None
+_ec2_connection = None
+_slave_nodes = None
+_node_selector = None
+_selector_lock = threading.Lock()
+
+
+def get_node_cache():
+    global _node_cache
+    config = Config.load_default()
+    if _node_cache is None:
+        _node_cache = NodeCache()
+    _node_cache.ttl = config.aws.node_cache_ttl
+    return _node_cache
+
+
+def resolve_aws_names(names):
+    """
+    Resolves AWS Name tags to the public hostnames of the running instances carrying them. Returns a dict with a list
+    of hostnames per name. Names that are not in the node cache are looked up together in a single API call.
+    """
+    cache = get_node_cache()
+    hostnames = {}
+    missing = []
+    for name in names:
+        cached = cache.get(name)
+        if cached is None:
+            missing.append(name)
+        else:
+            hostnames[name] = cached
+
+    if missing:
+        found = dict((name, []) for name in missing)
+        with span('cluster.aws_lookup'):
+            instances = get_instances_by_tags(missing)
+        for instance in instances:
+            found.setdefault(instance.tags.get('Name'), []).append(instance.public_dns_name)
+        # names without running instances are not cached, the cluster might be starting up
+        cache.update(dict((name, found[name]) for name in missing if found[name]))
+        hostnames.update(found)
+    return hostnames
+
+
+def invalidate_node(hostname):
+    """
+    Drops a hostname from the node cache, e.g. after connecting to it failed, so that it will be looked up again.
+    Returns whether the hostname was cached.
+    """
+    if Config.load_default().cluster.type == 'standard':
+        return False
+    return get_node_cache().invalidate_host(hostname)
+
+
+def get_ec2_connection():
+    global _ec2_connection
+    if _ec2_connection is None:
         import boto.ec2
         config = Config.load_default()
-        conn = boto.ec2.connect_to_region(
+        _ec2_connection = boto.ec2.connect_to_region(
             config.aws.region,
             aws_access_key_id=config.aws.access_key_id,
             aws_secret_access_key=config.aws.secret_access_key
         )
+    return _ec2_connection
 
+
+def get_instances_by_tags(tags, conn=None):
+    if not conn:
+        conn = get_ec2_connection()
+
+    if is_collection(tags):
+        # boto only recognizes lists as multiple filter values
+        tags = list(tags)
     instances = conn.get_only_instances(filters={'instance-state-code': 16, 'tag:Name': tags})
 
     return instances
 
 
 def get_running_instances():
-    import boto.ec2
-    config = Config.load_default()
-    conn = boto.ec2.connect_to_region(
-        config.aws.region,
-        aws_access_key_id=config.aws.access_key_id,
-        aws_secret_access_key=config.aws.secret_access_key
-    )
+    conn = get_ec2_connection()
 
     instances = conn.get_only_instances(
         filters={'instance-state-code': [0, 16, 64, 80]})
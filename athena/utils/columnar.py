@@ -0,0 +1,93 @@
+"""
+Writing query results in the columnar Parquet and Arrow (IPC file) formats. Requires pyarrow, which can be installed
+with `pip install athena[columnar]`.
+"""
+
+IMPALA_TO_ARROW_TYPES = {
+    'BOOLEAN': 'bool_',
+    'TINYINT': 'int8',
+    'SMALLINT': 'int16',
+    'INT': 'int32',
+    'BIGINT': 'int64',
+    'FLOAT': 'float32',
+    'DOUBLE': 'float64',
+    'STRING': 'string',
+    'VARCHAR': 'string',
+    'CHAR': 'string',
+    'BINARY': 'binary',
+    'DATE': 'date32'
+}
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise ValueError("Writing parquet or arrow files requires the pyarrow package, which you can install with "
+                         "'pip install athena[columnar]'")
+
+
+def arrow_schema(description):
+    """Creates an Arrow schema from the description of a DB-API cursor, keeping the Impala column names and types."""
+    pa = import_pyarrow()
+    fields = []
+    for column in description:
+        name, type_code, precision, scale = column[0], column[1], column[4], column[5]
+        if type_code == 'DECIMAL':
+            arrow_type = pa.decimal128(precision, scale)
+        elif type_code == 'TIMESTAMP':
+            arrow_type = pa.timestamp('us')
+        else:
+            # complex or unknown types are written as their string representation
+            arrow_type = getattr(pa, IMPALA_TO_ARROW_TYPES.get(type_code, 'string'))()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+def record_batch(schema, rows):
+    """Converts a list of row tuples to an Arrow record batch with the given schema."""
+    pa = import_pyarrow()
+    columns = zip(*rows) if rows else [()] * len(schema)
+    arrays = [pa.array(list(values), type=field.type) for field, values in zip(schema, columns)]
+    return pa.RecordBatch.from_arrays(arrays, schema.names)
+
+
+def write_columnar(filename, description, batches, output_format='parquet', progress=None):
+    """
+    Streams batches (lists) of rows to a Parquet or Arrow file. Every batch is converted to a record batch and written
+    before the next one is read, so it becomes a row group of its own in a Parquet file and memory use is bounded by
+    the batch size. When a Throughput is given, it is updated with the in-memory size of every batch.
+    """
+    pa = import_pyarrow()
+    schema = arrow_schema(description)
+
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(filename, schema)
+
+        def write(batch):
+            writer.write_table(pa.Table.from_batches([batch]))
+
+        close = writer.close
+    elif output_format == 'arrow':
+        sink = pa.OSFile(filename, 'wb')
+        writer = pa.RecordBatchFileWriter(sink, schema)
+        write = writer.write_batch
+
+        def close():
+            writer.close()
+            sink.close()
+    else:
+        raise ValueError("Unknown columnar output format '{}'".format(output_format))
+
+    try:
+        for rows in batches:
+            batch = record_batch(schema, rows)
+            write(batch)
+            if progress:
+                progress.update(batch.num_rows, sum(column.nbytes for column in batch.columns))
+    finally:
+        close()
+    if progress:
+        progress.finish()
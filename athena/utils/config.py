@@ -2,10 +2,13 @@ from __future__ import absolute_import
 from __future__ import with_statement
 
 import errno
-from os import remove, removedirs
+import threading
+from copy import deepcopy
+from os import remove, removedirs, stat
 from os.path import isfile, join as path_join, exists
 from click.utils import get_app_dir
 from athena.utils.file import mkdir_p, touchopen
+from athena.utils.profiling import span
 import yaml
 
 
@@ -122,11 +125,22 @@ class Config(object):
     DEFAULT_CONFIG = {
         'cluster': {
             'type': 'standard',
-            'impala_port': 21050
+            'impala_port': 21050,
+            'pool_size': 4,
+            'pool_idle_timeout': 300,
+            'pool_health_check_interval': 30,
+            'slave_selection': 'least_outstanding',
+            'node_down_time': 60,
+            'connect_attempts': 3,
+            'fetch_size': 10000
         },
         'ssh': {
             'username': None,
-            'key_path': None
+            'key_path': None,
+            'keepalive': 30,
+            'control_persist': None,
+            'remote_dir': None,
+            'remote_dir_max_age': 7 * 24 * 3600
         },
         'mailing': {
             'smtp_host': 'localhost',
@@ -135,40 +149,94 @@ class Config(object):
             'smtp_password': None,
             'smtp_use_tls': True,
             'from_address': 'data@example.com',
-            'default_template': 'datamail.html'
+            'default_template': 'datamail.html',
+            'query_concurrency': 4
+        },
+        'aws': {
+            'region': None,
+            'access_key_id': None,
+            'secret_access_key': None,
+            'node_cache_ttl': 300
+        },
+        'cache': {
+            'enabled': False,
+            'ttl': 300,
+            'max_size_mb': 256,
+            'max_entry_rows': 100000
         },
         'slack': {
             'token': None,
             'default_channel': None,
             'default_username': 'athena',
-            'default_icon': None
+            'default_icon': None,
+            'max_rows': 10000,
+            'max_table_rows': 50,
+            'max_message_chars': 3000,
+            'max_retries': 5
+        },
+        'scheduling': {
+            'celery_broker_url': None,
+            'celery_result_backend': None,
+            'celery_timezone': 'Europe/Amsterdam',
+            'coalesce_reports': True,
+            'fan_out': True,
+            'query_retries': 2,
+            'query_retry_delay': 60,
+            'workers': 2,
+            'missed_run_grace': 86400,
+            'reload_interval': 30,
+            'metrics': False,
+            'metrics_port': None,
+            'metrics_textfile': None
         }
     }
 
+    __slots__ = ('_values',)
+
+    _cache = {}
+    _cache_lock = threading.Lock()
+
     def __init__(self, config_dict):
         """
-        From a dictionary with arbitrary nesting, recursively creates a class hierarchy allowing dot-notation access to
-        attributes with any depth.
+        From a dictionary with arbitrary nesting, recursively creates a read-only class hierarchy allowing dot-notation
+        access to attributes with any depth. Values are normalized once, when the Config is created: strings are
+        stripped, nested dicts become Config objects and lists become tuples.
         """
-        for k, v in config_dict.iteritems():
-            if isinstance(v, (list, tuple)):
-                setattr(self, k, [Config(x) if isinstance(x, dict) else x for x in v])
-            else:
-                setattr(self, k, Config(v) if isinstance(v, dict) else v)
-
-    def __getattribute__(self, name):
-        val = object.__getattribute__(self, name)
-        if isinstance(val, basestring):
-            return val.strip()
-        elif isinstance(val, (list, tuple)):
-            return [x.strip() for x in val]
+        object.__setattr__(self, '_values', dict((k, Config._normalize(v)) for k, v in config_dict.iteritems()))
+
+    @staticmethod
+    def _normalize(value):
+        if isinstance(value, basestring):
+            return value.strip()
+        elif isinstance(value, dict):
+            return Config(value)
+        elif isinstance(value, (list, tuple)):
+            return tuple(Config._normalize(x) for x in value)
         else:
-            return val
+            return value
+
+    def __getattr__(self, name):
+        if name == '_values':
+            # only reachable on instances that were not created through __init__ (e.g. by copy)
+            raise AttributeError(name)
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError("Configuration has no value for '{}'".format(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Configuration is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("Configuration is read-only")
+
+    def __repr__(self):
+        return '<config: {}>'.format(', '.join(sorted(self._values)))
 
     @staticmethod
     def load(config_file):
-        values = yaml.safe_load(config_file)
-        config_dict = Config._merge(dict(Config.DEFAULT_CONFIG), values)
+        values = yaml.safe_load(config_file) or {}
+        config_dict = Config._merge(deepcopy(Config.DEFAULT_CONFIG), values)
         return Config(config_dict)
 
     @staticmethod
@@ -192,11 +260,35 @@ class Config(object):
 
     @staticmethod
     def load_default():
-        config_file = ConfigDir().open_athena_config()
-        config_obj = Config.load(config_file)
-        config_file.close()
+        """
+        Returns the Config from the default configuration file. The parsed Config is cached for the whole process, and
+        only parsed again when the modification time or size of the file changes.
+        """
+        config_path = path_join(get_app_dir('athena', force_posix=True), 'config.yml')
+        try:
+            st = stat(config_path)
+            version = (st.st_mtime, st.st_size)
+        except OSError:
+            version = None
+
+        cached = Config._cache.get(config_path)
+        if cached is not None and version is not None and cached[0] == version:
+            return cached[1]
+
+        with Config._cache_lock, span('config.load'):
+            config_file = ConfigDir().open_athena_config()
+            try:
+                config_obj = Config.load(config_file)
+            finally:
+                config_file.close()
+            Config._cache[config_path] = (version, config_obj)
         return config_obj
 
+    @staticmethod
+    def clear_cache():
+        with Config._cache_lock:
+            Config._cache.clear()
+
 
 class ConfigurationError(Exception):
     def __init__(self):
@@ -0,0 +1,142 @@
+import re
+import threading
+from pipes import quote
+
+from athena.utils import imap_bounded
+
+JOB_STARTED = re.compile(r'Running job: (job_\w+)')
+JOB_PROGRESS = re.compile(r'\bmap (\d+)% reduce (\d+)%')
+JOB_SUCCEEDED = re.compile(r'Job (job_\w+) completed successfully')
+JOB_FAILED = re.compile(r'Job (job_\w+) failed|DistCp: Exception|ERROR tools\.DistCp')
+
+
+class Copy(object):
+    """A single distcp job, copying src to dst, and its progress as parsed from the distcp output."""
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        # the path that ends up being written, which depends on whether dst is an existing directory
+        self.target = dst
+        self.job_id = None
+        self.map_percent = 0
+        self.state = 'waiting'
+        self.output = None
+
+    def feed(self, line):
+        """Updates the progress from a line of distcp output. Returns whether the progress changed."""
+        match = JOB_PROGRESS.search(line)
+        if match:
+            changed = int(match.group(1)) != self.map_percent
+            self.map_percent = int(match.group(1))
+            return changed
+        match = JOB_STARTED.search(line)
+        if match:
+            self.job_id = match.group(1)
+            self.state = 'running'
+            return True
+        if JOB_SUCCEEDED.search(line):
+            self.map_percent = 100
+            return True
+        if JOB_FAILED.search(line):
+            self.state = 'failing'
+            return True
+        return False
+
+    def __repr__(self):
+        return '<copy {} -> {}: {} {}%>'.format(self.src, self.dst, self.state, self.map_percent)
+
+
+def parse_manifest(lines, default_dst=None):
+    """
+    Reads copies from a manifest: one source per line, optionally followed by whitespace and a destination of its own.
+    Empty lines and lines starting with # are skipped. Returns a list of (src, dst) tuples.
+    """
+    copies = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        if len(parts) > 2:
+            raise ValueError("Line {} of the manifest should contain a source and optionally a destination".format(
+                number))
+        dst = parts[1] if len(parts) == 2 else default_dst
+        if dst is None:
+            raise ValueError("Line {} of the manifest has no destination, and none was given".format(number))
+        copies.append((parts[0], dst))
+    return copies
+
+
+def is_hdfs_path(path):
+    return '://' not in path or path.startswith('hdfs://')
+
+
+def distcp_command(src, dst, maps=None, bandwidth=None):
+    options = ''
+    if maps:
+        options += ' -m {:d}'.format(maps)
+    if bandwidth:
+        options += ' -bandwidth {:d}'.format(bandwidth)
+    return 'sudo -u hdfs hadoop distcp{} {} {}'.format(options, quote(src), quote(dst))
+
+
+def run_copies(client, copies, parallel=1, maps=None, bandwidth=None, on_progress=None, on_line=None, log_file=None,
+               fix_permissions=True):
+    """
+    Runs a distcp job on the cluster for every (src, dst) in copies, at most `parallel` at a time, each over its own
+    channel of the client's SSH connection. on_progress is called with the list of Copy objects whenever the progress of
+    one of them changes, and on_line with every line of distcp output. Afterwards the permissions of the HDFS paths that
+    were written, and of the destination directories that were created for them, are opened up. Returns the list of Copy
+    objects, with the state of each being either 'done' or 'failed'.
+    """
+    jobs = [Copy(src, dst) for src, dst in copies]
+    lock = threading.Lock()
+
+    def report():
+        if on_progress:
+            with lock:
+                on_progress(jobs)
+
+    # distcp copies into a destination directory when it exists, so find out where every copy will end up
+    destinations = set(job.dst for job in jobs)
+    is_dir = dict((dst, client.hdfs_is_dir(dst)) for dst in destinations if is_hdfs_path(dst))
+    created = []
+    for dst in destinations:
+        if sum(1 for job in jobs if job.dst == dst) > 1 and not is_dir.get(dst, True):
+            # several jobs copying to a directory that does not exist yet would race to create it
+            client.hdfs_mkdir(dst)
+            is_dir[dst] = True
+            created.append(dst)
+    for job in jobs:
+        if is_dir.get(job.dst):
+            job.target = job.dst.rstrip('/') + '/' + job.src.rstrip('/').rsplit('/', 1)[-1]
+
+    def run(job):
+        job.state = 'starting'
+        report()
+
+        def handle(line):
+            if on_line:
+                with lock:
+                    on_line(line)
+            if job.feed(line):
+                report()
+
+        job.output = client.dist_copy(job.src, job.dst, maps=maps, bandwidth=bandwidth, on_stdout=handle,
+                                      on_stderr=handle, log_file=log_file)
+        job.state = 'done' if job.output[2] == 0 else 'failed'
+        report()
+
+    for job, (_, error) in zip(jobs, imap_bounded(run, jobs, parallel)):
+        if error is not None:
+            job.state = 'failed'
+            job.output = ('', str(error[1]), None)
+            report()
+
+    # the created directories are changed recursively, along with everything copied into them
+    written = [job.target for job in jobs
+               if job.state == 'done' and is_hdfs_path(job.target) and job.dst not in created]
+    if fix_permissions and (created or written):
+        client.fix_hdfs_permissions(*sorted(created) + written)
+    return jobs
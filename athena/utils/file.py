@@ -1,16 +1,148 @@
 import csv
 import time
+import zlib
+from contextlib import contextmanager
+from cStringIO import StringIO
+from itertools import islice
 from os import makedirs
 import errno
 from os.path import join as path_join
+from athena.utils.profiling import span
 
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+OUTPUT_FORMATS = ('csv', 'parquet', 'arrow')
+OUTPUT_FORMAT_EXTENSIONS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow'}
+
+
+def guess_output_format(filename):
+    """Returns the output format that matches the extension of the given filename, csv by default."""
+    for extension, output_format in OUTPUT_FORMAT_EXTENSIONS.items():
+        if filename.lower().endswith(extension):
+            return output_format
+    return 'csv'
+
+
+def write_csv(csv_file, rows, headers=None, batch_size=10000, progress=None):
+    write_csv_batches(csv_file, chunked(rows, batch_size), headers, progress)
+
+
+def write_csv_batches(csv_file, batches, headers=None, progress=None):
+    """
+    Writes batches (lists) of rows to a CSV file, compressed with gzip or zstd when the filename ends with .gz or .zst.
+    Each batch is formatted in memory and written to the file at once. When a Throughput is given, it is updated after
+    every batch.
+    """
+    buf = StringIO()
+    csv_writer = csv.writer(buf)
+    with open_output(csv_file) as f:
+
+        def flush(rows):
+            data = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            f.write(data)
+            if progress:
+                progress.update(rows, len(data))
 
-def write_csv(csv_file, rows, headers=None):
-    with open(csv_file, 'wb') as f:
-        csv_writer = csv.writer(f)
         if headers:
             csv_writer.writerow(headers)
-        csv_writer.writerows(rows)
+            flush(0)
+        for batch in batches:
+            with span('csv.write'):
+                csv_writer.writerows(batch)
+                flush(len(batch))
+    if progress:
+        progress.finish()
+
+
+def chunked(iterable, size):
+    """Yields lists of at most `size` items from the given iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class CompressedWriter(object):
+    """File-like object that compresses everything written to it with the given compressor object."""
+
+    def __init__(self, f, compressor):
+        self.f = f
+        self.compressor = compressor
+
+    def write(self, data):
+        self.f.write(self.compressor.compress(data))
+
+    def close(self):
+        self.f.write(self.compressor.flush())
+
+
+@contextmanager
+def open_output(filename):
+    """
+    Opens a file for (buffered) binary writing. Data is gzip compressed when the filename ends with .gz, and zstd
+    compressed when it ends with .zst.
+    """
+    if filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("Writing .zst files requires the zstandard package, which you can install with "
+                             "'pip install athena[zstd]'")
+        compressor = zstandard.ZstdCompressor().compressobj()
+    elif filename.endswith('.gz'):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    else:
+        compressor = None
+
+    with open(filename, 'wb', WRITE_BUFFER_SIZE) as f:
+        if compressor is None:
+            yield f
+        else:
+            writer = CompressedWriter(f, compressor)
+            yield writer
+            writer.close()
+
+
+class Throughput(object):
+    """
+    Keeps track of the number of rows and bytes written, and calls `report` with itself at most every `interval`
+    seconds while writing, and once more with final=True when done.
+    """
+
+    def __init__(self, report=None, interval=1.0):
+        self.report = report
+        self.interval = interval
+        self.rows = 0
+        self.bytes = 0
+        self.start = self._last_report = time.time()
+
+    def update(self, rows, nbytes):
+        self.rows += rows
+        self.bytes += nbytes
+        now = time.time()
+        if self.report and now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report(self, final=False)
+
+    def finish(self):
+        if self.report:
+            self.report(self, final=True)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rows_per_second(self):
+        return self.rows / max(self.elapsed, 1e-6)
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / max(self.elapsed, 1e-6)
 
 
 def mkdir_p(path):
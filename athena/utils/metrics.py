@@ -0,0 +1,158 @@
+import fcntl
+import json
+import os
+import re
+import threading
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from os.path import join as path_join
+
+
+def histogram(buckets, *values):
+    """
+    Returns a histogram of the given values, as a dict with the upper bounds of the `buckets`, the `counts` per bucket
+    (plus one for the values above the last bucket), and the `sum` and `count` of the values.
+    """
+    counts = [0] * (len(buckets) + 1)
+    for value in values:
+        counts[bisect_left(buckets, value)] += 1
+    return {'buckets': list(buckets), 'counts': counts, 'sum': float(sum(values)), 'count': len(values)}
+
+
+class Counters(object):
+    """
+    Named counters and histograms, persisted as JSON in a file in the config directory. Updates are serialized with a
+    file lock, so they add up correctly over all threads and processes that share the directory, like scheduler
+    workers.
+    """
+
+    def __init__(self, config_dir, filename):
+        self.config_dir = config_dir
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def increment(self, **amounts):
+        self.update(amounts)
+
+    def update(self, counters=None, histograms=None):
+        """
+        Adds the amounts in counters to the counters with the same name, and merges the histograms (see histogram())
+        into the ones with the same name. A histogram whose buckets changed starts over.
+        """
+        with self._locked() as f:
+            metrics = self._parse(f.read())
+            for name, amount in (counters or {}).items():
+                metrics[name] = metrics.get(name, 0) + amount
+            for name, added in (histograms or {}).items():
+                current = metrics.get(name)
+                if not isinstance(current, dict) or current['buckets'] != list(added['buckets']):
+                    current = metrics[name] = histogram(added['buckets'])
+                current['counts'] = [a + b for a, b in zip(current['counts'], added['counts'])]
+                current['sum'] += added['sum']
+                current['count'] += added['count']
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(metrics, sort_keys=True))
+
+    def read(self):
+        return self._parse(self.config_dir.read(self.filename))
+
+    def reset(self):
+        self.config_dir.delete(self.filename)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            with open(path_join(self.config_dir.path, self.filename), 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    yield f
+                finally:
+                    f.flush()
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _parse(content):
+        try:
+            return json.loads(content or '{}')
+        except ValueError:
+            return {}
+
+
+def format_prometheus(metrics, prefix=''):
+    """
+    Returns counters and histograms, as read from Counters, in the Prometheus text format. Names can have labels, like
+    'stage_seconds{stage="query.execute"}'. Counters get a _total suffix.
+    """
+    lines = []
+    families = set()
+    for key in sorted(metrics):
+        value = metrics[key]
+        name, _, labels = key.partition('{')
+        labels = labels.rstrip('}')
+        name = prefix + re.sub('[^a-zA-Z0-9_]', '_', name)
+        if not isinstance(value, dict):
+            name += '_total'
+        if name not in families:
+            families.add(name)
+            lines.append('# TYPE {} {}'.format(name, 'histogram' if isinstance(value, dict) else 'counter'))
+        if not isinstance(value, dict):
+            lines.append(_sample(name, labels, value))
+            continue
+        cumulative = 0
+        for bound, count in zip([str(b) for b in value['buckets']] + ['+Inf'], value['counts']):
+            cumulative += count
+            lines.append(_sample(name + '_bucket', ','.join(filter(None, [labels, 'le="{}"'.format(bound)])),
+                                 cumulative))
+        lines.append(_sample(name + '_sum', labels, value['sum']))
+        lines.append(_sample(name + '_count', labels, value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _sample(name, labels, value):
+    return '{}{} {}'.format(name, '{' + labels + '}' if labels else '', value)
+
+
+def write_textfile(path, text):
+    """Replaces the file at path with text, atomically, so a collector reading the file never sees half of it."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+
+
+class MetricsServer(HTTPServer):
+    """Serves the text returned by render() at /metrics over HTTP, from a daemon thread, for Prometheus to scrape."""
+
+    def __init__(self, render, port, host=''):
+        HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.render = render
+        self.port = self.server_address[1]
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
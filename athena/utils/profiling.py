@@ -0,0 +1,114 @@
+import json
+import threading
+from bisect import bisect_left
+import time
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    """
+    Keeps the number of calls, the total time and the longest time of every named stage, over all threads. Stages can
+    be nested and run concurrently, so their times can add up to more than the wall time. With `buckets` (upper bounds
+    in seconds, ascending), every stage also keeps a histogram of its times in `bucket_counts`, with one more count
+    for the times above the last bucket. Besides times, the profiler keeps named `counters`, like the rows fetched.
+    """
+
+    def __init__(self, buckets=None):
+        self.start = time.time()
+        self.buckets = tuple(buckets) if buckets else None
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+            stage['calls'] += 1
+            stage['total_seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            if self.buckets:
+                if 'bucket_counts' not in stage:
+                    stage['bucket_counts'] = [0] * (len(self.buckets) + 1)
+                stage['bucket_counts'][bisect_left(self.buckets, seconds)] += 1
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def drain(self):
+        """Returns the stages and counters collected so far, and starts over with none."""
+        with self._lock:
+            stages, counters = self.stages, self.counters
+            self.stages, self.counters = {}, {}
+        return stages, counters
+
+    @property
+    def wall_seconds(self):
+        return time.time() - self.start
+
+    def report(self):
+        """Returns the timing breakdown as a table, with the stages that took the most time first."""
+        lines = ['{:<24} {:>7} {:>10} {:>10}'.format('stage', 'calls', 'total (s)', 'max (s)')]
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1]['total_seconds'])
+        for name, stage in stages:
+            lines.append('{:<24} {:>7} {:>10.3f} {:>10.3f}'.format(name, stage['calls'], stage['total_seconds'],
+                                                                   stage['max_seconds']))
+        lines.append('{:<24} {:>7} {:>10.3f}'.format('wall time', '', self.wall_seconds))
+        with self._lock:
+            counters = sorted(self.counters.items())
+        for name, amount in counters:
+            lines.append('{:<24} {:>7}'.format(name, amount))
+        return '\n'.join(lines)
+
+    def to_json(self, **extra):
+        with self._lock:
+            metrics = dict(extra, wall_seconds=self.wall_seconds, stages=dict(self.stages),
+                           counters=dict(self.counters))
+        return json.dumps(metrics, indent=2, sort_keys=True)
+
+
+_profiler = None
+
+
+def enable_profiling(buckets=None):
+    """Starts collecting the time spent in spans, in a new Profiler, which is returned."""
+    global _profiler
+    _profiler = Profiler(buckets)
+    return _profiler
+
+
+def disable_profiling():
+    global _profiler
+    _profiler = None
+
+
+def get_profiler():
+    """Returns the active Profiler, or None when profiling is not enabled."""
+    return _profiler
+
+
+@contextmanager
+def span(name):
+    """
+    Records the time the block takes as the stage with the given name, when profiling is enabled. When it is not,
+    this costs next to nothing.
+    """
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        profiler.record(name, time.time() - start)
+
+
+def count(name, amount=1):
+    """Adds amount to the counter with the given name, when profiling is enabled."""
+    profiler = _profiler
+    if profiler is not None:
+        profiler.count(name, amount)
@@ -1,15 +1,35 @@
-import StringIO
+import atexit
+import hashlib
+import json
+import select
+import stat
 import socket
+import threading
 from paramiko.client import SSHClient
 from paramiko.client import AutoAddPolicy
+from paramiko.ssh_exception import SSHException
 from paramiko.sftp_client import SFTPClient
 import os
 import time
-from athena.utils.config import Config
-from cluster import get_dns
+from collections import deque
+from athena.utils.config import Config, ConfigDir
+from cluster import get_dns, invalidate_node
+from athena.utils.distcp import distcp_command
+from athena.utils.profiling import count, span
 import subprocess
+from pipes import quote
 from os.path import join as path_join
 
+RECV_BUFFER_SIZE = 64 * 1024
+# a large window lets the server keep sending while we are busy handling output
+COMMAND_WINDOW_SIZE = 4 * 1024 * 1024
+MAX_LINE_LENGTH = 64 * 1024
+TAIL_LINES = 1000
+# only a safety net: waiting ends as soon as output arrives or the channel is closed
+WAIT_TIMEOUT = 1.0
+# relative to the home directory on the master node
+DEFAULT_REMOTE_DIR = '.athena-uploads'
+
 
 def open_ssh_session(slave=False):
     config = Config.load_default()
@@ -17,98 +37,446 @@ def open_ssh_session(slave=False):
     dns = get_dns(slave)
     username = config.ssh.username
     cmd = "ssh -i {} {}@{} -oStrictHostKeyChecking=no".format(ssh_key, username, dns)
+    if config.ssh.control_persist:
+        # keep the connection open in the background, so the next session to the same host skips the handshake
+        control_path = path_join(ConfigDir().sub('ssh').path, '%C')
+        cmd += " -oControlMaster=auto -oControlPath={} -oControlPersist={}".format(
+            control_path, config.ssh.control_persist)
     subprocess.call(cmd, shell=True)
 
 
-class MasterNodeSSHClient():
-    def __init__(self, host, username=None, ssh_key=None):
-        self.ssh_client = SSHClient()
-        self.ssh_client.load_system_host_keys()
-        self.ssh_client.set_missing_host_key_policy(AutoAddPolicy())
-        self.ssh_client.connect(host, username=username, key_filename=os.path.expanduser(ssh_key))
-        self.ssh_client.get_transport().set_keepalive(30)
+def connect_ssh(host, username=None, ssh_key=None, keepalive=30):
+    client = SSHClient()
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(AutoAddPolicy())
+    try:
+        with span('ssh.connect'):
+            client.connect(host, username=username, key_filename=os.path.expanduser(ssh_key) if ssh_key else None)
+    except (socket.error, SSHException):
+        # make sure the host is looked up again next time, in case it was replaced
+        invalidate_node(host)
+        raise
+    client.get_transport().set_keepalive(keepalive)
+    return client
+
+
+def is_active(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+class SSHConnectionRegistry(object):
+    """
+    Thread-safe registry of SSH connections, keyed by (host, username, key path). A connection is opened on first use
+    and then shared by everything in the process that talks to the same host: paramiko multiplexes any number of
+    channels (commands, SFTP sessions, forwarded ports) over a single transport. Connections that are no longer active
+    are reopened on the next use.
+    """
+
+    def __init__(self, keepalive=30, connect_fn=connect_ssh):
+        self.keepalive = keepalive
+        self.closed = False
+        self._connect = connect_fn
+        self._clients = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, username=None, ssh_key=None):
+        """Returns a connected SSHClient for the given host, reconnecting when its connection was lost."""
+        key = (host, username, ssh_key)
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("SSH connection registry is closed")
+            client = self._clients.get(key)
+            if client is not None and is_active(client):
+                count('ssh.connections_reused')
+                return client
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        # connecting takes a while, so only threads that need the same connection wait for each other
+        with lock:
+            with self._lock:
+                client = self._clients.get(key)
+            if client is not None and is_active(client):
+                count('ssh.connections_reused')
+                return client
+            if client is not None:
+                client.close()
+            client = self._connect(host, username, ssh_key, self.keepalive)
+            count('ssh.connections_opened')
+            with self._lock:
+                self._clients[key] = client
+            return client
+
+    def discard(self, host, username=None, ssh_key=None):
+        """Closes the connection for the given host, so the next get() opens a new one."""
+        with self._lock:
+            client = self._clients.pop((host, username, ssh_key), None)
+        if client is not None:
+            client.close()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            clients = self._clients.values()
+            self._clients = {}
+        for client in clients:
+            client.close()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_ssh_registry():
+    """Returns the process-wide SSH connection registry."""
+    global _registry
+    with _registry_lock:
+        if _registry is None or _registry.closed:
+            _registry = SSHConnectionRegistry(keepalive=Config.load_default().ssh.keepalive)
+        return _registry
+
+
+def close_ssh_connections():
+    """Closes all shared SSH connections. The next call to get_ssh_registry() creates a new registry."""
+    global _registry
+    with _registry_lock:
+        if _registry is not None:
+            _registry.close()
+            _registry = None
+
+
+atexit.register(close_ssh_connections)
+
+
+class OutputStream(object):
+    """
+    Splits the output of a remote command into lines as it comes in and passes every line to `callback`. Raw output is
+    also appended to `log_file` when one is given. Only the last `tail_lines` lines are kept in memory, and lines
+    longer than MAX_LINE_LENGTH are split, so memory use is bounded no matter how much the command prints.
+    """
+
+    def __init__(self, callback=None, log_file=None, tail_lines=TAIL_LINES):
+        self.callback = callback
+        self.log_file = log_file
+        self.tail = deque(maxlen=tail_lines)
+        self.omitted = 0
+        self._partial = ''
+
+    def feed(self, data):
+        if self.log_file:
+            self.log_file.write(data)
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        if len(self._partial) >= MAX_LINE_LENGTH:
+            lines.append(self._partial)
+            self._partial = ''
+        for line in lines:
+            self._line(line)
+
+    def close(self):
+        if self._partial:
+            self._line(self._partial)
+            self._partial = ''
 
-    def _send_command_and_wait(self, cmd):
-        ssh = self.ssh_client
+    def getvalue(self):
+        lines = list(self.tail)
+        if self.omitted:
+            lines.insert(0, '... ({} earlier lines omitted)'.format(self.omitted))
+        return '\n'.join(lines)
 
-        chan = ssh.get_transport().open_session()
+    def _line(self, line):
+        if len(self.tail) == self.tail.maxlen:
+            self.omitted += 1
+        self.tail.append(line)
+        if self.callback:
+            self.callback(line)
 
+
+def wait_for_command(chan, stdout, stderr):
+    """
+    Reads the output of the command running on a channel into the given OutputStreams until it exits, and returns
+    its exit status. Blocks in select() on the channel in between, instead of polling it.
+    """
+    while True:
+        if chan.recv_ready():
+            stdout.feed(chan.recv(RECV_BUFFER_SIZE))
+        elif chan.recv_stderr_ready():
+            stderr.feed(chan.recv_stderr(RECV_BUFFER_SIZE))
+        elif chan.exit_status_ready():
+            # the server sends the exit status after all output, so nothing is left to read
+            break
+        else:
+            select.select([chan], [], [], WAIT_TIMEOUT)
+    stdout.close()
+    stderr.close()
+    return chan.recv_exit_status()
+
+
+class FileDigests(object):
+    """
+    SHA-1 digests of local files, persisted in the config directory together with the size and modification time of
+    every file, so a file is only read again when it changed.
+    """
+
+    FILENAME = 'file_digests.json'
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, config_dir=None):
+        self.config_dir = config_dir or ConfigDir()
+        self._entries = None
+        self._changed = False
+
+    def digest(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entries = self._load()
+        entry = entries.get(path)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return entry['sha1']
+
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(self.READ_SIZE), ''):
+                h.update(data)
+        entries[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': h.hexdigest()}
+        self._changed = True
+        return entries[path]['sha1']
+
+    def save(self):
+        if self._changed:
+            self.config_dir.write(self.FILENAME, json.dumps(self._entries))
+            self._changed = False
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.config_dir.read(self.FILENAME) or '{}')
+            except ValueError:
+                self._entries = {}
+        return self._entries
+
+
+class UnsafeRemoteFileError(IOError):
+    pass
+
+
+class RemoteFileStore(object):
+    """
+    Files uploaded to the master node, stored under `root` by their SHA-1 digest in a 'files' directory, so a file that
+    is already there is not uploaded again. Every upload gets its own directory under 'runs', with links to the files
+    by their original names. Runs and files that have not been used for `max_age` seconds are removed by clean().
+
+    A relative root is relative to the home directory of the SSH user. The directories are only accessible to the user
+    with the given uid (the owner of that home directory by default), and nothing is reused unless it belongs to that
+    user, so other users cannot swap out the scripts that are run. An UnsafeRemoteFileError is raised otherwise.
+    """
+
+    def __init__(self, sftp, root, max_age=7 * 24 * 3600, digests=None, uid=None):
+        self.sftp = sftp
+        self.root = sftp.normalize(root)
+        self.max_age = max_age
+        self.digests = digests or FileDigests()
+        self.uid = uid if uid is not None else sftp.stat('.').st_uid
+        self.files_dir = path_join(self.root, 'files')
+        self.runs_dir = path_join(self.root, 'runs')
+        self.uploaded = 0
+        self.reused = 0
+
+    def upload(self, paths, prefix=''):
+        """Makes the given local files available in a new run directory, and returns the path of that directory."""
+        for directory in (self.root, self.files_dir, self.runs_dir):
+            self._mkdir(directory)
+        stored = dict((a.filename, a) for a in self.sftp.listdir_attr(self.files_dir))
+
+        # the random suffix keeps runs that start in the same millisecond apart
+        run_name = '{}{:d}-{}'.format(prefix, int(time.time() * 1000), os.urandom(4).encode('hex'))
+        run_dir = path_join(self.runs_dir, run_name)
+        self.sftp.mkdir(run_dir, 0o700)
+        try:
+            for path in paths:
+                digest = self.digests.digest(path)
+                remote_path = path_join(self.files_dir, digest)
+                attributes = stored.get(digest)
+                if attributes is not None:
+                    self._check(remote_path, attributes, stat.S_ISREG)
+                if attributes is not None and attributes.st_size == os.path.getsize(path):
+                    # mark it as used, so clean() keeps it
+                    self.sftp.utime(remote_path, None)
+                    self.reused += 1
+                else:
+                    self._put(path, remote_path)
+                    self.uploaded += 1
+                self.sftp.symlink(remote_path, path_join(run_dir, os.path.basename(path)))
+        finally:
+            self.digests.save()
+        return run_dir
+
+    def clean(self):
+        """Removes runs and files that were not used for max_age seconds. Returns the number of removed entries."""
+        cutoff = time.time() - self.max_age
+        removed = 0
+        for run in self._listdir_attr(self.runs_dir):
+            if run.st_mtime < cutoff and stat.S_ISDIR(run.st_mode):
+                run_dir = path_join(self.runs_dir, run.filename)
+                for name in self.sftp.listdir(run_dir):
+                    self.sftp.remove(path_join(run_dir, name))
+                self.sftp.rmdir(run_dir)
+                removed += 1
+        for stored in self._listdir_attr(self.files_dir):
+            if stored.st_mtime < cutoff:
+                self.sftp.remove(path_join(self.files_dir, stored.filename))
+                removed += 1
+        return removed
+
+    def _put(self, path, remote_path):
+        # upload under a temporary name first, so an interrupted upload is never mistaken for the complete file
+        partial = '{}.{}.part'.format(remote_path, os.getpid())
+        self.sftp.put(path, partial)
+        try:
+            self.sftp.rename(partial, remote_path)
+        except IOError:
+            # uploaded by someone else in the meantime
+            self.sftp.remove(partial)
+
+    def _mkdir(self, path):
+        """Creates a directory that only the user can access, or checks that the existing directory is one."""
         try:
-            # Execute the given command
-            chan.exec_command(cmd)
+            self.sftp.mkdir(path, 0o700)
+        except IOError:
+            # it already exists, which is only fine when it was created like this
+            pass
+        else:
+            # not every SFTP server applies the mode given to mkdir
+            self.sftp.chmod(path, 0o700)
+        self._check(path, self.sftp.lstat(path), stat.S_ISDIR, private=True)
 
-            # To capture Data. Need to read the entire buffer to caputure output
+    def _check(self, path, attributes, is_type, private=False):
+        if not is_type(attributes.st_mode):
+            raise UnsafeRemoteFileError("{} on the master node is not a {}".format(
+                path, 'directory' if is_type is stat.S_ISDIR else 'regular file'))
+        if attributes.st_uid != self.uid:
+            raise UnsafeRemoteFileError("{} on the master node belongs to another user (uid {})".format(
+                path, attributes.st_uid))
+        if private and stat.S_IMODE(attributes.st_mode) & 0o077:
+            raise UnsafeRemoteFileError("{} on the master node is accessible to other users (mode {:o}), it should "
+                                        "only be accessible to you".format(path, stat.S_IMODE(attributes.st_mode)))
 
-            contents = StringIO.StringIO()
-            error = StringIO.StringIO()
+    def _listdir_attr(self, path):
+        try:
+            return self.sftp.listdir_attr(path)
+        except IOError:
+            return []
 
-            while not chan.exit_status_ready():
 
-                if chan.recv_ready():
-                    data = chan.recv(1024)
-                    # print "Indside stdout"
-                    while data:
-                        contents.write(data)
-                        data = chan.recv(1024)
+class MasterNodeSSHClient(object):
+    """
+    Runs commands and copies files over SSH. By default the connection is shared with all other clients for the same
+    host in this process (see SSHConnectionRegistry) and stays open after close(), so subsequent operations skip the
+    SSH handshake. Pass shared=False for a private connection that close() shuts down.
+    """
 
-                if chan.recv_stderr_ready():
+    def __init__(self, host, username=None, ssh_key=None, shared=True):
+        config = Config.load_default()
+        self.host = host
+        self.username = username or config.ssh.username
+        self.ssh_key = ssh_key or config.ssh.key_path
+        self.shared = shared
+        self._sftp = None
+        self._registry = get_ssh_registry() if shared else SSHConnectionRegistry(keepalive=config.ssh.keepalive)
+        # connect right away, so connection errors surface here
+        self._registry.get(self.host, self.username, self.ssh_key)
 
-                    error_buff = chan.recv_stderr(1024)
-                    while error_buff:
-                        error.write(error_buff)
-                        error_buff = chan.recv_stderr(1024)
+    @property
+    def ssh_client(self):
+        return self._registry.get(self.host, self.username, self.ssh_key)
 
-            exit_status = chan.recv_exit_status()
+    def sftp(self):
+        """Returns the SFTP session of this client, which is opened once and reused for all file operations."""
+        transport = self.ssh_client.get_transport()
+        if self._sftp is None or self._sftp.get_channel().get_transport() is not transport or \
+                self._sftp.get_channel().closed:
+            self._sftp = SFTPClient.from_transport(transport)
+        return self._sftp
 
-        except socket.timeout:
-            raise socket.timeout
+    def upload(self, paths, prefix=''):
+        """
+        Uploads local files to a new directory on the master node, skipping files that were uploaded before (see
+        RemoteFileStore), and removes stale uploads. Returns the path of the directory.
+        """
+        config = Config.load_default()
+        remote_dir = config.ssh.remote_dir or DEFAULT_REMOTE_DIR
+        with span('ssh.upload'):
+            store = RemoteFileStore(self.sftp(), remote_dir, config.ssh.remote_dir_max_age)
+            run_dir = store.upload(paths, prefix)
+            store.clean()
+        return run_dir
 
-        out = contents.getvalue()
-        err = error.getvalue()
+    def _open_session(self):
+        try:
+            return self.ssh_client.get_transport().open_session(window_size=COMMAND_WINDOW_SIZE)
+        except (SSHException, socket.error, EOFError):
+            # the connection dropped after it was last checked, so try once more on a new one
+            self._registry.discard(self.host, self.username, self.ssh_key)
+            return self.ssh_client.get_transport().open_session(window_size=COMMAND_WINDOW_SIZE)
 
-        return out, err, exit_status
+    def _send_command_and_wait(self, cmd, on_stdout=None, on_stderr=None, log_file=None, tail_lines=TAIL_LINES):
+        """
+        Runs a command and waits for it to finish. Lines of stdout and stderr are passed to on_stdout and on_stderr as
+        they arrive, and all output is appended to log_file when given. Returns a tuple with the last tail_lines lines
+        of stdout and of stderr, and the exit status.
+        """
+        log = open(log_file, 'ab') if log_file else None
+        stdout = OutputStream(on_stdout, log, tail_lines)
+        stderr = OutputStream(on_stderr, log, tail_lines)
+        chan = self._open_session()
+        try:
+            with span('ssh.command'):
+                chan.exec_command(cmd)
+                exit_status = wait_for_command(chan, stdout, stderr)
+        finally:
+            chan.close()
+            if log:
+                log.close()
+        return stdout.getvalue(), stderr.getvalue(), exit_status
 
     def test(self):
         output = self._send_command_and_wait('echo "ssh connection successful"')
         self.print_output(output)
 
     def copy(self, src, dst):
-        scp = SFTPClient.from_transport(self.ssh_client.get_transport())
-        scp.put(src, dst)
+        self.sftp().put(src, dst)
 
     def create_tmp_dir(self, prefix=''):
-        scp = SFTPClient.from_transport(self.ssh_client.get_transport())
         dirpath = path_join('/tmp', prefix + str(int(time.time() * 1000)))
-        scp.mkdir(dirpath)
+        self.sftp().mkdir(dirpath)
         return dirpath
 
-    def dist_copy(self, src, dest):
-        cmd = 'sudo -u hdfs hadoop distcp {} {}'.format(src, dest)
-        return self._send_command_and_wait(cmd)
+    def dist_copy(self, src, dest, maps=None, bandwidth=None, **output_options):
+        return self._send_command_and_wait(distcp_command(src, dest, maps, bandwidth), **output_options)
 
-    def run_pig_script(self, pig_script, support_scripts=[]):
-        tmp_dir = self.create_tmp_dir('pig_scripts')
+    def hdfs_is_dir(self, path):
+        return self._send_command_and_wait('sudo -u hdfs hdfs dfs -test -d {}'.format(quote(path)))[2] == 0
 
-        def copy_script(full_path):
-            filename = os.path.basename(full_path)
-            dest = path_join(tmp_dir, filename)
-            self.copy(full_path, dest)
+    def hdfs_mkdir(self, path):
+        return self._send_command_and_wait('sudo -u hdfs hdfs dfs -mkdir -p {}'.format(quote(path)))
 
-        copy_script(pig_script)
-        for script in support_scripts:
-            copy_script(script)
+    def run_pig_script(self, pig_script, support_scripts=[], **output_options):
+        tmp_dir = self.upload([pig_script] + list(support_scripts), 'pig_scripts')
         cmd = 'cd {} && pig {}'.format(tmp_dir, os.path.basename(pig_script))
-        return self._send_command_and_wait(cmd)
+        return self._send_command_and_wait(cmd, **output_options)
 
-    def run_impala_script(self, impala_script):
-        filename = os.path.basename(impala_script)
-        dest = path_join(self.create_tmp_dir('impala_scripts'), filename)
-        self.copy(impala_script, dest)
+    def run_impala_script(self, impala_script, **output_options):
+        dest = path_join(self.upload([impala_script], 'impala_scripts'), os.path.basename(impala_script))
         cmd = 'impala-shell -i {} -f {}'.format(get_dns(slave=True), dest)
-        return self._send_command_and_wait(cmd)
+        return self._send_command_and_wait(cmd, **output_options)
 
-    def fix_hdfs_permissions(self, hdfs_dir):
-        return self._send_command_and_wait('sudo -u hdfs hdfs dfs -chmod -R 777 {}'.format(hdfs_dir))
+    def fix_hdfs_permissions(self, *hdfs_paths):
+        return self._send_command_and_wait('sudo -u hdfs hdfs dfs -chmod -R 777 {}'.format(
+            ' '.join(quote(path) for path in hdfs_paths)))
 
     @staticmethod
     def print_output(output_tuple):
@@ -118,4 +486,8 @@ class MasterNodeSSHClient():
             print line
 
     def close(self):
-        self.ssh_client.close()
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        if not self.shared:
+            self._registry.close()
@@ -1,81 +1,571 @@
+from __future__ import print_function
+import errno
 import select
-import SocketServer
+import socket
+import struct
 import sys
+import threading
+import time
+from Queue import Queue, Empty
+from collections import deque
 
 from athena.utils.cluster import get_dns
 from athena.utils.ssh import MasterNodeSSHClient
 
+BUFFER_SIZE = 256 * 1024
+# largest chunk handed to a channel at once; paramiko sends at most one packet per call anyway
+CHANNEL_CHUNK_SIZE = 32 * 1024
+# channels cannot be selected for writing, so while one has a full window it is retried at this interval
+CHANNEL_RETRY_INTERVAL = 0.005
+# how often the loop checks whether it should stop, when there is nothing else to do
+STOP_CHECK_INTERVAL = 0.5
+RECENT_CONNECTIONS = 100
+# the SOCKS proxy connects anyone to any host the SSH server can reach, so by default it only accepts local connections
+SOCKS_BIND_ADDRESS = '127.0.0.1'
 
-class ForwardServer(SocketServer.ThreadingTCPServer):
-    daemon_threads = True
-    allow_reuse_address = True
 
+class Pipe(object):
+    """
+    One direction of a forwarded connection: reads from `src` and writes to `dst`. Data read from a socket goes into a
+    buffer that is reused for every read. Nothing new is read until everything read before was written, so a slow
+    destination holds back its source instead of making buffers grow.
+    """
 
-class Handler(SocketServer.BaseRequestHandler):
-    def handle(self):
+    def __init__(self, src, dst, buffer_size=BUFFER_SIZE):
+        self.src = src
+        self.dst = dst
+        self.buffer_size = buffer_size
+        self.to_channel = not isinstance(dst, socket.socket)
+        self._buffer = bytearray(buffer_size) if self.to_channel else None
+        self._data = ''
+        self._start = self._end = 0
+        self.bytes = 0
+        self.eof = False
+        self.closed = False
+
+    @property
+    def pending(self):
+        return self._start < self._end
+
+    def read(self):
         try:
-            chan = self.ssh_transport.open_channel('direct-tcpip',
-                                                   (self.chain_host, self.chain_port),
-                                                   self.request.getpeername())
-        except Exception as e:
-            print('Incoming request to {}:{} failed: {}'.format(self.chain_host,
-                                                                self.chain_port,
-                                                                repr(e)))
+            if self._buffer is not None:
+                n = self.src.recv_into(self._buffer)
+                self._data = self._buffer
+            else:
+                self._data = self.src.recv(self.buffer_size)
+                n = len(self._data)
+        except socket.timeout:
+            # nothing to read from the channel after all
             return
-        if chan is None:
-            print('Incoming request to {}:{} was rejected by the SSH server.'.format(self.chain_host, self.chain_port))
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self._start, self._end = 0, n
+        if not n:
+            self.eof = True
+
+    def push(self, data):
+        """Makes data that was already read from src pending for dst."""
+        self._data = data
+        self._start, self._end = 0, len(data)
+
+    def write(self):
+        """Writes as much of the pending data as dst accepts without blocking. Returns the number of bytes written."""
+        written = 0
+        while self.pending:
+            size = min(self._end - self._start, CHANNEL_CHUNK_SIZE if self.to_channel else self.buffer_size)
+            try:
+                n = self.dst.send(buffer(self._data, self._start, size))
+            except socket.timeout:
+                # the window of the channel is full
+                break
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not n:
+                raise socket.error(errno.EPIPE, 'Channel closed by the SSH server')
+            self._start += n
+            written += n
+        self.bytes += written
+        return written
+
+    def finish(self):
+        """Passes on the end of the data stream to dst, once everything has been written."""
+        if self.eof and not self.pending and not self.closed:
+            self.closed = True
+            try:
+                if self.to_channel:
+                    self.dst.shutdown_write()
+                else:
+                    self.dst.shutdown(socket.SHUT_WR)
+            except (socket.error, EOFError):
+                pass
+
+
+class ForwardedConnection(object):
+    """A local connection forwarded over an SSH channel, with its byte counts and latencies."""
+
+    def __init__(self, sock, chan, peer, destination, connect_time, buffer_size=BUFFER_SIZE):
+        self.sock = sock
+        self.chan = chan
+        self.peer = peer
+        self.destination = destination
+        self.connect_time = connect_time
+        self.opened = time.time()
+        self.closed = None
+        self.first_response = None
+        self.outgoing = Pipe(sock, chan, buffer_size)
+        self.incoming = Pipe(chan, sock, buffer_size)
+
+    @property
+    def pipes(self):
+        return self.outgoing, self.incoming
+
+    @property
+    def done(self):
+        return self.outgoing.closed and self.incoming.closed
+
+    @property
+    def bytes_sent(self):
+        return self.outgoing.bytes
+
+    @property
+    def bytes_received(self):
+        return self.incoming.bytes
+
+    @property
+    def first_byte_time(self):
+        """Seconds from opening the connection until the first response data arrived."""
+        return self.first_response - self.opened if self.first_response else None
+
+    def close(self):
+        self.closed = time.time()
+        for s in (self.chan, self.sock):
+            try:
+                s.close()
+            except (socket.error, EOFError):
+                pass
+
+    def summary(self):
+        return "{:,} bytes sent, {:,} bytes received in {:.1f}s (channel opened in {:.0f} ms)".format(
+            self.bytes_sent, self.bytes_received, (self.closed or time.time()) - self.opened, self.connect_time * 1000)
+
+
+class SocksHandshake(object):
+    """
+    The SOCKS5 negotiation on a newly accepted connection. Only the CONNECT command without authentication is
+    supported. Data is fed to it as it arrives, until `destination` holds the (host, port) that the client asked for.
+    """
+
+    VERSION = '\x05'
+    NO_AUTHENTICATION = '\x00'
+    NO_ACCEPTABLE_METHODS = '\xff'
+    CONNECT = '\x01'
+    IPV4, DOMAIN, IPV6 = '\x01', '\x03', '\x04'
+    SUCCEEDED = '\x00'
+    HOST_UNREACHABLE = '\x04'
+    COMMAND_NOT_SUPPORTED = '\x07'
+    ADDRESS_TYPE_NOT_SUPPORTED = '\x08'
+
+    def __init__(self, sock, peer):
+        self.sock = sock
+        self.peer = peer
+        self.opened = time.time()
+        self.destination = None
+        # data the client sent after its request, which has to be forwarded
+        self.remainder = ''
+        self._data = ''
+        self._greeted = False
+
+    def feed(self, data):
+        """Processes data from the client. Raises a SocksError when the client asks for something unsupported."""
+        self._data += data
+        if not self._greeted:
+            if len(self._data) < 2 or len(self._data) < 2 + ord(self._data[1]):
+                return
+            version, methods = self._data[0], self._data[2:2 + ord(self._data[1])]
+            self._data = self._data[2 + len(methods):]
+            if version != self.VERSION or self.NO_AUTHENTICATION not in methods:
+                self._send(self.VERSION + self.NO_ACCEPTABLE_METHODS)
+                raise SocksError("unsupported SOCKS version or authentication method")
+            self._send(self.VERSION + self.NO_AUTHENTICATION)
+            self._greeted = True
+
+        if len(self._data) < 5:
+            return
+        version, command, address_type = self._data[0], self._data[1], self._data[3]
+        if version != self.VERSION or command != self.CONNECT:
+            self.reply(self.COMMAND_NOT_SUPPORTED)
+            raise SocksError("only the SOCKS CONNECT command is supported")
+        if address_type == self.IPV4:
+            end = 8
+        elif address_type == self.DOMAIN:
+            end = 5 + ord(self._data[4])
+        elif address_type == self.IPV6:
+            end = 20
+        else:
+            self.reply(self.ADDRESS_TYPE_NOT_SUPPORTED)
+            raise SocksError("unsupported SOCKS address type")
+        if len(self._data) < end + 2:
+            return
+        self.destination = (self._host(address_type, end), struct.unpack('>H', self._data[end:end + 2])[0])
+        self.remainder = self._data[end + 2:]
+        self._data = ''
+
+    def _host(self, address_type, end):
+        if address_type == self.IPV4:
+            return socket.inet_ntoa(self._data[4:end])
+        if address_type == self.IPV6:
+            return socket.inet_ntop(socket.AF_INET6, self._data[4:end])
+        return self._data[5:end]
+
+    def reply(self, status):
+        self._send(self.VERSION + status + '\x00' + self.IPV4 + '\x00' * 6)
+
+    def _send(self, data):
+        # the replies are tiny, so they never have to wait for the socket long
+        self.sock.setblocking(1)
+        try:
+            self.sock.sendall(data)
+        finally:
+            self.sock.setblocking(0)
+
+
+class SocksError(Exception):
+    pass
+
+
+class OpeningChannel(object):
+    """A local connection waiting for its channel to be opened."""
+
+    def __init__(self, sock, peer, destination, started, handshake=None):
+        self.sock = sock
+        self.peer = peer
+        self.destination = destination
+        self.started = started
+        self.handshake = handshake
+
+
+class TunnelForwarder(object):
+    """
+    Forwards connections to local ports over a single SSH transport. Every local port either forwards to a fixed
+    remote host and port, as seen from the SSH server (see add_forward), or is a SOCKS5 proxy that lets clients connect
+    to any host the SSH server can reach (see add_socks). All connections are served by a single event loop, so there
+    is no thread per connection. Only opening a channel happens in a thread of its own, since the SSH server answers
+    that request once it has connected to the destination, which for an unreachable host takes until its connection
+    attempt times out. Keeps byte counts and latencies for the open and the most recently closed connections. With
+    quiet=True nothing is logged per connection.
+    """
+
+    def __init__(self, transport, buffer_size=BUFFER_SIZE, quiet=False, log=print):
+        self.transport = transport
+        self.buffer_size = buffer_size
+        self.quiet = quiet
+        self.log = log
+        self.listeners = {}
+        self.handshakes = []
+        self.opening = []
+        self.connections = []
+        self.recent = deque(maxlen=RECENT_CONNECTIONS)
+        self.totals = {'connections': 0, 'failed': 0, 'bytes_sent': 0, 'bytes_received': 0}
+        self._stopped = False
+        # channels opened by the threads, which wake up the loop by writing to _wakeup
+        self._opened = Queue()
+        self._waker, self._wakeup = socket.socketpair()
+        self._waker.setblocking(0)
+
+    def add_forward(self, local_port, remote_host, remote_port, bind_address=''):
+        """Forwards local_port to remote_host:remote_port. Returns the local port, which is useful for port 0."""
+        return self._listen(bind_address, local_port, (remote_host, remote_port))
+
+    def add_socks(self, local_port, bind_address=SOCKS_BIND_ADDRESS):
+        """
+        Runs a SOCKS5 proxy on local_port, which only accepts connections from this machine unless another
+        bind_address is given. Returns the local port, which is useful for port 0.
+        """
+        return self._listen(bind_address, local_port, None)
+
+    def serve_forever(self):
+        try:
+            while not self._stopped:
+                self.poll()
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stopped = True
+
+    def poll(self, timeout=STOP_CHECK_INTERVAL):
+        """Waits for at most `timeout` seconds for something to happen, and handles it."""
+        readers = self.listeners.keys() + [handshake.sock for handshake in self.handshakes] + [self._waker]
+        writers = []
+        for conn in self.connections:
+            for pipe in conn.pipes:
+                if pipe.pending:
+                    if pipe.to_channel:
+                        timeout = min(timeout, CHANNEL_RETRY_INTERVAL)
+                    else:
+                        writers.append(pipe.dst)
+                elif not pipe.eof:
+                    readers.append(pipe.src)
+
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        readable, writable = set(readable), set(writable)
+        for server in readable.intersection(self.listeners):
+            self._accept(server)
+        for handshake in list(self.handshakes):
+            if handshake.sock in readable:
+                self._negotiate(handshake)
+        if self._waker in readable:
+            self._wake()
+
+        for conn in list(self.connections):
+            try:
+                for pipe in conn.pipes:
+                    if pipe.src in readable and not pipe.pending:
+                        pipe.read()
+                        if pipe is conn.incoming and conn.first_response is None and pipe.pending:
+                            conn.first_response = time.time()
+                    if pipe.pending and (pipe.to_channel or pipe.dst in writable or pipe.src in readable):
+                        pipe.write()
+                    pipe.finish()
+            except (socket.error, EOFError) as e:
+                self._close(conn, e)
+            else:
+                if conn.done:
+                    self._close(conn)
+
+    def stats(self):
+        totals = dict(self.totals)
+        totals['open'] = len(self.connections)
+        for conn in self.connections:
+            totals['bytes_sent'] += conn.bytes_sent
+            totals['bytes_received'] += conn.bytes_received
+        return totals
+
+    def close(self):
+        for conn in list(self.connections):
+            self._close(conn)
+        for handshake in self.handshakes:
+            handshake.sock.close()
+        self.handshakes = []
+        for opening in self.opening:
+            opening.sock.close()
+        self.opening = []
+        self._drain_opened()
+        self._waker.close()
+        self._wakeup.close()
+        for server in self.listeners:
+            server.close()
+        self.listeners = {}
+
+    def _listen(self, bind_address, local_port, destination):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((bind_address, local_port))
+        server.listen(128)
+        server.setblocking(0)
+        self.listeners[server] = destination
+        return server.getsockname()[1]
+
+    def _accept(self, server):
+        while True:
+            try:
+                sock, peer = server.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            destination = self.listeners[server]
+            if destination is None:
+                self.handshakes.append(SocksHandshake(sock, peer))
+            else:
+                self._connect(sock, peer, destination, time.time())
+
+    def _negotiate(self, handshake):
+        try:
+            data = handshake.sock.recv(4096)
+            if not data:
+                raise SocksError("client closed the connection")
+            handshake.feed(data)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            error = e
+        except SocksError as e:
+            error = e
+        else:
+            if handshake.destination is None:
+                return
+            error = None
+
+        self.handshakes.remove(handshake)
+        if error is not None:
+            self.totals['failed'] += 1
+            self.log('SOCKS request from {} failed: {}'.format(handshake.peer, error))
+            handshake.sock.close()
             return
+        self._connect(handshake.sock, handshake.peer, handshake.destination, handshake.opened, handshake)
+
+    def _connect(self, sock, peer, destination, started, handshake=None):
+        """Opens a channel to the destination in a thread, see _opened for what happens when it is open."""
+        opening = OpeningChannel(sock, peer, destination, started, handshake)
+        self.opening.append(opening)
+        thread = threading.Thread(target=self._open_channel, args=(opening,))
+        thread.daemon = True
+        thread.start()
 
-        print('Connected!  Tunnel open {} -> {} -> {}'.format(self.request.getpeername(),
-                                                              chan.getpeername(), (self.chain_host, self.chain_port)))
+    def _open_channel(self, opening):
+        try:
+            chan = self.transport.open_channel('direct-tcpip', opening.destination, opening.peer)
+        except Exception as e:
+            chan = None
+            reason = repr(e)
+        else:
+            reason = 'rejected by the SSH server'
+        self._opened.put((opening, chan, reason))
+        try:
+            self._wakeup.send('x')
+        except socket.error:
+            # the forwarder was closed, or the loop has plenty of wake ups pending already
+            pass
+
+    def _wake(self):
+        try:
+            while self._waker.recv(4096):
+                pass
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
         while True:
-            r, w, x = select.select([self.request, chan], [], [])
-            if self.request in r:
-                data = self.request.recv(1024)
-                if len(data) == 0:
-                    break
-                chan.send(data)
-            if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
+            try:
+                opening, chan, reason = self._opened.get_nowait()
+            except Empty:
+                return
+            if opening in self.opening:
+                self.opening.remove(opening)
+                self._opened_channel(opening, chan, reason)
+            elif chan is not None:
+                chan.close()
 
-        peername = self.request.getpeername()
-        chan.close()
-        self.request.close()
-        print('Tunnel closed from %r' % (peername,))
+    def _drain_opened(self):
+        while True:
+            try:
+                _, chan, _ = self._opened.get_nowait()
+            except Empty:
+                return
+            if chan is not None:
+                chan.close()
+
+    def _opened_channel(self, opening, chan, reason):
+        """Starts forwarding the socket over the channel, or tells the client that it could not be opened."""
+        sock, peer, destination, handshake = opening.sock, opening.peer, opening.destination, opening.handshake
+        if chan is None:
+            self.totals['failed'] += 1
+            self.log('Incoming request to {}:{} failed: {}'.format(destination[0], destination[1], reason))
+            if handshake is not None:
+                try:
+                    handshake.reply(SocksHandshake.HOST_UNREACHABLE)
+                except socket.error:
+                    pass
+            sock.close()
+            return None
+
+        chan.settimeout(0.0)
+        conn = ForwardedConnection(sock, chan, peer, destination, time.time() - opening.started, self.buffer_size)
+        self.connections.append(conn)
+        self.totals['connections'] += 1
+        if handshake is not None:
+            try:
+                handshake.reply(SocksHandshake.SUCCEEDED)
+            except socket.error as e:
+                self._close(conn, e)
+                return None
+            if handshake.remainder:
+                conn.outgoing.push(handshake.remainder)
+        if not self.quiet:
+            self.log('Connected!  Tunnel open {} -> {}:{}'.format(peer, destination[0], destination[1]))
+        return conn
 
+    def _close(self, conn, error=None):
+        conn.close()
+        self.connections.remove(conn)
+        self.recent.append(conn)
+        self.totals['bytes_sent'] += conn.bytes_sent
+        self.totals['bytes_received'] += conn.bytes_received
+        if not self.quiet:
+            self.log('Tunnel closed from {} to {}:{}{}: {}'.format(
+                conn.peer, conn.destination[0], conn.destination[1], ' ({})'.format(error) if error else '',
+                conn.summary()))
 
-def forward_tunnel(local_port, remote_host, remote_port, transport):
-    # this is a little convoluted, but lets me configure things for the Handler
-    # object.  (SocketServer doesn't give Handlers any way to access the outer
-    # server normally.)
-    class SubHander(Handler):
-        chain_host = remote_host
-        chain_port = remote_port
-        ssh_transport = transport
 
-    ForwardServer(('', local_port), SubHander).serve_forever()
+def parse_forward_spec(spec):
+    """
+    Parses a port forwarding in the format of ssh -L: [bind_address:]port:host:hostport. Returns a tuple
+    (bind_address, port, host, hostport), with an empty bind address when none was given.
+    """
+    parts = spec.split(':')
+    if len(parts) == 3:
+        parts.insert(0, '')
+    if len(parts) != 4:
+        raise ValueError("Invalid port forwarding '{}', should be [bind_address:]port:host:hostport".format(spec))
+    bind_address, port, host, host_port = parts
+    try:
+        return bind_address, int(port), host, int(host_port)
+    except ValueError:
+        raise ValueError("Invalid port forwarding '{}', ports should be numbers".format(spec))
+
+
+def parse_socks_spec(spec):
+    """
+    Parses the address of a SOCKS proxy in the format [bind_address:]port. Returns a tuple (bind_address, port), with
+    SOCKS_BIND_ADDRESS when no bind address was given.
+    """
+    bind_address, _, port = spec.rpartition(':')
+    try:
+        return bind_address or SOCKS_BIND_ADDRESS, int(port)
+    except ValueError:
+        raise ValueError("Invalid SOCKS proxy address '{}', should be [bind_address:]port".format(spec))
 
 
-def create_tunnel(local_port, remote_port, slave=False):
+def create_tunnel(local_port=None, remote_port=None, slave=False, quiet=False, forwards=(), socks=None):
+    """
+    Creates SSH tunnels over a single connection to the master node: from local_port to remote_port on the master or a
+    slave node, for every (bind_address, port, host, hostport) in `forwards`, and a SOCKS5 proxy on `socks`, a tuple
+    (bind_address, port).
+    """
     client = None
 
-    remote_host = get_dns(slave=slave)
+    if local_port is not None:
+        forwards = [('', local_port, get_dns(slave=slave), remote_port)] + list(forwards)
 
-    print('Connecting to ssh host {}:{} ...'.format(remote_host, remote_port))
+    master = get_dns()
+    print('Connecting to ssh host {} ...'.format(master))
     try:
-        client = MasterNodeSSHClient(get_dns()).ssh_client
+        client = MasterNodeSSHClient(master).ssh_client
     except Exception as e:
-        print e
-        print('*** Failed to connect to {}:{}: {}'.format(remote_host, remote_port, e))
+        print(e)
+        print('*** Failed to connect to {}: {}'.format(master, e))
         sys.exit(1)
 
-    print('Now forwarding port {} to {}:{} ...'.format(local_port, remote_host, remote_port))
+    forwarder = TunnelForwarder(client.get_transport(), quiet=quiet)
+    for bind_address, port, host, host_port in forwards:
+        forwarder.add_forward(port, host, host_port, bind_address)
+        print('Now forwarding port {} to {}:{} ...'.format(port, host, host_port))
+    if socks is not None:
+        bind_address, port = socks
+        forwarder.add_socks(port, bind_address)
+        print('Now accepting SOCKS5 connections to any cluster node on {}:{} ...'.format(bind_address or '*', port))
 
     try:
-        forward_tunnel(local_port, remote_host, remote_port, client.get_transport())
+        forwarder.serve_forever()
     except KeyboardInterrupt:
-        print('C-c: Port forwarding stopped.')
+        stats = forwarder.stats()
+        print('C-c: Port forwarding stopped after {:,} connections, {:,} bytes sent and {:,} bytes received.'.format(
+            stats['connections'], stats['bytes_sent'], stats['bytes_received']))
         sys.exit(0)
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark for athena.utils.config: attribute access on a Config tree, and the cost of Config.load_default() with
+a cold and a warm cache. Run with `python benchmarks/bench_config.py` from an environment where athena is installed
+(e.g. with `pip install -e .`).
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import timeit
+
+CONFIG_YML = """
+cluster:
+  master: master.example.com
+  slaves: [10.0.0.0/24, slave1.example.com, slave2.example.com]
+ssh:
+  username: hadoop
+mailing:
+  smtp_host: smtp.example.com
+"""
+
+
+class LegacyConfig(object):
+    """The Config implementation before values were normalized at load time, kept for comparison."""
+
+    def __init__(self, config_dict):
+        for k, v in config_dict.iteritems():
+            if isinstance(v, (list, tuple)):
+                setattr(self, k, [LegacyConfig(x) if isinstance(x, dict) else x for x in v])
+            else:
+                setattr(self, k, LegacyConfig(v) if isinstance(v, dict) else v)
+
+    def __getattribute__(self, name):
+        val = object.__getattribute__(self, name)
+        if isinstance(val, basestring):
+            return val.strip()
+        elif isinstance(val, (list, tuple)):
+            return [x.strip() for x in val]
+        else:
+            return val
+
+
+def report(name, seconds, number):
+    print('{:<40} {:>10.3f} us/call'.format(name, seconds / number * 1e6))
+
+
+def main(number=100000):
+    home = tempfile.mkdtemp()
+    os.environ['HOME'] = home
+    try:
+        from athena.utils.config import Config, ConfigDir
+        import yaml
+        ConfigDir().write('config.yml', CONFIG_YML)
+        values = yaml.safe_load(CONFIG_YML)
+
+        legacy = LegacyConfig(values)
+        config = Config(values)
+        report('legacy attribute access (string)', timeit.timeit(lambda: legacy.cluster.master, number=number), number)
+        report('attribute access (string)', timeit.timeit(lambda: config.cluster.master, number=number), number)
+        report('legacy attribute access (list)', timeit.timeit(lambda: legacy.cluster.slaves, number=number), number)
+        report('attribute access (list)', timeit.timeit(lambda: config.cluster.slaves, number=number), number)
+
+        load_number = number // 100
+
+        def cold_load():
+            Config.clear_cache()
+            return Config.load_default()
+
+        report('load_default (cold cache)', timeit.timeit(cold_load, number=load_number), load_number)
+        report('load_default (warm cache)', timeit.timeit(Config.load_default, number=number), number)
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
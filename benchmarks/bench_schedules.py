@@ -0,0 +1,72 @@
+"""
+Benchmark for athena.scheduling.schedules.ScheduleRegistry: the time it takes to load the schedules of a directory with
+many report definitions, and to reload them when nothing or a single file changed, compared with parsing all files
+again as the schedulers did before. Run with `python benchmarks/bench_schedules.py` from an environment where athena is
+installed (e.g. with `pip install -e .`).
+"""
+from __future__ import print_function
+
+import shutil
+import tempfile
+import time
+
+from athena.scheduling.schedules import ScheduleRegistry
+from athena.utils.config import ConfigDir
+
+REPORT = """title: Report {number}
+description: A report with a few queries, like the ones in the reports directory
+recipients: data@example.com
+schedule:
+  minute: {minute}
+  hour: 7
+  day_of_week: mon-fri
+data:
+  inline:
+    - name: Totals
+      type: sql
+      query: SELECT COUNT(*) FROM events WHERE day = '{{{{ today }}}}'
+  csv:
+    - filename: details_{{{{ item }}}}.csv
+      type: sql
+      query: SELECT * FROM events WHERE country = '{{{{ item }}}}'
+      with_items: [nl, be, de]
+"""
+
+
+def timed(func, number):
+    start = time.time()
+    for _ in range(number):
+        func()
+    return (time.time() - start) / number * 1000
+
+
+def main(reports=500, number=20):
+    directory = tempfile.mkdtemp()
+    try:
+        config_dir = ConfigDir(directory)
+        for i in range(reports):
+            config_dir.write('report_{}.yml'.format(i), REPORT.format(number=i, minute=i % 60))
+
+        def full_parse():
+            registry = ScheduleRegistry(config_dir)
+            registry.refresh()
+            registry.schedules()
+
+        registry = ScheduleRegistry(config_dir)
+        registry.refresh()
+        changes = iter(range(number))
+
+        def change_one():
+            config_dir.write('report_0.yml', REPORT.format(number=0, minute=next(changes)))
+            registry.refresh()
+            registry.schedules()
+
+        print('{:<28} {:8.2f} ms'.format('parse all {} reports'.format(reports), timed(full_parse, 3)))
+        print('{:<28} {:8.2f} ms'.format('reload, nothing changed', timed(registry.refresh, number)))
+        print('{:<28} {:8.2f} ms'.format('reload, one report changed', timed(change_one, number)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
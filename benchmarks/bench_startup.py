@@ -0,0 +1,47 @@
+"""
+Benchmark for the startup time of the athena command: the time `athena --help` and `athena url` take, as separate
+processes, compared with starting the bare interpreter. Each command gets a temporary home directory with a minimal
+configuration, so no cluster is needed. Run with `python benchmarks/bench_startup.py` from an environment where athena
+is installed (e.g. with `pip install -e .`).
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+COMMANDS = [
+    ('python', ['-c', 'pass']),
+    ('athena --help', ['-c', 'from athena.cli import main; main()', '--help']),
+    ('athena url', ['-c', 'from athena.cli import main; main()', 'url']),
+]
+
+
+def timed(args, env, number):
+    with open(os.devnull, 'w') as devnull:
+        timings = []
+        for _ in range(number):
+            start = time.time()
+            subprocess.check_call([sys.executable] + args, env=env, stdout=devnull)
+            timings.append(time.time() - start)
+    return min(timings) * 1000, sum(timings) / number * 1000
+
+
+def main(number=20):
+    home = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(home, '.athena'))
+        with open(os.path.join(home, '.athena', 'config.yml'), 'w') as f:
+            f.write("cluster:\n  master: master\n  slaves: slave\n")
+        env = dict(os.environ, HOME=home)
+        for name, args in COMMANDS:
+            print('{:<16} {:8.1f} ms min {:8.1f} ms mean'.format(name, *timed(args, env, number)))
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
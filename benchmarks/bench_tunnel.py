@@ -0,0 +1,143 @@
+"""
+Benchmark for athena.utils.tunnel: throughput and round-trip latency of port forwarding over SSH, for the event loop
+based TunnelForwarder and the thread-per-connection forwarder it replaced. Both forward over the same SSH connection to
+an in-process paramiko server, which streams data for downloads and echoes everything else, so no cluster is needed.
+Encryption in paramiko takes a large part of the time, which is the same for both forwarders. Run with
+`python benchmarks/bench_tunnel.py` from an environment where athena is installed (e.g. with `pip install -e .`).
+"""
+from __future__ import print_function
+
+import logging
+import select
+import socket
+import SocketServer
+import struct
+import threading
+import time
+
+from athena.utils.tunnel import TunnelForwarder
+from standins import start_ssh_server
+
+DOWNLOAD = 'D'
+ECHO = 'E'
+CHUNK = 'x' * (256 * 1024)
+
+
+def recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def serve_channel(chan):
+    """Reads a command from the channel: a download of a number of bytes, or echoing until the channel closes."""
+    command = recv_exactly(chan, 9)
+    if command[0] == DOWNLOAD:
+        remaining = struct.unpack('>Q', command[1:])[0]
+        while remaining > 0:
+            remaining -= chan.send(CHUNK[:min(remaining, len(CHUNK))])
+    else:
+        while True:
+            data = chan.recv(65536)
+            if not data:
+                break
+            chan.sendall(data)
+    chan.close()
+
+
+def start_legacy_forwarder(transport):
+    """The forwarder before the event loop: a thread per connection, copying 1 KB at a time. Kept for comparison."""
+
+    class Handler(SocketServer.BaseRequestHandler):
+        def handle(self):
+            chan = transport.open_channel('direct-tcpip', ('localhost', 0), self.request.getpeername())
+            while True:
+                r, w, x = select.select([self.request, chan], [], [])
+                if self.request in r:
+                    data = self.request.recv(1024)
+                    if len(data) == 0:
+                        break
+                    chan.send(data)
+                if chan in r:
+                    data = chan.recv(1024)
+                    if len(data) == 0:
+                        break
+                    self.request.send(data)
+            chan.close()
+            self.request.close()
+
+    class ForwardServer(SocketServer.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = ForwardServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1], server.shutdown
+
+
+def start_forwarder(transport):
+    forwarder = TunnelForwarder(transport, quiet=True)
+    port = forwarder.add_forward(0, 'localhost', 0, bind_address='127.0.0.1')
+    thread = threading.Thread(target=forwarder.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return port, forwarder.stop
+
+
+def download(port, size):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(DOWNLOAD + struct.pack('>Q', size))
+    received = 0
+    while received < size:
+        data = sock.recv(1024 * 1024)
+        if not data:
+            break
+        received += len(data)
+    sock.close()
+    return received
+
+
+def round_trips(port, number):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(ECHO + '\0' * 8)
+    for _ in range(number):
+        sock.sendall('ping')
+        recv_exactly(sock, 4)
+    sock.close()
+
+
+def report(name, port, size, number):
+    start = time.time()
+    received = download(port, size)
+    elapsed = time.time() - start
+    print('{:<28} {:8.1f} MB/s'.format(name + ' download', received / elapsed / (1024 * 1024)))
+
+    start = time.time()
+    round_trips(port, number)
+    print('{:<28} {:8.3f} ms/round trip'.format(name + ' echo', (time.time() - start) / number * 1000))
+
+
+def main(size=64 * 1024 * 1024, number=1000):
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    client = start_ssh_server(serve_channel)
+    transport = client.get_transport()
+    try:
+        for name, start in (('legacy', start_legacy_forwarder), ('event loop', start_forwarder)):
+            port, stop = start(transport)
+            try:
+                report(name, port, size, number)
+            finally:
+                stop()
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Local stand-ins for the services athena talks to, so the benchmarks run without a cluster: a DB-API module in place of
+impyla, an in-process paramiko SSH server, an SMTP server that keeps the messages it receives and an HTTP server that
+answers like the Slack API, which is shared with the tests. Every stand-in listens on 127.0.0.1 on a free port.
+"""
+import asyncore
+import os
+import shutil
+import smtpd
+import socket
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from itertools import cycle, islice
+
+import paramiko
+import yaml
+
+from athena.queries import pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+from slack_mock import SlackMock  # noqa
+
+DESCRIPTION = [('id', 'INT', None, None, None, None, None), ('name', 'STRING', None, None, None, None, None),
+               ('amount', 'DOUBLE', None, None, None, None, None), ('country', 'STRING', None, None, None, None, None)]
+ROWS = [(i, u'customer {}'.format(i), i * 1.25, (u'nl', u'be', u'de')[i % 3]) for i in range(1000)]
+
+
+class FakeImpala(object):
+    """
+    DB-API stand-in for impyla. Every query returns `rows` rows with the columns in DESCRIPTION, executing takes
+    `latency` seconds and fetching a batch of rows `fetch_latency` seconds. The SQL of every query is kept in
+    `queries`.
+    """
+
+    def __init__(self, rows=100000, latency=0.0, fetch_latency=0.0):
+        self.rows = rows
+        self.latency = latency
+        self.fetch_latency = fetch_latency
+        self.queries = []
+        self.connections = 0
+
+    def connect(self, host=None, port=None, **kwargs):
+        self.connections += 1
+        return FakeConnection(self)
+
+
+class FakeConnection(object):
+    def __init__(self, impala):
+        self.impala = impala
+
+    def cursor(self):
+        return FakeCursor(self.impala)
+
+    def close(self):
+        pass
+
+
+class FakeCursor(object):
+    def __init__(self, impala):
+        self.impala = impala
+        self.arraysize = 1
+        self.description = None
+        self._rows = iter(())
+
+    def execute(self, sql, params=None):
+        self.impala.queries.append(sql)
+        time.sleep(self.impala.latency)
+        self.description = DESCRIPTION
+        self._rows = islice(cycle(ROWS), self.impala.rows)
+
+    def fetchmany(self, size=None):
+        time.sleep(self.impala.fetch_latency)
+        return list(islice(self._rows, size or self.arraysize))
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchall(self):
+        time.sleep(self.impala.fetch_latency)
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+
+def use_fake_impala(impala):
+    """Makes athena connect to the given FakeImpala, by replacing its connection pool."""
+    pool.close_pool()
+    pool._pool = pool.ConnectionPool(connect_fn=impala.connect)
+
+
+@contextmanager
+def athena_home(config):
+    """Runs the block with a temporary home directory, holding an athena configuration with the given settings."""
+    home = tempfile.mkdtemp()
+    previous = os.environ.get('HOME')
+    try:
+        os.mkdir(os.path.join(home, '.athena'))
+        with open(os.path.join(home, '.athena', 'config.yml'), 'w') as f:
+            f.write(yaml.safe_dump(config))
+        os.environ['HOME'] = home
+        yield home
+    finally:
+        if previous is None:
+            os.environ.pop('HOME', None)
+        else:
+            os.environ['HOME'] = previous
+        pool.close_pool()
+        shutil.rmtree(home)
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """SMTP server that accepts every message and keeps it in `messages`, as a (from, recipients, data) tuple."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.received = threading.Event()
+        self._thread = threading.Thread(target=asyncore.loop, args=(0.05,))
+        self._thread.daemon = True
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+        self.received.set()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.close()
+        self._thread.join()
+
+
+def use_slack_mock(mock):
+    """Makes the Slack client send its API calls to the given SlackMock."""
+    import slacker
+    slacker.API_BASE_URL = mock.url
+
+
+class StandInSSHServer(paramiko.ServerInterface):
+    """Accepts any password and any channel, including port forwarding requests."""
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        return paramiko.OPEN_SUCCEEDED
+
+
+def start_ssh_server(serve_channel):
+    """
+    Starts an in-process paramiko SSH server on a free port, which calls serve_channel in a thread for every channel
+    that is opened, and returns a paramiko SSHClient connected to it.
+    """
+    key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    def run():
+        sock, _ = listener.accept()
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(key)
+        transport.start_server(server=StandInSSHServer())
+        while transport.is_active():
+            chan = transport.accept(1)
+            if chan is not None:
+                thread = threading.Thread(target=serve_channel, args=(chan,))
+                thread.daemon = True
+                thread.start()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect('127.0.0.1', port=listener.getsockname()[1], username='athena', password='athena',
+                   look_for_keys=False, allow_agent=False)
+    return client
@@ -0,0 +1,248 @@
+"""
+Benchmark suite for athena, running against the local stand-ins in standins.py, so no cluster, SMTP server or Slack
+workspace is needed. It measures:
+
+- query_to_csv: throughput of streaming query results to a CSV file
+- execute_query: the peak memory of writing a result to a file and to the terminal, each in a fresh process
+- mail_report: the end-to-end latency of running the queries of a report and mailing it
+- slack: the latency of broadcasting a table to Slack
+- tunnel: download throughput through `athena tunnel` over SSH
+- startup: the time `athena url` and `athena --help` take to run
+
+Run with `python benchmarks/suite.py --output results.json` from an environment where athena is installed (e.g. with
+`pip install -e .`), and compare two runs, e.g. from two commits, with `python benchmarks/suite.py --compare
+before.json after.json`. Use --only to run some of the benchmarks.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import standins
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SQL = 'SELECT id, name, amount, country FROM customers'
+
+REPORT = {
+    'title': 'Benchmark report',
+    'recipients': 'data@example.com',
+    'data': {
+        'inline': [{'name': 'Block {}'.format(i), 'type': 'sql', 'query': SQL + ' WHERE block = {}'.format(i)}
+                   for i in range(3)],
+        'csv': [{'filename': 'customers_{{ item }}.csv', 'type': 'sql', 'with_items': ['nl', 'be', 'de'],
+                 'query': SQL + " WHERE country = '{{ item }}'"}],
+    }
+}
+
+
+def config(**sections):
+    settings = {'cluster': {'master': '127.0.0.1', 'slaves': '127.0.0.1'}}
+    settings.update(sections)
+    return settings
+
+
+def best_of(number, func):
+    timings = []
+    for _ in range(number):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def bench_query_to_csv(rows=200000):
+    from athena.queries import query_to_csv
+    with standins.athena_home(config()) as home:
+        standins.use_fake_impala(standins.FakeImpala(rows=rows))
+        csv_file = os.path.join(home, 'customers.csv')
+        seconds = best_of(3, lambda: query_to_csv(SQL, csv_file))
+        size = os.path.getsize(csv_file)
+    return {'query_to_csv.rows_per_second': (rows / seconds, 'rows/s', 'higher'),
+            'query_to_csv.mb_per_second': (size / seconds / (1024 * 1024), 'MB/s', 'higher')}
+
+
+def bench_execute_query(rows=100000):
+    results = {}
+    for target in ('file', 'terminal'):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--memory-child', target,
+                                          str(rows)], env=dict(os.environ, PYTHONPATH=ROOT))
+        results['execute_query.{}_peak_mb'.format(target)] = (float(output.splitlines()[-1]), 'MB', 'lower')
+    return results
+
+
+def measure_execute_query_memory(target, rows):
+    """Prints the memory that execute_query adds to the peak memory of this process, in MB."""
+    from athena.queries.query import execute_query
+    with standins.athena_home(config()) as home:
+        standins.use_fake_impala(standins.FakeImpala(rows=rows))
+        before = reset_peak_memory()
+        execute_query(SQL, os.path.join(home, 'customers.csv') if target == 'file' else None)
+        print((peak_memory() - before) / (1024.0 * 1024))
+
+
+def reset_peak_memory():
+    """
+    Resets the peak memory of this process to its current memory where Linux allows it, so the peak after that only
+    reflects what happened since, and returns the current memory in bytes (or the peak when it cannot be reset).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return proc_status('VmRSS')
+    except (IOError, KeyError):
+        return peak_memory()
+
+
+def peak_memory():
+    try:
+        return proc_status('VmHWM')
+    except (IOError, KeyError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # in bytes on macOS, kilobytes elsewhere
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def proc_status(field):
+    """Returns a memory size in bytes from /proc/self/status."""
+    with open('/proc/self/status') as f:
+        values = dict(line.split(':', 1) for line in f)
+    return int(values[field].split()[0]) * 1024
+
+
+def bench_mail_report(latency=0.05):
+    import yaml
+    from athena.broadcasting.mailing import mail_report
+    sink = standins.SMTPSink().start()
+    try:
+        settings = config(mailing={'smtp_host': '127.0.0.1', 'smtp_port': sink.port, 'smtp_use_tls': False})
+        with standins.athena_home(settings) as home:
+            impala = standins.FakeImpala(rows=1000, latency=latency)
+            standins.use_fake_impala(impala)
+            os.mkdir(os.path.join(home, '.athena', 'reports'))
+            with open(os.path.join(home, '.athena', 'reports', 'benchmark.yml'), 'w') as f:
+                f.write(yaml.safe_dump(REPORT))
+            seconds = best_of(5, lambda: mail_report('benchmark.yml'))
+    finally:
+        sink.stop()
+    assert len(sink.messages) == 5, "The SMTP sink received {} of the 5 reports".format(len(sink.messages))
+    return {'mail_report.seconds': (seconds, 's', 'lower'),
+            'mail_report.queries_per_report': (len(impala.queries) / 5.0, 'queries', 'lower')}
+
+
+def bench_slack(rows=50):
+    try:
+        import slacker  # noqa
+    except ImportError:
+        print('Skipping the slack benchmark, as slacker is not installed', file=sys.stderr)
+        return {}
+    from athena.broadcasting import slack
+    mock = standins.SlackMock().start()
+    try:
+        standins.use_slack_mock(mock)
+        with standins.athena_home(config(slack={'token': 'xoxb-benchmark', 'default_channel': 'benchmarks'})):
+            data = standins.ROWS[:rows]
+            headers = [column[0] for column in standins.DESCRIPTION]
+            seconds = best_of(10, lambda: slack.send_table('Benchmark', headers, data, None, None, None))
+    finally:
+        mock.stop()
+    return {'slack.send_table_ms': (seconds * 1000, 'ms', 'lower')}
+
+
+def bench_tunnel(size=32 * 1024 * 1024):
+    import bench_tunnel
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    client = standins.start_ssh_server(bench_tunnel.serve_channel)
+    try:
+        port, stop = bench_tunnel.start_forwarder(client.get_transport())
+        try:
+            seconds = best_of(3, lambda: bench_tunnel.download(port, size))
+        finally:
+            stop()
+    finally:
+        client.close()
+    return {'tunnel.download_mb_per_second': (size / seconds / (1024 * 1024), 'MB/s', 'higher')}
+
+
+def bench_startup(number=10):
+    import bench_startup
+    with standins.athena_home(config()):
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        results = {}
+        for name, args in bench_startup.COMMANDS[1:]:
+            key = 'startup.{}_ms'.format(name.replace('athena ', '').replace('--', '').replace(' ', '_'))
+            results[key] = (bench_startup.timed(args, env, number)[0], 'ms', 'lower')
+    return results
+
+
+BENCHMARKS = [('query_to_csv', bench_query_to_csv), ('execute_query', bench_execute_query),
+              ('mail_report', bench_mail_report), ('slack', bench_slack), ('tunnel', bench_tunnel),
+              ('startup', bench_startup)]
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(only=None):
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if only and name not in only:
+            continue
+        print('Running {}...'.format(name), file=sys.stderr)
+        for key, (value, unit, better) in sorted(benchmark().items()):
+            results[key] = {'value': value, 'unit': unit, 'better': better}
+            print('{:<40} {:12.2f} {}'.format(key, value, unit))
+    return {'commit': git_commit(), 'python': sys.version.split()[0], 'time': datetime.utcnow().isoformat() + 'Z',
+            'results': results}
+
+
+def compare(before, after):
+    """Prints the results of two runs side by side, with the change, marked with ! when it is for the worse."""
+    print('{:<40} {:>12} {:>12}  {:>8}'.format('', (before['commit'] or 'before')[:12],
+                                              (after['commit'] or 'after')[:12], 'change'))
+    for key in sorted(set(before['results']) | set(after['results'])):
+        old, new = before['results'].get(key), after['results'].get(key)
+        if old is None or new is None:
+            print('{:<40} {:>12} {:>12}'.format(key, '-' if old is None else '{:.2f}'.format(old['value']),
+                                                '-' if new is None else '{:.2f}'.format(new['value'])))
+            continue
+        change = (new['value'] - old['value']) / old['value'] if old['value'] else 0
+        worse = change < 0 if new['better'] == 'higher' else change > 0
+        print('{:<40} {:12.2f} {:12.2f}  {:+7.1%}{}'.format(key, old['value'], new['value'], change,
+                                                           ' !' if worse and abs(change) > 0.05 else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', '-o', help='write the results as JSON to this file')
+    parser.add_argument('--only', action='append', choices=[name for name, _ in BENCHMARKS],
+                        help='run only this benchmark, can be repeated')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    parser.add_argument('--memory-child', nargs=2, metavar=('TARGET', 'ROWS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.memory_child:
+        measure_execute_query_memory(args.memory_child[0], int(args.memory_child[1]))
+    elif args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            compare(json.load(before), json.load(after))
+    else:
+        results = run(args.only)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,8 @@ setup(
     extras_require={
         'scheduling': ["celery==3.1.17"],
         'aws': ["boto==2.35.1"],
+        'zstd': ["zstandard==0.13.0"],
+        'columnar': ["pyarrow==0.16.0"],
     },
     entry_points={
         'console_scripts': [
@@ -0,0 +1,60 @@
+"""
+An HTTP server that answers like the Slack API, for the tests and the benchmarks. Point slacker.API_BASE_URL at its
+`url` to use it.
+"""
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from urlparse import urlparse, parse_qs
+
+
+class SlackMock(HTTPServer):
+    """
+    HTTP server that answers every Slack API call with {"ok": true}, and keeps the calls in `calls`, as (api, params,
+    body) tuples. The first `rate_limited` calls are answered with HTTP 429 and a Retry-After of 0 seconds instead, and
+    are not kept.
+    """
+
+    def __init__(self, rate_limited=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SlackHandler)
+        self.port = self.server_address[1]
+        self.url = 'http://127.0.0.1:{}/api/{{api}}'.format(self.port)
+        self.calls = []
+        self.rate_limited = rate_limited
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SlackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.server.rate_limited > 0:
+            self.server.rate_limited -= 1
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        self.server.calls.append((url.path.rsplit('/', 1)[-1], params, body))
+        body = json.dumps({'ok': True, 'ts': str(time.time())})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+
+from athena.queries.cache import ResultCache, RecordingCursor, CachedCursor, normalize_sql
+from athena.utils.config import ConfigDir
+
+DESCRIPTION = [('id', 'INT', None, None, None, None, None), ('name', 'STRING', None, None, None, None, None)]
+
+
+class FakeCursor(object):
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.arraysize = 2
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT *\n  FROM foo -- all of it\n;") == normalize_sql("select * from FOO")
+    assert normalize_sql("SELECT 'A  B' /* x */ FROM foo") == "select 'A  B' from foo"
+    assert normalize_sql("SELECT 'a' FROM foo") != normalize_sql("SELECT 'A' FROM foo")
+
+
+def test_result_cache_put_get(tmpdir):
+    cache = ResultCache(ConfigDir(str(tmpdir)))
+    key = cache.key("SELECT * FROM foo", cluster='standard|master')
+    assert cache.get(key) is None
+    cache.put(key, DESCRIPTION, [(1, u'a'), (2, None)], ttl=60)
+
+    assert cache.get(cache.key("select *  from foo;", cluster='standard|master')) == (
+        DESCRIPTION, [(1, u'a'), (2, None)])
+    assert cache.get(cache.key("SELECT * FROM foo", cluster='standard|other')) is None
+    stats = cache.stats()
+    assert (stats['entries'], stats['hits'], stats['misses']) == (1, 1, 2)
+
+
+def test_result_cache_counts_lookups_from_concurrent_instances(tmpdir):
+    def lookups():
+        # like every query does, through get_result_cache()
+        for _ in range(20):
+            ResultCache(ConfigDir(str(tmpdir))).get('missing')
+
+    threads = [threading.Thread(target=lookups) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert ResultCache(ConfigDir(str(tmpdir))).stats()['misses'] == 160
+
+
+def test_result_cache_entries_expire(tmpdir):
+    cache = ResultCache(ConfigDir(str(tmpdir)))
+    cache.put('expired', DESCRIPTION, [(1, u'a')], ttl=-1)
+    assert cache.get('expired') is None
+
+
+def test_result_cache_evicts_least_recently_used(tmpdir):
+    cache = ResultCache(ConfigDir(str(tmpdir)))
+    rows = [(i, u'name {}'.format(i)) for i in range(100)]
+    cache.put('old', DESCRIPTION, rows, ttl=60)
+    cache.put('used', DESCRIPTION, rows, ttl=60)
+    past = time.time() - 100
+    os.utime(cache._path('old'), (past, past))
+    os.utime(cache._path('used'), (past, past))
+    cache.get('used')
+
+    cache.max_size = os.path.getsize(cache._path('used')) * 2
+    cache.put('new', DESCRIPTION, rows, ttl=60)
+    assert cache.get('old') is None
+    assert cache.get('used') is not None
+    assert cache.get('new') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_recording_cursor():
+    recording = RecordingCursor(FakeCursor([(1,), (2,), (3,)]), max_rows=3)
+    assert recording.fetchmany(2) == [(1,), (2,)]
+    assert not recording.complete
+    assert recording.fetchmany(2) == [(3,)]
+    assert recording.complete
+    assert recording.rows == [(1,), (2,), (3,)]
+
+    recording = RecordingCursor(FakeCursor([(1,), (2,), (3,)]), max_rows=2)
+    recording.fetchmany(2)
+    recording.fetchmany(2)
+    assert not recording.complete
+    assert recording.rows == []
+
+
+def test_cached_cursor():
+    cursor = CachedCursor(DESCRIPTION, [(1, u'a'), (2, u'b'), (3, u'c')])
+    assert cursor.fetchmany(2) == [(1, u'a'), (2, u'b')]
+    assert cursor.fetchall() == [(3, u'c')]
+    assert cursor.fetchone() is None
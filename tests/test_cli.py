@@ -1,7 +1,14 @@
+import json
+import os
+import subprocess
+import sys
+
 import pytest
 from click.testing import CliRunner
 from athena import cli
 
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 
 @pytest.fixture
 def runner():
@@ -13,3 +20,49 @@ def test_main(runner):
     assert result.exit_code == 0
     assert not result.exception
     assert result.output.split('\n')[0].strip() == 'Usage: main [OPTIONS] COMMAND [ARGS]...'
+
+
+# modules that only some commands need, which should not slow down starting the others
+HEAVY_MODULES = ('paramiko', 'impala', 'thrift', 'jinja2', 'mailshake', 'tabulate', 'slugify', 'celery', 'pyarrow',
+                 'requests')
+# seconds that importing the cli and running `athena url` may take, on top of starting the interpreter
+STARTUP_BUDGET = 0.25
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.time()
+from athena.cli import main
+try:
+    main(['url'])
+except SystemExit:
+    pass
+print(json.dumps({'seconds': time.time() - start, 'modules': sorted(sys.modules)}))
+"""
+
+
+def test_startup_does_not_load_heavy_modules(tmpdir):
+    tmpdir.join('.athena', 'config.yml').write("cluster:\n  master: master\n  slaves: slave\n", ensure=True)
+    env = dict(os.environ, HOME=str(tmpdir), PYTHONPATH=ROOT)
+    timings = []
+    for _ in range(3):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], env=env).splitlines()
+        assert output[0] == 'master'
+        result = json.loads(output[-1])
+        timings.append(result['seconds'])
+    loaded = set(module.split('.')[0] for module in result['modules'])
+    assert loaded.isdisjoint(HEAVY_MODULES), sorted(loaded.intersection(HEAVY_MODULES))
+    assert min(timings) < STARTUP_BUDGET
+
+
+def test_profile_and_metrics_json(runner, tmpdir, monkeypatch):
+    tmpdir.join('.athena', 'config.yml').write("cluster:\n  master: master\n  slaves: slave\n", ensure=True)
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setattr('athena.utils.profiling._profiler', None)
+    metrics_file = tmpdir.join('metrics.json')
+    result = runner.invoke(cli.main, ['--profile', '--metrics-json', str(metrics_file), 'url'])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith('master\n')
+    assert 'cluster.discover' in result.output
+    metrics = json.loads(metrics_file.read())
+    assert metrics['command'] == 'url'
+    assert metrics['stages']['cluster.discover']['calls'] == 1
@@ -0,0 +1,90 @@
+from athena.utils import cluster
+from athena.utils.config import ConfigDir
+
+
+class FakeInstance(object):
+    def __init__(self, name, hostname):
+        self.tags = {'Name': name}
+        self.public_dns_name = hostname
+
+
+def test_node_cache_is_persisted(tmpdir):
+    cache = cluster.NodeCache(ConfigDir(str(tmpdir)), ttl=60)
+    cache.update({'master': ['ec2-1.example.com']})
+    assert cluster.NodeCache(ConfigDir(str(tmpdir))).get('master') == ['ec2-1.example.com']
+
+
+def test_node_cache_entries_expire(tmpdir):
+    cache = cluster.NodeCache(ConfigDir(str(tmpdir)), ttl=-1)
+    cache.update({'master': ['ec2-1.example.com']})
+    assert cache.get('master') is None
+
+
+def test_node_cache_invalidate_host(tmpdir):
+    cache = cluster.NodeCache(ConfigDir(str(tmpdir)), ttl=60)
+    cache.update({'master': ['ec2-1.example.com'], 'slave': ['ec2-2.example.com']})
+    assert cache.invalidate_host('ec2-1.example.com')
+    assert not cache.invalidate_host('ec2-1.example.com')
+    assert cache.get('master') is None
+    assert cache.get('slave') == ['ec2-2.example.com']
+
+
+def test_resolve_aws_names_uses_one_lookup_for_missing_names(tmpdir, monkeypatch):
+    cache = cluster.NodeCache(ConfigDir(str(tmpdir)), ttl=60)
+    cache.update({'slave-1': ['ec2-1.example.com']})
+    lookups = []
+
+    def get_instances_by_tags(tags):
+        lookups.append(tags)
+        return [FakeInstance('slave-2', 'ec2-2.example.com'), FakeInstance('slave-3', 'ec2-3.example.com')]
+
+    monkeypatch.setattr(cluster, 'get_node_cache', lambda: cache)
+    monkeypatch.setattr(cluster, 'get_instances_by_tags', get_instances_by_tags)
+
+    assert cluster.resolve_aws_names(['slave-1', 'slave-2', 'slave-3']) == {
+        'slave-1': ['ec2-1.example.com'],
+        'slave-2': ['ec2-2.example.com'],
+        'slave-3': ['ec2-3.example.com'],
+    }
+    assert lookups == [['slave-2', 'slave-3']]
+    cluster.resolve_aws_names(['slave-1', 'slave-2', 'slave-3'])
+    assert len(lookups) == 1
+
+
+def test_node_inventory_indexes_ranges_lazily():
+    nodes = cluster.NodeInventory(['10.0.0.0/16', 'slave1.example.com'])
+    assert len(nodes) == 65537
+    assert nodes[0] == '10.0.0.0'
+    assert nodes[65535] == '10.0.255.255'
+    assert nodes[-1] == 'slave1.example.com'
+
+
+def test_node_inventory_iterates_like_get_ips_or_hostnames():
+    assert cluster.get_ips_or_hostnames('10.0.0.0/30') == ['10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3']
+    assert list(cluster.NodeInventory(['a', '10.0.0.1'])) == ['a', '10.0.0.1']
+
+
+def test_round_robin_skips_nodes_that_are_down():
+    selector = cluster.NodeSelector(cluster.NodeInventory(['a', 'b', 'c']), strategy='round_robin')
+    selector.mark_down('b')
+    assert [selector.select() for _ in range(4)] == ['a', 'c', 'a', 'c']
+
+
+def test_least_outstanding_avoids_busy_nodes():
+    selector = cluster.NodeSelector(cluster.NodeInventory(['a', 'b']), strategy='least_outstanding')
+    with selector.track('a'):
+        assert selector.select() == 'b'
+
+
+def test_latency_weighted_prefers_fast_nodes():
+    selector = cluster.NodeSelector(cluster.NodeInventory(['fast', 'slow']), strategy='latency_weighted')
+    selector.record_latency('fast', 0.01)
+    selector.record_latency('slow', 100)
+    assert [selector.select() for _ in range(20)].count('fast') > 15
+
+
+def test_select_excludes_nodes_and_falls_back_to_down_nodes():
+    selector = cluster.NodeSelector(cluster.NodeInventory(['a', 'b']), strategy='random')
+    selector.mark_down('a')
+    assert selector.select(exclude=['b']) == 'a'
+    assert selector.select(exclude=['a', 'b']) is None
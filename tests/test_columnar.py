@@ -0,0 +1,46 @@
+from datetime import datetime
+from decimal import Decimal
+import pytest
+from athena.utils import columnar
+from athena.utils.file import guess_output_format
+
+pa = pytest.importorskip('pyarrow')
+
+DESCRIPTION = [
+    ('id', 'BIGINT', None, None, None, None, None),
+    ('name', 'STRING', None, None, None, None, None),
+    ('price', 'DECIMAL', None, None, 10, 2, None),
+    ('created', 'TIMESTAMP', None, None, None, None, None),
+]
+ROWS = [
+    (1, 'one', Decimal('1.50'), datetime(2015, 3, 1, 12, 0)),
+    (2, None, None, None),
+]
+
+
+def test_arrow_schema_keeps_names_and_types():
+    schema = columnar.arrow_schema(DESCRIPTION)
+    assert schema.names == ['id', 'name', 'price', 'created']
+    assert [str(f.type) for f in schema] == ['int64', 'string', 'decimal(10, 2)', 'timestamp[us]']
+
+
+def test_write_parquet_in_row_groups(tmpdir):
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = str(tmpdir.join('out.parquet'))
+    columnar.write_columnar(path, DESCRIPTION, [ROWS[:1], ROWS[1:]], 'parquet')
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.num_row_groups == 2
+    assert parquet_file.read(columns=['id']).column('id').to_pylist() == [1, 2]
+
+
+def test_write_arrow(tmpdir):
+    path = str(tmpdir.join('out.arrow'))
+    columnar.write_columnar(path, DESCRIPTION, [ROWS], 'arrow')
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    assert table.column('name').to_pylist() == [u'one', None]
+
+
+def test_guess_output_format():
+    assert guess_output_format('out.parquet') == 'parquet'
+    assert guess_output_format('out.ARROW') == 'arrow'
+    assert guess_output_format('out.csv.gz') == 'csv'
@@ -1,3 +1,4 @@
+import pytest
 from athena.utils import config
 
 
@@ -15,3 +16,39 @@ def test_is_collection_on_string():
 
 def test_is_collection_on_int():
     assert config.is_collection(666) is False
+
+
+def test_values_are_normalized():
+    c = config.Config({'a': ' text ', 'b': [' x', 'y '], 'c': {'d': 1}})
+    assert c.a == 'text'
+    assert c.b == ('x', 'y')
+    assert c.c.d == 1
+
+
+def test_config_is_read_only():
+    c = config.Config({'a': 1})
+    with pytest.raises(AttributeError):
+        c.a = 2
+    with pytest.raises(AttributeError):
+        c.b
+
+
+def test_load_merges_defaults_without_modifying_them():
+    c = config.Config.load("cluster:\n  impala_port: 1234\n")
+    assert c.cluster.impala_port == 1234
+    assert c.cluster.type == 'standard'
+    assert config.Config.DEFAULT_CONFIG['cluster']['impala_port'] == 21050
+
+
+def test_load_default_is_cached_until_file_changes(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    config.Config.clear_cache()
+    config_file = tmpdir.join('.athena', 'config.yml')
+    config.ConfigDir()
+    config_file.write("cluster:\n  master: one\n")
+    first = config.Config.load_default()
+    assert config.Config.load_default() is first
+
+    config_file.write("cluster:\n  master: other\n")
+    assert config.Config.load_default().cluster.master == 'other'
+    config.Config.clear_cache()
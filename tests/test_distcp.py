@@ -0,0 +1,75 @@
+import pytest
+from athena.utils.distcp import Copy, parse_manifest, run_copies, distcp_command
+
+OUTPUT = """16/05/01 10:00:01 INFO tools.DistCp: Input Options: DistCpOptions{atomicCommit=false}
+16/05/01 10:00:03 INFO mapreduce.Job: Running job: job_1462089600000_0001
+16/05/01 10:00:09 INFO mapreduce.Job:  map 0% reduce 0%
+16/05/01 10:00:21 INFO mapreduce.Job:  map 45% reduce 0%
+16/05/01 10:00:30 INFO mapreduce.Job:  map 100% reduce 0%
+16/05/01 10:00:31 INFO mapreduce.Job: Job job_1462089600000_0001 completed successfully"""
+
+
+class FakeClient(object):
+    def __init__(self, directories=(), failing=()):
+        self.directories = set(directories)
+        self.failing = failing
+        self.copies = []
+        self.chmods = []
+
+    def hdfs_is_dir(self, path):
+        return path in self.directories
+
+    def hdfs_mkdir(self, path):
+        self.directories.add(path)
+
+    def dist_copy(self, src, dst, maps=None, bandwidth=None, on_stdout=None, on_stderr=None, log_file=None):
+        self.copies.append((src, dst, maps, bandwidth))
+        for line in OUTPUT.split('\n'):
+            on_stderr(line)
+        return '', 'tail', 1 if src in self.failing else 0
+
+    def fix_hdfs_permissions(self, *paths):
+        self.chmods.append(paths)
+
+
+def test_copy_parses_progress():
+    copy = Copy('/data/in', '/data/out')
+    percentages = []
+    for line in OUTPUT.split('\n'):
+        if copy.feed(line):
+            percentages.append(copy.map_percent)
+    assert copy.job_id == 'job_1462089600000_0001'
+    assert percentages == [0, 45, 100, 100]
+
+
+def test_parse_manifest():
+    manifest = ['# logs', 's3n://bucket/logs/2016-05-01', '', 's3n://bucket/users  /data/users']
+    assert parse_manifest(manifest, '/data/logs') == [('s3n://bucket/logs/2016-05-01', '/data/logs'),
+                                                      ('s3n://bucket/users', '/data/users')]
+    with pytest.raises(ValueError):
+        parse_manifest(manifest)
+
+
+def test_distcp_command():
+    assert distcp_command('/a b', '/c', maps=20, bandwidth=50) == "sudo -u hdfs hadoop distcp -m 20 -bandwidth 50 " \
+                                                                  "'/a b' /c"
+
+
+def test_run_copies_fixes_permissions_of_written_paths_and_created_directories():
+    client = FakeClient(failing=['s3n://bucket/b'])
+    progress = []
+    jobs = run_copies(client, [('s3n://bucket/a', '/data'), ('s3n://bucket/b', '/data'), ('/x', 's3n://bucket/x')],
+                      parallel=2, maps=10, on_progress=lambda copies: progress.append(len(copies)))
+
+    assert [job.state for job in jobs] == ['done', 'failed', 'done']
+    assert client.directories == set(['/data'])
+    assert sorted(client.copies) == [('/x', 's3n://bucket/x', 10, None), ('s3n://bucket/a', '/data', 10, None),
+                                     ('s3n://bucket/b', '/data', 10, None)]
+    assert client.chmods == [('/data',)]
+    assert progress
+
+
+def test_run_copies_fixes_permissions_of_copies_into_existing_directories():
+    client = FakeClient(directories=['/data'])
+    run_copies(client, [('s3n://bucket/a', '/data'), ('s3n://bucket/b', '/data'), ('s3n://bucket/c', '/c')])
+    assert client.chmods == [('/data/a', '/data/b', '/c')]
@@ -0,0 +1,40 @@
+import gzip
+import pytest
+from athena.utils import file
+
+
+ROWS = [(1, 'one'), (2, 'two'), (3, 'three')]
+
+
+def test_write_csv(tmpdir):
+    path = str(tmpdir.join('out.csv'))
+    file.write_csv(path, iter(ROWS), headers=['id', 'name'], batch_size=2)
+    assert open(path).read() == 'id,name\r\n1,one\r\n2,two\r\n3,three\r\n'
+
+
+def test_write_csv_gzip(tmpdir):
+    path = str(tmpdir.join('out.csv.gz'))
+    file.write_csv_batches(path, [ROWS[:2], ROWS[2:]], headers=['id', 'name'])
+    assert gzip.open(path).read() == 'id,name\r\n1,one\r\n2,two\r\n3,three\r\n'
+
+
+def test_write_csv_zstd(tmpdir):
+    zstandard = pytest.importorskip('zstandard')
+    path = str(tmpdir.join('out.csv.zst'))
+    file.write_csv_batches(path, [ROWS])
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(open(path, 'rb').read()) == \
+        '1,one\r\n2,two\r\n3,three\r\n'
+
+
+def test_write_csv_reports_throughput(tmpdir):
+    reports = []
+    throughput = file.Throughput(lambda t, final: reports.append(final), interval=0)
+    file.write_csv_batches(str(tmpdir.join('out.csv')), [ROWS[:2], ROWS[2:]], headers=['id', 'name'],
+                           progress=throughput)
+    assert throughput.rows == 3
+    assert throughput.bytes == len('id,name\r\n1,one\r\n2,two\r\n3,three\r\n')
+    assert reports[-1] is True
+
+
+def test_chunked():
+    assert list(file.chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
@@ -0,0 +1,29 @@
+from athena.broadcasting import mailing
+
+
+def test_run_report_queries_runs_identical_queries_once(tmpdir, monkeypatch):
+    executed = []
+
+    def run_report_query(query):
+        executed.append(query['query'])
+        if query['kind'] == 'csv':
+            with open(query['path'], 'w') as f:
+                f.write('a\n1\n')
+            return query['path']
+        return {'headers': ['a'], 'rows': [(1,)]}
+
+    monkeypatch.setattr(mailing, 'run_report_query', run_report_query)
+    queries = [
+        {'kind': 'inline', 'name': 'first', 'query': 'SELECT a FROM t'},
+        {'kind': 'inline', 'name': 'second', 'query': 'select a\n  from t;'},
+        {'kind': 'csv', 'name': 'first.csv', 'query': 'SELECT a FROM t', 'path': str(tmpdir.join('first.csv'))},
+        {'kind': 'csv', 'name': 'second.csv', 'query': 'SELECT a FROM t', 'path': str(tmpdir.join('second.csv'))},
+    ]
+    results, executions = mailing.run_report_queries(queries, concurrency=2)
+
+    assert executions == 2
+    assert sorted(executed) == ['SELECT a FROM t', 'SELECT a FROM t']
+    assert [error for _, error in results] == [None] * 4
+    assert results[0][0] is results[1][0]
+    assert [result for result, _ in results[2:]] == [queries[2]['path'], queries[3]['path']]
+    assert tmpdir.join('second.csv').read() == 'a\n1\n'
@@ -0,0 +1,104 @@
+import pytest
+from athena.queries.pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def ping(self):
+        if not self.conn.alive:
+            raise IOError("connection lost")
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.alive = True
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections():
+    return []
+
+
+@pytest.fixture
+def pool(connections):
+    def connect(host, port):
+        conn = FakeConnection(host, port)
+        connections.append(conn)
+        return conn
+    return ConnectionPool(max_size=2, idle_timeout=300, health_check_interval=0, acquire_timeout=0.01,
+                          connect_fn=connect)
+
+
+def test_connections_are_reused(pool, connections):
+    with pool.connection('node1', 21050):
+        pass
+    with pool.connection('node1', 21050):
+        pass
+    assert len(connections) == 1
+
+
+def test_connections_are_keyed_by_host_and_port(pool, connections):
+    with pool.connection('node1', 21050):
+        pass
+    with pool.connection('node2', 21050):
+        pass
+    assert [(c.host, c.port) for c in connections] == [('node1', 21050), ('node2', 21050)]
+
+
+def test_size_limit(pool):
+    first = pool.acquire('node1', 21050)
+    pool.acquire('node1', 21050)
+    with pytest.raises(PoolTimeout):
+        pool.acquire('node1', 21050)
+    pool.release(first)
+    assert pool.acquire('node1', 21050) is first
+
+
+def test_unhealthy_connection_is_replaced(pool, connections):
+    with pool.connection('node1', 21050):
+        pass
+    connections[0].alive = False
+    with pool.connection('node1', 21050) as conn:
+        assert conn is connections[1]
+    assert connections[0].closed
+
+
+def test_idle_connections_are_evicted(pool, connections):
+    pool.idle_timeout = -1
+    with pool.connection('node1', 21050):
+        pass
+    assert connections[0].closed
+    assert pool.stats() == {}
+
+
+def test_close(pool, connections):
+    pooled = pool.acquire('node1', 21050)
+    with pool.connection('node2', 21050):
+        pass
+    pool.close()
+    assert connections[1].closed
+    assert not connections[0].closed
+    pool.release(pooled)
+    assert connections[0].closed
+
+
+def test_connect_and_health_check_times_are_kept_as_latency(pool):
+    pool.health_check_interval = 300
+    pooled = pool.acquire('node1', 21050)
+    assert pooled.latency is not None
+    pool.release(pooled)
+    assert pool.acquire('node1', 21050).latency is None
@@ -0,0 +1,35 @@
+from athena.queries import render
+
+
+def test_render_table_uses_widths_of_first_batch():
+    lines = []
+    render.render_table(['id', 'name'], [[(1, 'one'), (22, None)], [(333, 'three!')]], lines.append)
+    assert lines == [
+        'id  name',
+        '--  ----',
+        '1   one',
+        '22',
+        '333  three!',
+    ]
+
+
+def test_render_table_max_rows():
+    lines = []
+    written = render.render_table(['id'], [[(1,), (2,)], [(3,)]], lines.append, max_rows=2)
+    assert written == 2
+    assert lines[-1] == '... (output limited to 2 rows)'
+
+
+def test_render_table_asks_for_more_after_every_full_page():
+    fetched = []
+
+    def batches():
+        for batch in ([(1,), (2,)], [(3,), (4,)], [(5,)]):
+            fetched.append(batch)
+            yield batch
+
+    lines = []
+    answers = iter([True, False])
+    written = render.render_table(['id'], batches(), lines.append, page_size=2, more=lambda: next(answers))
+    assert written == 4
+    assert len(fetched) == 2
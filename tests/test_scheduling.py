@@ -0,0 +1,246 @@
+import calendar
+from datetime import datetime
+
+import pytest
+import pytz
+
+from athena.scheduling.runner import CronScheduler, ScheduledJob, SchedulerState, load_jobs, to_timestamp
+from athena.scheduling.schedules import CronSchedule, ScheduleRegistry, parse_cron_field
+from athena.utils.config import ConfigDir
+from athena.utils import profiling, wait_until
+
+
+def test_reports_with_the_same_schedule_are_coalesced(tmpdir, monkeypatch):
+    pytest.importorskip('celery')
+    monkeypatch.setenv('HOME', str(tmpdir))
+    from athena.scheduling.celeryconfig import read_schedules_from
+
+    reports = ConfigDir(str(tmpdir.mkdir('reports')))
+    reports.write('a.yml', "title: Report A\nschedule: {minute: 0, hour: 7}\n")
+    reports.write('b.yml', "title: Report B\nschedule: {minute: 0, hour: 7}\n")
+    reports.write('c.yml', "title: Report C\nschedule: {minute: 30, hour: 7}\n")
+
+    schedule = read_schedules_from(reports)
+    assert sorted(schedule) == ['report-a+report-b', 'report-c']
+    assert schedule['report-a+report-b']['task'] == 'athena.scheduling.scheduler.process_jobs'
+    assert schedule['report-a+report-b']['args'] == (['a.yml', 'b.yml'],)
+    assert schedule['report-c']['args'] == ('c.yml',)
+    assert sorted(read_schedules_from(reports, coalesce=False)) == ['report-a', 'report-b', 'report-c']
+
+
+def test_fanned_out_reports_run_each_inline_query_in_a_task(tmpdir, monkeypatch):
+    pytest.importorskip('celery')
+    monkeypatch.setenv('HOME', str(tmpdir))
+    from athena.scheduling import scheduler, get_metrics, ReportError
+
+    queries = [
+        {'kind': 'inline', 'name': 'totals', 'description': None, 'query': 'SELECT 1'},
+        {'kind': 'csv', 'name': 'totals.csv', 'query': 'SELECT 1', 'path': str(tmpdir.join('out', 'totals.csv'))},
+        {'kind': 'inline', 'name': 'broken', 'description': None, 'query': 'SELECT x'},
+    ]
+    reports = [('a.yml', {'title': 'A'}, queries[:2]), ('b.yml', {'title': 'B'}, [dict(queries[0]), queries[2]])]
+    executed = []
+    sent = []
+
+    def run_report_query(query):
+        executed.append(query['query'])
+        if query['query'] == 'SELECT x':
+            raise ValueError('no column x')
+        if query['kind'] == 'csv':
+            with open(query['path'], 'w') as f:
+                f.write('a\n1\n')
+            return query['path']
+        return {'headers': ['a'], 'rows': [(1,)]}
+
+    monkeypatch.setattr(scheduler, 'prepare_reports', lambda names: (reports, []))
+    monkeypatch.setattr(scheduler, 'run_report_query', run_report_query)
+    # the chord callback runs the csv queries itself, like mail_reports does
+    monkeypatch.setattr('athena.broadcasting.mailing.run_report_query',
+                        lambda query: executed.append('callback') or run_report_query(query))
+    monkeypatch.setattr('athena.broadcasting.mailing.send_report',
+                        lambda job, blocks, csvs, template=None: sent.append((job['title'], blocks, csvs)))
+    monkeypatch.setattr(scheduler.celery_app.conf, 'CELERY_ALWAYS_EAGER', True)
+    monkeypatch.setattr(scheduler.celery_app.conf, 'CELERY_EAGER_PROPAGATES_EXCEPTIONS', True)
+    tmpdir.join('.athena', 'config.yml').write("scheduling:\n  query_retries: 0\n", ensure=True)
+
+    with pytest.raises(ReportError) as e:
+        scheduler.process_jobs(['a.yml', 'b.yml'])
+    assert "b.yml failed to run 1 of its queries: 'broken': ValueError: no column x" in str(e.value)
+    assert executed == ['SELECT 1', 'SELECT x', 'callback', 'SELECT 1']
+    assert [(title, [b['name'] for b in blocks], [c['name'] for c in csvs]) for title, blocks, csvs in sent] == [
+        ('A', ['totals'], ['totals.csv'])]
+    assert tmpdir.join('out', 'totals.csv').read() == 'a\n1\n'
+    assert get_metrics().read()['query_executions_saved'] == 1
+
+
+def test_job_metrics_are_collected_and_written_to_a_textfile(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setattr(profiling, '_profiler', None)
+    from athena.scheduling import enable_metrics, job_metrics, get_metrics
+    tmpdir.join('.athena', 'config.yml').write(
+        "scheduling:\n  metrics: true\n  metrics_textfile: {}\n".format(tmpdir.join('athena.prom')), ensure=True)
+
+    assert enable_metrics()
+    with job_metrics():
+        with profiling.span('query.execute'):
+            profiling.count('query.rows', 10)
+    with pytest.raises(ValueError):
+        with job_metrics():
+            raise ValueError('broken')
+
+    metrics = get_metrics().read()
+    assert (metrics['jobs'], metrics['jobs_failed'], metrics['query_rows']) == (2, 1, 10)
+    assert metrics['job_seconds']['count'] == 2
+    assert metrics['stage_seconds{stage="query.execute"}']['count'] == 1
+    text = tmpdir.join('athena.prom').read()
+    assert 'athena_scheduler_jobs_failed_total 1\n' in text
+    assert 'athena_scheduler_stage_seconds_count{stage="query.execute"} 1\n' in text
+
+
+def test_parse_cron_field():
+    assert parse_cron_field('*/15', 0, 59) == {0, 15, 30, 45}
+    assert parse_cron_field('1,10-12', 1, 31) == {1, 10, 11, 12}
+    assert parse_cron_field('mon-wed', 0, 6, ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')) == {1, 2, 3}
+    with pytest.raises(ValueError):
+        parse_cron_field('61', 0, 59)
+
+
+def test_cron_schedule_next_after():
+    # 9:15 on a monday between the 10th and the 17th, in January, February or March
+    schedule = CronSchedule(minute=15, hour=9, day_of_week=1, day_of_month='10-17', month_of_year='1, 2, 3')
+    assert schedule.next_after(datetime(2026, 10, 18, 12, 0)) == datetime(2027, 1, 11, 9, 15)
+    assert schedule.next_after(datetime(2027, 1, 11, 9, 15)) == datetime(2027, 2, 15, 9, 15)
+    assert CronSchedule(minute='*/30').next_after(datetime(2026, 1, 1, 8, 30, 12)) == datetime(2026, 1, 1, 9, 0)
+    with pytest.raises(ValueError):
+        CronSchedule(day_of_month=31, month_of_year=2).next_after(datetime(2026, 1, 1))
+
+
+class FakeClock(object):
+    def __init__(self, dt):
+        self.now = to_timestamp(dt)
+
+    def __call__(self):
+        return self.now
+
+
+def test_cron_scheduler_runs_due_and_missed_jobs(tmpdir):
+    clock = FakeClock(datetime(2026, 10, 18, 7, 59))
+    state = SchedulerState(ConfigDir(str(tmpdir)))
+    state.update('missed', last_run=to_timestamp(datetime(2026, 10, 17, 7, 0)))
+    state.update('too-late', last_run=to_timestamp(datetime(2026, 10, 10, 7, 0)))
+    runs = []
+    jobs = [ScheduledJob('daily', CronSchedule(minute=0, hour=8), ['daily.yml']),
+            ScheduledJob('missed', CronSchedule(minute=0, hour=7), ['missed.yml']),
+            ScheduledJob('too-late', CronSchedule(minute=0, hour=7, day_of_week='sat'), ['too-late.yml'])]
+    engine = CronScheduler(jobs, runs.append, state, workers=2, missed_run_grace=3600 * 24, clock=clock)
+    engine.start()
+
+    assert engine.tick() == 60
+    clock.now += 60
+    engine.tick()
+    engine.shutdown()
+    assert sorted(runs) == [['daily.yml'], ['missed.yml']]
+    state = SchedulerState(ConfigDir(str(tmpdir)))
+    assert state.get('daily') == {'last_run': clock.now, 'last_status': 'ok', 'last_duration': 0}
+    assert engine.jobs['daily'].next_run == to_timestamp(datetime(2026, 10, 19, 8, 0))
+    assert engine.jobs['too-late'].next_run == to_timestamp(datetime(2026, 10, 24, 7, 0))
+
+
+def test_cron_scheduler_runs_jobs_that_are_due_at_the_same_time_together(tmpdir):
+    # a monday
+    clock = FakeClock(datetime(2026, 10, 19, 6, 59))
+    runs = []
+    jobs = [ScheduledJob('daily', CronSchedule(minute=0, hour=7), ['daily.yml']),
+            ScheduledJob('weekdays', CronSchedule(minute=0, hour=7, day_of_week='mon-fri'), ['weekdays.yml']),
+            ScheduledJob('later', CronSchedule(minute=30, hour=7), ['later.yml'])]
+    engine = CronScheduler(jobs, runs.append, SchedulerState(ConfigDir(str(tmpdir))), clock=clock)
+    engine.start()
+    clock.now += 60
+    engine.tick()
+    engine.shutdown()
+    assert runs == [['daily.yml', 'weekdays.yml']]
+
+
+def test_cron_scheduler_evaluates_schedules_in_its_timezone(tmpdir):
+    # 7:00 in Tokyo is 22:00 UTC the day before
+    clock = FakeClock(datetime(2026, 10, 18))
+    clock.now = calendar.timegm(datetime(2026, 10, 18, 21, 59).utctimetuple())
+    runs = []
+    engine = CronScheduler([ScheduledJob('daily', CronSchedule(minute=0, hour=7), ['daily.yml'])], runs.append,
+                           SchedulerState(ConfigDir(str(tmpdir))), clock=clock, timezone=pytz.timezone('Asia/Tokyo'))
+    engine.start()
+    assert engine.tick() == 60
+    clock.now += 60
+    engine.tick()
+    engine.shutdown()
+    assert runs == [['daily.yml']]
+    assert engine.jobs['daily'].next_run == calendar.timegm(datetime(2026, 10, 19, 22, 0).utctimetuple())
+
+
+def test_cron_scheduler_skips_runs_of_jobs_that_are_still_running(tmpdir):
+    clock = FakeClock(datetime(2026, 10, 18, 8, 0, 30))
+    release = []
+    runs = []
+
+    def run_job(files):
+        runs.append(files)
+        wait_until(lambda: release, 0.01)
+
+    engine = CronScheduler([ScheduledJob('often', CronSchedule(), ['often.yml'])], run_job,
+                           SchedulerState(ConfigDir(str(tmpdir))), clock=clock)
+    engine.start()
+    for _ in range(3):
+        clock.now += 60
+        engine.tick()
+    release.append(True)
+    engine.shutdown()
+    assert runs == [['often.yml']]
+
+
+def test_schedule_registry_reparses_changed_files_and_isolates_broken_ones(tmpdir, monkeypatch):
+    reports = ConfigDir(str(tmpdir))
+    reports.write('a.yml', "title: Report A\nschedule: {minute: 0, hour: 7}\n")
+    reports.write('b.yml', "schedule: {minute: 0, hour: 7}\n")
+    reports.write('broken.yml', "title: [oops\n")
+    reports.write('invalid.yml', "title: Invalid\nschedule: {hour: 25}\n")
+    registry = ScheduleRegistry(reports)
+    assert registry.refresh()
+    fields = {'minute': '0', 'hour': '7', 'day_of_week': '*', 'day_of_month': '*', 'month_of_year': '*'}
+    assert dict(registry.schedules()) == {'report-a+b': {'fields': fields, 'files': ['a.yml', 'b.yml']}}
+    assert sorted(registry.errors) == ['broken.yml', 'invalid.yml']
+
+    parsed = []
+    parse = registry._parse
+    monkeypatch.setattr(registry, '_parse', lambda filename: parsed.append(filename) or parse(filename))
+    assert not registry.refresh()
+    assert parsed == []
+
+    reports.write('broken.yml', "title: Fixed\nschedule: {minute: 30}\n")
+    reports.delete('a.yml')
+    assert registry.refresh()
+    assert parsed == ['broken.yml']
+    assert sorted(registry.schedules()) == ['b', 'fixed']
+    assert sorted(registry.errors) == ['invalid.yml']
+
+
+def test_cron_scheduler_applies_reloaded_jobs(tmpdir):
+    reports = ConfigDir(str(tmpdir.mkdir('reports')))
+    reports.write('a.yml', "title: A\nschedule: {minute: 0, hour: 7}\n")
+    reports.write('b.yml', "title: B\nschedule: {minute: 0, hour: 8}\n")
+    registry = ScheduleRegistry(reports)
+    registry.refresh()
+    clock = FakeClock(datetime(2026, 10, 18, 6, 0))
+    engine = CronScheduler(load_jobs(registry), None, SchedulerState(ConfigDir(str(tmpdir))), clock=clock,
+                           registry=registry)
+    engine.start()
+    job_a = engine.jobs['a']
+
+    reports.write('a.yml', "title: A\nschedule: {minute: 30, hour: 6}\n\n")
+    reports.delete('b.yml')
+    reports.write('c.yml', "title: C\nschedule: {minute: 0, hour: 9}\n")
+    engine.reload()
+    engine.shutdown()
+    assert list(engine.jobs) == ['a', 'c']
+    assert engine.jobs['a'] is job_a
+    assert job_a.next_run == to_timestamp(datetime(2026, 10, 18, 6, 30))
+    assert engine.jobs['c'].next_run == to_timestamp(datetime(2026, 10, 18, 9, 0))
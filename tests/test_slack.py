@@ -0,0 +1,72 @@
+from contextlib import contextmanager
+
+import pytest
+
+from athena.queries import limit_query
+from athena.queries.cache import CachedCursor
+from slack_mock import SlackMock
+
+
+@pytest.fixture
+def slack(tmpdir, monkeypatch):
+    slacker = pytest.importorskip('slacker')
+    from athena.broadcasting import slack
+    monkeypatch.setenv('HOME', str(tmpdir))
+    tmpdir.join('.athena', 'config.yml').write(
+        "slack:\n  token: xoxb-test\n  default_channel: data\n  max_table_rows: 3\n  max_message_chars: 60\n",
+        ensure=True)
+    server = SlackMock().start()
+    monkeypatch.setattr(slacker, 'API_BASE_URL', server.url)
+    monkeypatch.setattr(slack, '_clients', {})
+    monkeypatch.setattr(slack, 'server', server, raising=False)
+    yield slack
+    server.stop()
+
+
+def fake_query(slack, monkeypatch, rows):
+    executed = []
+
+    @contextmanager
+    def query_impala_cursor(sql):
+        executed.append(sql)
+        yield CachedCursor([('id',), ('name',)], rows[:int(sql.rsplit(' ', 1)[-1])])
+
+    monkeypatch.setattr(slack, 'query_impala_cursor', query_impala_cursor)
+    return executed
+
+
+def test_limit_query():
+    assert limit_query('SELECT * FROM t -- all of it', 10) == 'SELECT * FROM t\nLIMIT 10'
+    assert limit_query('-- customers\nSELECT * FROM t; -- done', 10) == '-- customers\nSELECT * FROM t\nLIMIT 10'
+    assert limit_query("SELECT '--', '/*' FROM t /* all; of it */;\n", 10) == "SELECT '--', '/*' FROM t\nLIMIT 10"
+    assert limit_query('select * from t limit 5;', 10) == 'select * from t limit 5;'
+    assert limit_query('SELECT * FROM t LIMIT 5 -- top five', 10) == 'SELECT * FROM t LIMIT 5 -- top five'
+    assert limit_query('SELECT * FROM t LIMIT 5 /* top five */;', 10) == 'SELECT * FROM t LIMIT 5 /* top five */;'
+    assert limit_query('SELECT 1; SELECT 2', 10) == 'SELECT 1; SELECT 2'
+    assert limit_query("SELECT * FROM t WHERE name = 'unterminated", 10) == "SELECT * FROM t WHERE name = 'unterminated"
+    assert limit_query('SHOW TABLES', 10) == 'SHOW TABLES'
+
+
+def test_small_results_are_posted_as_tables_in_chunks(slack, monkeypatch):
+    executed = fake_query(slack, monkeypatch, [(i, 'customer {}'.format(i)) for i in range(3)])
+    slack.server.rate_limited = 1
+
+    assert slack.broadcast_query('SELECT id, name FROM customers', 'Customers') == 3
+    assert executed == ['SELECT id, name FROM customers\nLIMIT 10001']
+    assert slack.server.rate_limited == 0
+    messages = [params['text'] for api, params, _ in slack.server.calls]
+    assert [api for api, _, _ in slack.server.calls] == ['chat.postMessage'] * 2
+    assert messages[0].startswith('\nCustomers ```id    name')
+    assert 'customer 2' in messages[1]
+    assert all(params['channel'] == '#data' for _, params, _ in slack.server.calls)
+
+
+def test_large_results_are_uploaded_as_csv(slack, monkeypatch):
+    fake_query(slack, monkeypatch, [(i, 'customer {}'.format(i)) for i in range(10)])
+
+    assert slack.broadcast_query('SELECT id, name FROM customers', 'Customers', max_rows=5) == 5
+    [(api, params, body)] = slack.server.calls
+    assert api == 'files.upload'
+    assert params['filename'] == 'customers.csv'
+    assert params['initial_comment'] == 'Customers: The first 5 rows'
+    assert 'id,name\r\n0,customer 0\r\n' in body and '4,customer 4' in body and '5,customer 5' not in body
@@ -0,0 +1,194 @@
+import os
+import shutil
+import stat
+import time
+
+import pytest
+from athena.utils import ssh
+from athena.utils.config import ConfigDir
+from athena.utils.ssh import SSHConnectionRegistry, OutputStream, FileDigests, RemoteFileStore, UnsafeRemoteFileError
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class FakeClient(object):
+    def __init__(self, host):
+        self.host = host
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+@pytest.fixture
+def clients():
+    return []
+
+
+@pytest.fixture
+def registry(clients):
+    def connect(host, username, ssh_key, keepalive):
+        client = FakeClient(host)
+        clients.append(client)
+        return client
+    return SSHConnectionRegistry(connect_fn=connect)
+
+
+def test_connections_are_shared(registry, clients):
+    assert registry.get('master', 'hadoop', '~/.ssh/id_rsa') is registry.get('master', 'hadoop', '~/.ssh/id_rsa')
+    registry.get('other', 'hadoop', '~/.ssh/id_rsa')
+    assert [c.host for c in clients] == ['master', 'other']
+
+
+def test_lost_connections_are_reopened(registry, clients):
+    client = registry.get('master')
+    client.transport.active = False
+    assert registry.get('master') is not client
+    assert client.closed
+    assert len(clients) == 2
+
+
+def test_close(registry, clients):
+    registry.get('master')
+    registry.get('other')
+    registry.close()
+    assert all(c.closed for c in clients)
+    with pytest.raises(RuntimeError):
+        registry.get('master')
+
+
+def test_output_stream_passes_on_lines_and_keeps_a_tail(tmpdir):
+    lines = []
+    log = tmpdir.join('output.log')
+    with log.open('wb') as f:
+        stream = OutputStream(lines.append, f, tail_lines=2)
+        stream.feed('one\ntw')
+        stream.feed('o\nthree\nfour')
+        stream.close()
+    assert lines == ['one', 'two', 'three', 'four']
+    assert stream.getvalue() == '... (2 earlier lines omitted)\nthree\nfour'
+    assert log.read() == 'one\ntwo\nthree\nfour'
+
+
+def test_output_stream_splits_long_lines(monkeypatch):
+    monkeypatch.setattr(ssh, 'MAX_LINE_LENGTH', 4)
+    lines = []
+    stream = OutputStream(lines.append)
+    stream.feed('abcdef')
+    stream.feed('gh\n')
+    assert lines == ['abcdef', 'gh']
+
+
+class LocalSFTP(object):
+    """Stands in for an SFTPClient, working on the local file system."""
+
+    def __init__(self):
+        self.puts = []
+
+    def listdir_attr(self, path):
+        return [FileAttributes(name, os.lstat(os.path.join(path, name))) for name in os.listdir(path)]
+
+    def put(self, local_path, remote_path):
+        self.puts.append(local_path)
+        shutil.copy(local_path, remote_path)
+
+    def mkdir(self, path, mode=0o777):
+        if os.path.exists(path):
+            raise IOError("Failure")
+        os.mkdir(path, mode)
+
+    def normalize(self, path):
+        return os.path.abspath(path)
+
+    def rename(self, old_path, new_path):
+        if os.path.exists(new_path):
+            raise IOError("Failure")
+        os.rename(old_path, new_path)
+
+    def __getattr__(self, name):
+        # chmod, listdir, lstat, remove, rmdir, stat, symlink and utime behave like their counterparts in os
+        return getattr(os, name)
+
+
+class FileAttributes(object):
+    def __init__(self, filename, st):
+        self.filename = filename
+        self.st_size = st.st_size
+        self.st_mtime = st.st_mtime
+        self.st_mode = st.st_mode
+        self.st_uid = st.st_uid
+
+
+def test_remote_file_store_uploads_changed_files_only(tmpdir):
+    script = tmpdir.join('script.pig')
+    script.write('A = LOAD "data";')
+    udf = tmpdir.join('udfs.jar')
+    udf.write('jar contents')
+    sftp = LocalSFTP()
+    digests = FileDigests(ConfigDir(str(tmpdir.mkdir('config'))))
+    store = RemoteFileStore(sftp, str(tmpdir.join('remote')), digests=digests)
+
+    first = store.upload([str(script), str(udf)], 'pig_scripts')
+    script.write('A = LOAD "other data";')
+    second = store.upload([str(script), str(udf)], 'pig_scripts')
+
+    assert sftp.puts == [str(script), str(udf), str(script)]
+    assert open(os.path.join(first, 'script.pig')).read() == 'A = LOAD "data";'
+    assert open(os.path.join(second, 'script.pig')).read() == 'A = LOAD "other data";'
+    assert open(os.path.join(second, 'udfs.jar')).read() == 'jar contents'
+
+
+def test_remote_file_store_runs_in_the_same_millisecond_get_their_own_directory(tmpdir, monkeypatch):
+    script = tmpdir.join('script.pig')
+    script.write('A = LOAD "data";')
+    store = RemoteFileStore(LocalSFTP(), str(tmpdir.join('remote')),
+                            digests=FileDigests(ConfigDir(str(tmpdir.mkdir('config')))))
+    monkeypatch.setattr(ssh.time, 'time', lambda: 1500000000.0)
+
+    first = store.upload([str(script)], 'pig_scripts')
+    second = store.upload([str(script)], 'pig_scripts')
+    assert first != second
+    assert sorted(os.listdir(store.runs_dir)) == sorted([os.path.basename(first), os.path.basename(second)])
+
+
+def test_remote_file_store_removes_stale_runs_and_files(tmpdir):
+    script = tmpdir.join('script.pig')
+    script.write('A = LOAD "data";')
+    store = RemoteFileStore(LocalSFTP(), str(tmpdir.join('remote')), max_age=60,
+                            digests=FileDigests(ConfigDir(str(tmpdir.mkdir('config')))))
+    old_run = store.upload([str(script)])
+    assert store.clean() == 0
+
+    past = time.time() - 120
+    for path in [old_run] + [os.path.join(store.files_dir, name) for name in os.listdir(store.files_dir)]:
+        os.utime(path, (past, past))
+    assert store.clean() == 2
+    assert os.listdir(store.runs_dir) == os.listdir(store.files_dir) == []
+
+
+def test_remote_file_store_only_uses_private_directories_of_the_user(tmpdir):
+    script = tmpdir.join('script.pig')
+    script.write('A = LOAD "data";')
+    digests = FileDigests(ConfigDir(str(tmpdir.mkdir('config'))))
+    remote = tmpdir.join('remote')
+    run_dir = RemoteFileStore(LocalSFTP(), str(remote), digests=digests).upload([str(script)])
+    for path in (str(remote), os.path.dirname(run_dir), run_dir):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+
+    remote.chmod(0o777)
+    with pytest.raises(UnsafeRemoteFileError):
+        RemoteFileStore(LocalSFTP(), str(remote), digests=digests).upload([str(script)])
+    remote.chmod(0o700)
+    with pytest.raises(UnsafeRemoteFileError):
+        RemoteFileStore(LocalSFTP(), str(remote), digests=digests, uid=os.getuid() + 1).upload([str(script)])
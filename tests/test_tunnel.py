@@ -0,0 +1,165 @@
+import socket
+import struct
+import threading
+
+import pytest
+
+from athena.utils import wait_until
+from athena.utils.tunnel import TunnelForwarder, parse_forward_spec, parse_socks_spec
+
+
+class FakeChannel(object):
+    """Stands in for a paramiko channel, backed by one end of a socket pair."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def shutdown_write(self):
+        self.sock.shutdown(socket.SHUT_WR)
+
+    def close(self):
+        self.sock.close()
+
+
+class EchoTransport(object):
+    """Opens channels to an echo server."""
+
+    def __init__(self):
+        self.requests = []
+
+    def open_channel(self, kind, dest_addr, src_addr):
+        self.requests.append((kind, dest_addr))
+        return self._echo_channel()
+
+    def _echo_channel(self):
+        local, remote = socket.socketpair()
+        thread = threading.Thread(target=self._echo, args=(remote,))
+        thread.daemon = True
+        thread.start()
+        return FakeChannel(local)
+
+    @staticmethod
+    def _echo(sock):
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sock.sendall(data)
+        sock.close()
+
+
+class SlowTransport(EchoTransport):
+    """Only opens channels to 'unreachable' once `reachable` is set, like an SSH server trying to connect to it."""
+
+    def __init__(self):
+        EchoTransport.__init__(self)
+        self.reachable = threading.Event()
+
+    def open_channel(self, kind, dest_addr, src_addr):
+        if dest_addr[0] == 'unreachable':
+            self.reachable.wait(5)
+        return EchoTransport.open_channel(self, kind, dest_addr, src_addr)
+
+
+@pytest.fixture
+def forwarder():
+    forwarder = TunnelForwarder(SlowTransport(), quiet=True)
+    thread = threading.Thread(target=forwarder.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield forwarder
+    forwarder.stop()
+    thread.join(5)
+
+
+def read_all(sock):
+    received = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return ''.join(received)
+        received.append(data)
+
+
+def test_forwarder_copies_data_both_ways(forwarder):
+    port = forwarder.add_forward(0, 'node1', 8888, bind_address='127.0.0.1')
+    payload = ''.join(chr(i % 256) for i in range(256)) * 8192
+    client = socket.create_connection(('127.0.0.1', port))
+    sender = threading.Thread(target=lambda: (client.sendall(payload), client.shutdown(socket.SHUT_WR)))
+    sender.start()
+    received = read_all(client)
+    sender.join()
+    client.close()
+    assert received == payload
+
+    wait_until(lambda: not forwarder.connections, 0.01)
+    assert forwarder.transport.requests == [('direct-tcpip', ('node1', 8888))]
+    stats = forwarder.stats()
+    assert (stats['connections'], stats['open']) == (1, 0)
+    assert stats['bytes_sent'] == stats['bytes_received'] == len(payload)
+    assert forwarder.recent[0].first_byte_time is not None
+
+
+def test_socks_proxy(forwarder):
+    port = forwarder.add_socks(0, bind_address='127.0.0.1')
+    client = socket.create_connection(('127.0.0.1', port))
+    # a client may send its request and data without waiting for the replies
+    hostname = 'node2.example.com'
+    client.sendall('\x05\x01\x00' + '\x05\x01\x00\x03' + chr(len(hostname)) + hostname + struct.pack('>H', 8042) +
+                   'GET / HTTP/1.0\r\n\r\n')
+    client.shutdown(socket.SHUT_WR)
+    received = read_all(client)
+    client.close()
+
+    assert received[:2] == '\x05\x00'
+    assert received[2:12] == '\x05\x00\x00\x01' + '\x00' * 6
+    assert received[12:] == 'GET / HTTP/1.0\r\n\r\n'
+    assert forwarder.transport.requests == [('direct-tcpip', ('node2.example.com', 8042))]
+
+
+def test_slow_channels_do_not_hold_up_other_connections(forwarder):
+    slow = socket.create_connection(('127.0.0.1', forwarder.add_forward(0, 'unreachable', 80, '127.0.0.1')))
+    wait_until(lambda: forwarder.opening, 0.01)
+    client = socket.create_connection(('127.0.0.1', forwarder.add_forward(0, 'node1', 80, '127.0.0.1')))
+    client.settimeout(2)
+    client.sendall('ping')
+    assert client.recv(4) == 'ping'
+    assert not forwarder.transport.reachable.is_set()
+
+    forwarder.transport.reachable.set()
+    slow.settimeout(2)
+    slow.sendall('pong')
+    assert slow.recv(4) == 'pong'
+    client.close()
+    slow.close()
+
+
+def test_socks_proxy_only_listens_on_loopback_by_default(forwarder):
+    forwarder.add_socks(0)
+    assert [server.getsockname()[0] for server in forwarder.listeners] == ['127.0.0.1']
+
+
+def test_parse_socks_spec():
+    assert parse_socks_spec('1080') == ('127.0.0.1', 1080)
+    assert parse_socks_spec('0.0.0.0:1080') == ('0.0.0.0', 1080)
+    with pytest.raises(ValueError):
+        parse_socks_spec('localhost:socks')
+
+
+def test_parse_forward_spec():
+    assert parse_forward_spec('8080:node1:80') == ('', 8080, 'node1', 80)
+    assert parse_forward_spec('127.0.0.1:8080:node1:80') == ('127.0.0.1', 8080, 'node1', 80)
+    with pytest.raises(ValueError):
+        parse_forward_spec('8080:node1')
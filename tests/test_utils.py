@@ -0,0 +1,67 @@
+import time
+import urllib2
+from athena.utils import imap_bounded, profiling
+from athena.utils.config import ConfigDir
+from athena.utils.metrics import Counters, MetricsServer, format_prometheus, histogram
+
+
+def test_imap_bounded_keeps_order():
+    def slow_for_small(x):
+        time.sleep(0.01 * (5 - x))
+        return x * 2
+    results = list(imap_bounded(slow_for_small, range(5), 5))
+    assert [r for r, _ in results] == [0, 2, 4, 6, 8]
+
+
+def test_imap_bounded_reports_errors_per_item():
+    def fail_on_odd(x):
+        if x % 2:
+            raise ValueError(x)
+        return x
+    results = list(imap_bounded(fail_on_odd, range(4), 2))
+    assert [r for r, _ in results] == [0, None, 2, None]
+    assert [e[0] if e else None for _, e in results] == [None, ValueError, None, ValueError]
+
+
+def test_counters(tmpdir):
+    counters = Counters(ConfigDir(str(tmpdir)), 'metrics.json')
+    counters.increment(queries=3, executions=2)
+    counters.increment(queries=2, executions=2)
+    assert Counters(ConfigDir(str(tmpdir)), 'metrics.json').read() == {'queries': 5, 'executions': 4}
+
+
+def test_histograms_are_merged_and_served_for_prometheus(tmpdir):
+    counters = Counters(ConfigDir(str(tmpdir)), 'metrics.json')
+    counters.update({'reports': 2}, {'seconds{stage="smtp"}': histogram((0.5, 1), 0.2, 3)})
+    counters.update({'reports': 1}, {'seconds{stage="smtp"}': histogram((0.5, 1), 0.5)})
+    text = format_prometheus(counters.read(), 'athena_')
+    assert text.splitlines() == [
+        '# TYPE athena_reports_total counter',
+        'athena_reports_total 3',
+        '# TYPE athena_seconds histogram',
+        'athena_seconds_bucket{stage="smtp",le="0.5"} 2',
+        'athena_seconds_bucket{stage="smtp",le="1"} 2',
+        'athena_seconds_bucket{stage="smtp",le="+Inf"} 3',
+        'athena_seconds_sum{stage="smtp"} 3.7',
+        'athena_seconds_count{stage="smtp"} 3',
+    ]
+
+    server = MetricsServer(lambda: text, 0, '127.0.0.1').start()
+    try:
+        assert urllib2.urlopen('http://127.0.0.1:{}/metrics'.format(server.port)).read() == text
+    finally:
+        server.stop()
+
+
+def test_spans_are_recorded_only_when_profiling(monkeypatch):
+    monkeypatch.setattr(profiling, '_profiler', None)
+    with profiling.span('ignored'):
+        pass
+    profiler = profiling.enable_profiling()
+    for _ in range(2):
+        with profiling.span('stage'):
+            time.sleep(0.01)
+    assert list(profiler.stages) == ['stage']
+    assert profiler.stages['stage']['calls'] == 2
+    assert profiler.stages['stage']['total_seconds'] >= 0.02
+    assert 'stage' in profiler.report().splitlines()[1]